@@ -1,5 +1,42 @@
 import React, { useState, useEffect, useCallback } from 'react';
 
+// Splits one server-sent event into its name and parsed JSON payload (comment lines are ignored)
+function parseEvent(message) {
+  let event = 'message';
+  let data = '';
+  for (const line of message.split('\n')) {
+    if (line.startsWith('event:')) {
+      event = line.slice(6).trim();
+    } else if (line.startsWith('data:')) {
+      data += line.slice(5).trim();
+    }
+  }
+  return { event, data: data ? JSON.parse(data) : null };
+}
+
+// Adds a usage delta (same shape as the summary) to the current summary
+function applyDelta(summary, delta) {
+  if (!summary) {
+    return summary;
+  }
+  const modelUsage = { ...summary.model_usage };
+  for (const [model, usage] of Object.entries(delta.model_usage)) {
+    const current = modelUsage[model] || { input_tokens: 0, output_tokens: 0, requests: 0 };
+    modelUsage[model] = {
+      input_tokens: current.input_tokens + usage.input_tokens,
+      output_tokens: current.output_tokens + usage.output_tokens,
+      requests: current.requests + usage.requests,
+    };
+  }
+  return {
+    total_requests: summary.total_requests + delta.total_requests,
+    total_input_tokens: summary.total_input_tokens + delta.total_input_tokens,
+    total_output_tokens: summary.total_output_tokens + delta.total_output_tokens,
+    estimated_total_cost_usd: Math.round((summary.estimated_total_cost_usd + delta.estimated_total_cost_usd) * 1e6) / 1e6,
+    model_usage: modelUsage,
+  };
+}
+
 // Make sure onLogout is accepted as a prop here
 function UsageDashboard({ onLogout }) {
   const [usageData, setUsageData] = useState(null);
@@ -15,7 +52,10 @@ function UsageDashboard({ onLogout }) {
   }, [onLogout]); // Add onLogout to useCallback's dependency array
 
   useEffect(() => {
-    const fetchUsage = async () => {
+    const controller = new AbortController(); // Closes the stream when the component unmounts
+    let retryTimer = null;
+
+    const streamUsage = async () => {
       const token = localStorage.getItem('accessToken'); // Get the stored token
       if (!token) {
         // If no token, set an error and stop loading
@@ -25,36 +65,69 @@ function UsageDashboard({ onLogout }) {
       }
 
       try {
-        // Make the API call to your backend with the Authorization header
-        const response = await fetch('http://127.0.0.1:8000/usage/summary', {
+        // fetch rather than EventSource, which cannot send the Authorization header
+        const response = await fetch('http://127.0.0.1:8000/usage/summary/stream', {
           headers: {
             'Authorization': `Bearer ${token}`,
           },
+          signal: controller.signal,
         });
 
         if (!response.ok) {
           // If response is not OK (e.g., 401, 403, 500), parse error and set it
           const errorData = await response.json();
           setError(`Failed to fetch usage data: ${response.status} - ${JSON.stringify(errorData)}`);
+          setLoading(false);
           // If it's an auth error, maybe log out automatically
           if (response.status === 401 || response.status === 403) {
             handleLogout(); // Log out if token is invalid/expired
           }
-        } else {
-          // If successful, parse data and set it to state
-          const data = await response.json();
-          setUsageData(data);
+          return;
+        }
+
+        // The server sends one "snapshot" event with the full summary, then "delta" events as usage is recorded
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+          const { value, done } = await reader.read();
+          if (done) {
+            break;
+          }
+          buffer += decoder.decode(value, { stream: true });
+          const messages = buffer.split('\n\n');
+          buffer = messages.pop(); // Keep any incomplete message for the next chunk
+          for (const message of messages) {
+            const { event, data } = parseEvent(message);
+            if (event === 'snapshot') {
+              setUsageData(data);
+              setError(null);
+              setLoading(false);
+            } else if (event === 'delta') {
+              setUsageData(previous => applyDelta(previous, data));
+            }
+          }
         }
       } catch (err) {
+        if (controller.signal.aborted) {
+          return;
+        }
         // Catch any network or other unexpected errors
         setError(`An error occurred: ${err.message}`);
-      } finally {
-        // Always set loading to false when done
         setLoading(false);
       }
+
+      // The connection dropped: reconnect, which starts again from a fresh snapshot
+      if (!controller.signal.aborted) {
+        retryTimer = setTimeout(streamUsage, 3000);
+      }
     };
 
-    fetchUsage(); // Call the fetch function when the component mounts
+    streamUsage(); // Open the stream when the component mounts
+    return () => {
+      controller.abort();
+      clearTimeout(retryTimer);
+    };
   }, [onLogout, handleLogout]); // Now handleLogout is stable
 
   // Conditional rendering based on loading, error, or data presence
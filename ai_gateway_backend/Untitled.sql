@@ -4,5 +4,63 @@ CREATE TABLE usage_log (
     model_name VARCHAR(255) NOT NULL,
     input_tokens INT NOT NULL,
     output_tokens INT NOT NULL,
-    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+    cost_usd DECIMAL(12, 6) NULL,
+    cache_hit BOOLEAN NOT NULL DEFAULT FALSE
 );
+
+CREATE INDEX idx_usage_log_user_time ON usage_log (user_id, timestamp, id);
+
+-- Per-user x model rollups, maintained by the usage writer.
+-- Backfill existing installs with: python -m backend.db.rollups rebuild
+CREATE TABLE usage_rollup_hourly (
+    user_id VARCHAR(255) NOT NULL,
+    model_name VARCHAR(255) NOT NULL,
+    bucket_start DATETIME NOT NULL,
+    requests INT NOT NULL DEFAULT 0,
+    input_tokens BIGINT NOT NULL DEFAULT 0,
+    output_tokens BIGINT NOT NULL DEFAULT 0,
+    cost_usd DECIMAL(16, 6) NOT NULL DEFAULT 0,
+    cache_hits INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, model_name, bucket_start)
+);
+
+CREATE TABLE usage_rollup_daily (
+    user_id VARCHAR(255) NOT NULL,
+    model_name VARCHAR(255) NOT NULL,
+    bucket_start DATETIME NOT NULL,
+    requests INT NOT NULL DEFAULT 0,
+    input_tokens BIGINT NOT NULL DEFAULT 0,
+    output_tokens BIGINT NOT NULL DEFAULT 0,
+    cost_usd DECIMAL(16, 6) NOT NULL DEFAULT 0,
+    cache_hits INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, model_name, bucket_start)
+);
+
+CREATE TABLE usage_rollup_total (
+    user_id VARCHAR(255) NOT NULL,
+    model_name VARCHAR(255) NOT NULL,
+    requests INT NOT NULL DEFAULT 0,
+    input_tokens BIGINT NOT NULL DEFAULT 0,
+    output_tokens BIGINT NOT NULL DEFAULT 0,
+    cost_usd DECIMAL(16, 6) NOT NULL DEFAULT 0,
+    cache_hits INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, model_name)
+);
+
+-- Monthly RANGE partitioning of usage_log, managed by backend.db.usage_archive
+-- (which adds upcoming months by splitting pmax and archives expired ones).
+-- MySQL requires the partitioning column in every unique key.
+ALTER TABLE usage_log
+    MODIFY timestamp DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    DROP PRIMARY KEY,
+    ADD PRIMARY KEY (id, timestamp);
+ALTER TABLE usage_log PARTITION BY RANGE COLUMNS (timestamp) (
+    PARTITION pmax VALUES LESS THAN (MAXVALUE)
+);
+
+-- Upgrading an install whose usage_log predates cost_usd / cache_hit: run this
+-- once. A fresh install gets both columns from CREATE TABLE and must not run it.
+-- ALTER TABLE usage_log
+--     ADD COLUMN cost_usd DECIMAL(12, 6) NULL,
+--     ADD COLUMN cache_hit BOOLEAN NOT NULL DEFAULT FALSE;
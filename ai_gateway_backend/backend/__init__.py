@@ -0,0 +1,4 @@
+from dotenv import load_dotenv
+
+# Loaded once, before any backend module reads its configuration from the environment
+load_dotenv()
@@ -0,0 +1,379 @@
+"""
+Load-testing benchmark for the gateway.
+
+Starts the provider simulator and the gateway (uvicorn, SQLite database,
+fresh spool directory) as subprocesses, then drives each scenario at each
+concurrency level for a fixed time and reports throughput and latency
+percentiles. Results are written as JSON, tagged with the git commit, so
+runs can be compared across commits:
+
+    python -m backend.bench.run --concurrency 1,16,64 --duration 15 --output before.json
+    python -m backend.bench.run --concurrency 1,16,64 --duration 15 --compare before.json
+
+Scenarios: token (POST /token), generate (POST /generate), generate_stream
+(POST /generate/stream, with time to first delta), usage (GET /usage) and
+usage_summary (GET /usage/summary). Prompts are unique and sent with
+cache "bypass", so every generate request reaches the simulator.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime, timezone
+from typing import Optional
+
+import httpx
+
+from backend.bench import simulator
+
+SCENARIOS = ["token", "generate", "generate_stream", "usage", "usage_summary"]
+BENCH_PASSWORD = "bench-password"
+# The directory containing the backend package; subprocesses run from here
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _percentile(sorted_values: list[float], q: float) -> Optional[float]:
+    # Nearest-rank percentile
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * q // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def _summary_ms(values: list[float]) -> dict:
+    values = sorted(values)
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "mean": None, "max": None}
+    return {
+        "p50": round(_percentile(values, 50) * 1000, 3),
+        "p95": round(_percentile(values, 95) * 1000, 3),
+        "p99": round(_percentile(values, 99) * 1000, 3),
+        "mean": round(sum(values) / len(values) * 1000, 3),
+        "max": round(values[-1] * 1000, 3),
+    }
+
+
+class Gateway:
+    """
+    The simulator and the gateway as subprocesses, stopped on exit.
+    """
+
+    def __init__(self, args: argparse.Namespace, workdir: str):
+        self.args = args
+        self.workdir = workdir
+        self.processes: list[subprocess.Popen] = []
+        self.url = f"http://127.0.0.1:{args.gateway_port}"
+        self.simulator_url = f"http://127.0.0.1:{args.simulator_port}"
+
+    def _spawn(self, command: list[str], env: dict, name: str):
+        log = open(os.path.join(self.workdir, f"{name}.log"), "w")
+        self.processes.append(subprocess.Popen(command, cwd=PROJECT_DIR, env=env, stdout=log, stderr=subprocess.STDOUT))
+
+    def start(self):
+        args = self.args
+        simulator_flags = []
+        for name in vars(simulator.SimulatorConfig()):
+            value = getattr(args, f"sim_{name}")
+            if value is not None:
+                simulator_flags += [f"--{name.replace('_', '-')}", str(value)]
+        self._spawn([sys.executable, "-m", "backend.bench.simulator", "--port", str(args.simulator_port)]
+                    + simulator_flags, dict(os.environ), "simulator")
+
+        env = dict(os.environ)
+        env.update({
+            "DB_BACKEND": "sqlite",
+            "DB_PATH": os.path.join(self.workdir, "bench.db"),
+            "USAGE_SPOOL_DIR": os.path.join(self.workdir, "spool"),
+            "RATE_LIMIT_SQLITE_PATH": os.path.join(self.workdir, "rate_limits.db"),
+            "SECRET_KEY": env.get("SECRET_KEY", "bench-secret"),
+            "OPENAI_BASE_URL": f"{self.simulator_url}/v1",
+            "ANTHROPIC_BASE_URL": self.simulator_url,
+            "LLAMA_API_URL": f"{self.simulator_url}/v1/chat/completions",
+            "OPENAI_API_KEY": "simulated",
+            "ANTHROPIC_API_KEY": "simulated",
+            "LLAMA_API_KEY": "simulated",
+            "USE_OPENAI_MOCK": "false",
+            "USE_ANTHROPIC_MOCK": "false",
+            "USE_LLAMA_MOCK": "false",
+            # The simulator speaks HTTP/1.1 only
+            "USE_HTTP2": "false",
+        })
+        if not args.rate_limits:
+            env["RATE_LIMIT_ENABLED"] = "false"
+        for assignment in args.env:
+            name, _, value = assignment.partition("=")
+            env[name] = value
+        self._spawn([sys.executable, "-m", "uvicorn", "backend.main:app", "--host", "127.0.0.1",
+                     "--port", str(args.gateway_port), "--log-level", "warning"], env, "gateway")
+
+    async def wait_ready(self, timeout: float = 60):
+        deadline = time.monotonic() + timeout
+        async with httpx.AsyncClient() as client:
+            for url in (f"{self.simulator_url}/stats", f"{self.url}/openapi.json"):
+                while True:
+                    if any(process.poll() is not None for process in self.processes):
+                        raise RuntimeError(f"A benchmark subprocess exited early; see the logs in {self.workdir}")
+                    try:
+                        if (await client.get(url)).status_code == 200:
+                            break
+                    except httpx.HTTPError:
+                        pass
+                    if time.monotonic() > deadline:
+                        raise RuntimeError(f"{url} not ready after {timeout}s; see the logs in {self.workdir}")
+                    await asyncio.sleep(0.2)
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+async def _create_users(client: httpx.AsyncClient, count: int, run_id: str) -> list[dict]:
+    # Registration hashes passwords; a few at a time stays within the hashing queue
+    semaphore = asyncio.Semaphore(4)
+
+    async def create(i: int) -> dict:
+        username = f"bench-{run_id}-{i}"
+        async with semaphore:
+            response = await client.post("/register", json={
+                "username": username, "email": f"{username}@example.com", "password": BENCH_PASSWORD
+            })
+            response.raise_for_status()
+            response = await client.post("/token", data={"username": username, "password": BENCH_PASSWORD})
+            response.raise_for_status()
+        return {"username": username, "headers": {"Authorization": f"Bearer {response.json()['access_token']}"}}
+
+    return await asyncio.gather(*(create(i) for i in range(count)))
+
+
+async def _seed_usage(client: httpx.AsyncClient, users: list[dict], args: argparse.Namespace, concurrency: int):
+    # Gives the usage queries some rows to read
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def seed(user: dict):
+        async with semaphore:
+            await _request(client, "generate", user, args.model, args.max_tokens)
+
+    await asyncio.gather(*(seed(user) for user in users for _ in range(args.seed_requests)))
+
+
+async def _request(client: httpx.AsyncClient, scenario: str, user: dict, model: str,
+                   max_tokens: int) -> tuple[int, Optional[float]]:
+    """
+    Sends one request; returns (status, seconds to the first streamed delta
+    or None).
+    """
+    if scenario == "token":
+        response = await client.post("/token", data={"username": user["username"], "password": BENCH_PASSWORD})
+        return response.status_code, None
+    if scenario == "usage":
+        return (await client.get("/usage", params={"limit": 50}, headers=user["headers"])).status_code, None
+    if scenario == "usage_summary":
+        return (await client.get("/usage/summary", headers=user["headers"])).status_code, None
+
+    payload = {"prompt": f"benchmark {uuid.uuid4().hex} tell me something", "model_name": model,
+               "max_tokens": max_tokens, "cache": "bypass"}
+    if scenario == "generate":
+        return (await client.post("/generate", json=payload, headers=user["headers"])).status_code, None
+
+    start = time.perf_counter()
+    first_delta = None
+    async with client.stream("POST", "/generate/stream", json=payload, headers=user["headers"]) as response:
+        async for line in response.aiter_lines():
+            if first_delta is None and line.startswith("event: delta"):
+                first_delta = time.perf_counter() - start
+            if line.startswith("event: error"):
+                return 599, first_delta
+    return response.status_code, first_delta
+
+
+async def _run_level(client: httpx.AsyncClient, scenario: str, concurrency: int, users: list[dict],
+                     args: argparse.Namespace) -> dict:
+    latencies: list[float] = []
+    first_deltas: list[float] = []
+    statuses: dict[str, int] = {}
+    warm_until = time.monotonic() + args.warmup
+    stop_at = warm_until + args.duration
+
+    async def worker(user: dict):
+        while True:
+            start = time.monotonic()
+            if start >= stop_at:
+                return
+            try:
+                status, first_delta = await _request(client, scenario, user, args.model, args.max_tokens)
+            except httpx.HTTPError as e:
+                status, first_delta = type(e).__name__, None
+            if start < warm_until:
+                continue
+            latencies.append(time.monotonic() - start)
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            if first_delta is not None:
+                first_deltas.append(first_delta)
+
+    started = time.monotonic()
+    await asyncio.gather(*(worker(users[i % len(users)]) for i in range(concurrency)))
+    # Requests still in flight at the deadline finish late; count the time they took
+    elapsed = max(time.monotonic(), stop_at) - max(started, warm_until)
+    requests = len(latencies)
+    ok = statuses.get("200", 0)
+    result = {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": requests - ok,
+        "status_counts": statuses,
+        "duration_s": round(elapsed, 3),
+        "throughput_rps": round(ok / elapsed, 3) if elapsed > 0 else 0.0,
+        "latency_ms": _summary_ms(latencies),
+    }
+    if scenario == "generate_stream":
+        result["first_delta_ms"] = _summary_ms(first_deltas)
+    return result
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=PROJECT_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args: argparse.Namespace) -> dict:
+    gateway = None
+    workdir = args.workdir or tempfile.mkdtemp(prefix="gateway-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    if args.gateway_url:
+        url = args.gateway_url
+    else:
+        gateway = Gateway(args, workdir)
+        gateway.start()
+        url = gateway.url
+    try:
+        if gateway is not None:
+            await gateway.wait_ready()
+        levels = [int(level) for level in args.concurrency.split(",")]
+        limits = httpx.Limits(max_connections=max(levels), max_keepalive_connections=max(levels))
+        timeout = httpx.Timeout(args.request_timeout)
+        async with httpx.AsyncClient(base_url=url, limits=limits, timeout=timeout) as client:
+            users = await _create_users(client, min(max(levels), args.users), uuid.uuid4().hex[:8])
+            if "usage" in args.scenarios or "usage_summary" in args.scenarios:
+                await _seed_usage(client, users, args, max(levels))
+            results = []
+            for scenario in args.scenarios:
+                for concurrency in levels:
+                    result = await _run_level(client, scenario, concurrency, users, args)
+                    results.append(result)
+                    print(_format_result(result), file=sys.stderr)
+            simulator_stats = None
+            if gateway is not None:
+                simulator_stats = (await client.get(f"{gateway.simulator_url}/stats")).json()
+    finally:
+        if gateway is not None:
+            gateway.stop()
+
+    return {
+        "meta": {
+            "commit": _git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "args": {name: value for name, value in vars(args).items() if name not in ("output", "compare")},
+        },
+        "simulator": simulator_stats,
+        "results": results,
+    }
+
+
+def _format_result(result: dict) -> str:
+    latency = result["latency_ms"]
+    return (f"{result['scenario']:<16} c={result['concurrency']:<4} {result['throughput_rps']:>9.1f} req/s  "
+            f"p50={latency['p50']}ms p95={latency['p95']}ms p99={latency['p99']}ms  errors={result['errors']}")
+
+
+def compare(baseline: dict, current: dict, threshold: Optional[float] = None) -> bool:
+    """
+    Prints throughput and p95/p99 changes per (scenario, concurrency).
+    Returns False if any throughput dropped, or any p95 grew, by more than
+    `threshold` percent.
+    """
+    def change(old, new):
+        return None if not old or new is None else (new - old) / old * 100
+
+    def fmt(value):
+        return "n/a" if value is None else f"{value:+.1f}%"
+
+    ok = True
+    before = {(result["scenario"], result["concurrency"]): result for result in baseline["results"]}
+    print(f"baseline {baseline['meta'].get('commit')} -> current {current['meta'].get('commit')}")
+    for result in current["results"]:
+        old = before.get((result["scenario"], result["concurrency"]))
+        if old is None:
+            continue
+        rps = change(old["throughput_rps"], result["throughput_rps"])
+        p95 = change(old["latency_ms"]["p95"], result["latency_ms"]["p95"])
+        p99 = change(old["latency_ms"]["p99"], result["latency_ms"]["p99"])
+        print(f"{result['scenario']:<16} c={result['concurrency']:<4} rps {fmt(rps):>8}  p95 {fmt(p95):>8}  "
+              f"p99 {fmt(p99):>8}")
+        if threshold is not None and ((rps is not None and rps < -threshold) or (p95 is not None and p95 > threshold)):
+            ok = False
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the gateway against a simulated provider")
+    parser.add_argument("--scenarios", type=lambda value: value.split(","), default=SCENARIOS,
+                        help=f"Comma-separated subset of {','.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", default="1,8,32", help="Comma-separated concurrency levels")
+    parser.add_argument("--duration", type=float, default=10, help="Measured seconds per scenario and level")
+    parser.add_argument("--warmup", type=float, default=1, help="Unmeasured seconds before each measurement")
+    parser.add_argument("--users", type=int, default=64, help="Most users to spread requests over")
+    parser.add_argument("--model", default="gpt-4")
+    parser.add_argument("--max-tokens", type=int, default=50)
+    parser.add_argument("--seed-requests", type=int, default=20,
+                        help="Generate requests per user before the usage scenarios")
+    parser.add_argument("--request-timeout", type=float, default=120)
+    parser.add_argument("--rate-limits", action="store_true", help="Keep the gateway's per-user rate limits on")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="Extra gateway environment, e.g. --env COALESCE_ENABLED=false")
+    parser.add_argument("--gateway-url", help="Benchmark an already running gateway instead of starting one")
+    parser.add_argument("--gateway-port", type=int, default=9101)
+    parser.add_argument("--simulator-port", type=int, default=9100)
+    parser.add_argument("--workdir", help="Database, spool and logs; a temporary directory by default")
+    parser.add_argument("--output", help="Write the JSON results here (default: stdout)")
+    parser.add_argument("--compare", help="Baseline results JSON to compare against")
+    parser.add_argument("--fail-threshold", type=float,
+                        help="With --compare, exit 1 if throughput drops or p95 grows by more than this percent")
+    simulator.add_arguments(parser, prefix="sim-")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    results = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if not compare(baseline, results, args.fail_threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+"""
+Local stand-in for the upstream providers, for benchmarks. Serves the
+OpenAI and OpenRouter chat completions API and the Anthropic messages API,
+streaming and not, with configurable latency, streaming speed and injected
+failures.
+
+    python -m backend.bench.simulator --port 9100 --latency-ms 300 --error-rate 0.01
+
+Point the gateway at it with:
+
+    OPENAI_BASE_URL=http://127.0.0.1:9100/v1
+    ANTHROPIC_BASE_URL=http://127.0.0.1:9100
+    LLAMA_API_URL=http://127.0.0.1:9100/v1/chat/completions
+"""
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+from dataclasses import dataclass
+from typing import Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+@dataclass
+class SimulatorConfig:
+    # Time to the full response, or to the first chunk when streaming
+    latency_ms: float = 200.0
+    # "fixed", "uniform" (0..2x), "exponential" (mean) or "lognormal" (median, spread latency_sigma)
+    latency_dist: str = "lognormal"
+    latency_sigma: float = 0.5
+    # Streaming speed after the first chunk; 0 sends all chunks at once
+    tokens_per_second: float = 50.0
+    output_tokens: int = 50
+    # Fraction of requests answered 500, and 429 with Retry-After
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    retry_after: float = 1.0
+    seed: Optional[int] = None
+
+
+config = SimulatorConfig()
+app = FastAPI(title="Provider simulator")
+_random = random.Random()
+stats = {"requests": 0, "errors": 0, "rate_limited": 0}
+
+
+def _latency() -> float:
+    base = config.latency_ms / 1000
+    if config.latency_dist == "fixed":
+        return base
+    if config.latency_dist == "uniform":
+        return _random.uniform(0, 2 * base)
+    if config.latency_dist == "exponential":
+        return _random.expovariate(1 / base) if base > 0 else 0.0
+    return _random.lognormvariate(0, config.latency_sigma) * base
+
+
+def _fault(anthropic: bool) -> Optional[JSONResponse]:
+    # One draw per request, so the two rates are independent fractions of all traffic
+    draw = _random.random()
+    if draw < config.rate_limit_rate:
+        stats["rate_limited"] += 1
+        kind = "rate_limit_error" if anthropic else "rate_limit_exceeded"
+        return JSONResponse(_error_body(kind, "Simulated rate limit", anthropic), status_code=429,
+                            headers={"retry-after": str(config.retry_after)})
+    if draw < config.rate_limit_rate + config.error_rate:
+        stats["errors"] += 1
+        kind = "api_error" if anthropic else "server_error"
+        return JSONResponse(_error_body(kind, "Simulated server error", anthropic), status_code=500)
+    return None
+
+
+def _error_body(kind: str, message: str, anthropic: bool) -> dict:
+    if anthropic:
+        return {"type": "error", "error": {"type": kind, "message": message}}
+    return {"error": {"type": kind, "message": message, "code": None, "param": None}}
+
+
+def _request_tokens(body: dict) -> tuple[int, list[str]]:
+    prompt = " ".join(
+        message["content"] if isinstance(message.get("content"), str) else json.dumps(message.get("content"))
+        for message in body.get("messages", [])
+    )
+    output_tokens = max(1, min(config.output_tokens, int(body.get("max_tokens") or config.output_tokens)))
+    words = [("lorem " if i else "Lorem ") for i in range(output_tokens)]
+    return max(1, len(prompt.split())), words
+
+
+async def _paced(words: list[str]):
+    # Yields once per token at tokens_per_second, after the first-chunk latency
+    await asyncio.sleep(_latency())
+    interval = 1 / config.tokens_per_second if config.tokens_per_second > 0 else 0
+    for i, word in enumerate(words):
+        if i and interval:
+            await asyncio.sleep(interval)
+        yield word
+
+
+def _sse(data: dict, event: Optional[str] = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+
+@app.head("/")
+@app.head("/v1")
+@app.head("/v1/chat/completions")
+async def warm_up():
+    return JSONResponse(None)
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    stats["requests"] += 1
+    body = await request.json()
+    fault = _fault(anthropic=False)
+    if fault is not None:
+        await asyncio.sleep(_latency())
+        return fault
+    input_tokens, words = _request_tokens(body)
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+    model = body.get("model", "")
+    usage = {"prompt_tokens": input_tokens, "completion_tokens": len(words),
+             "total_tokens": input_tokens + len(words)}
+
+    if not body.get("stream"):
+        await asyncio.sleep(_latency() + (len(words) / config.tokens_per_second if config.tokens_per_second else 0))
+        return {
+            "id": completion_id, "object": "chat.completion", "created": created, "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(words).strip()},
+                         "finish_reason": "length"}],
+            "usage": usage,
+        }
+
+    include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+
+    async def events():
+        chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model}
+        async for word in _paced(words):
+            yield _sse({**chunk, "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]})
+        yield _sse({**chunk, "choices": [{"index": 0, "delta": {}, "finish_reason": "length"}]})
+        if include_usage:
+            yield _sse({**chunk, "choices": [], "usage": usage})
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.post("/v1/messages")
+async def messages(request: Request):
+    stats["requests"] += 1
+    body = await request.json()
+    fault = _fault(anthropic=True)
+    if fault is not None:
+        await asyncio.sleep(_latency())
+        return fault
+    input_tokens, words = _request_tokens(body)
+    message_id = f"msg_{uuid.uuid4().hex}"
+    model = body.get("model", "")
+    message = {"id": message_id, "type": "message", "role": "assistant", "model": model,
+               "stop_reason": None, "stop_sequence": None}
+
+    if not body.get("stream"):
+        await asyncio.sleep(_latency() + (len(words) / config.tokens_per_second if config.tokens_per_second else 0))
+        return {**message, "stop_reason": "max_tokens",
+                "content": [{"type": "text", "text": "".join(words).strip()}],
+                "usage": {"input_tokens": input_tokens, "output_tokens": len(words)}}
+
+    async def events():
+        yield _sse({"type": "message_start", "message": {
+            **message, "content": [], "usage": {"input_tokens": input_tokens, "output_tokens": 1}
+        }}, "message_start")
+        yield _sse({"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}},
+                   "content_block_start")
+        async for word in _paced(words):
+            yield _sse({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": word}},
+                       "content_block_delta")
+        yield _sse({"type": "content_block_stop", "index": 0}, "content_block_stop")
+        yield _sse({"type": "message_delta", "delta": {"stop_reason": "max_tokens", "stop_sequence": None},
+                    "usage": {"output_tokens": len(words)}}, "message_delta")
+        yield _sse({"type": "message_stop"}, "message_stop")
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.get("/stats")
+async def get_stats():
+    return stats
+
+
+def add_arguments(parser: argparse.ArgumentParser, prefix: str = ""):
+    """
+    The simulator's settings as command line flags; the benchmark runner
+    passes the same flags through.
+    """
+    defaults = SimulatorConfig()
+    parser.add_argument(f"--{prefix}latency-ms", type=float, default=defaults.latency_ms)
+    parser.add_argument(f"--{prefix}latency-dist", choices=["fixed", "uniform", "exponential", "lognormal"],
+                        default=defaults.latency_dist)
+    parser.add_argument(f"--{prefix}latency-sigma", type=float, default=defaults.latency_sigma)
+    parser.add_argument(f"--{prefix}tokens-per-second", type=float, default=defaults.tokens_per_second)
+    parser.add_argument(f"--{prefix}output-tokens", type=int, default=defaults.output_tokens)
+    parser.add_argument(f"--{prefix}error-rate", type=float, default=defaults.error_rate)
+    parser.add_argument(f"--{prefix}rate-limit-rate", type=float, default=defaults.rate_limit_rate)
+    parser.add_argument(f"--{prefix}retry-after", type=float, default=defaults.retry_after)
+    parser.add_argument(f"--{prefix}seed", type=int, default=defaults.seed)
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Simulated OpenAI / Anthropic / OpenRouter API for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    add_arguments(parser)
+    args = parser.parse_args()
+    for name in vars(config):
+        setattr(config, name, getattr(args, name))
+    _random.seed(config.seed)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
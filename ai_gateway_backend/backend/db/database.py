@@ -1,19 +1,482 @@
 import os
-import mysql.connector
-from dotenv import load_dotenv
+import re
+import time
+import queue
+import asyncio
+import sqlite3
+import threading
+import contextvars
+from datetime import datetime
+from functools import lru_cache, partial
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Iterable, Optional
 
-load_dotenv()
+# "mysql" in production; "sqlite" for local runs, tests and benchmarks
+DB_BACKEND = os.getenv("DB_BACKEND", "mysql").lower()
 
 DB_HOST = os.getenv("DB_HOST", "localhost")
 DB_USER = os.getenv("DB_USER", "root")
 DB_PASSWORD = os.getenv("DB_PASSWORD", "")
 DB_NAME = os.getenv("DB_NAME", "ai_gateway")
+DB_PATH = os.getenv("DB_PATH", "ai_gateway.db")
 
-def get_connection():
+# Pool config
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_POOL_MIN_IDLE = int(os.getenv("DB_POOL_MIN_IDLE", "2"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "5"))
+# Idle connections older than this are pinged before being handed out again
+DB_HEALTHCHECK_INTERVAL = float(os.getenv("DB_HEALTHCHECK_INTERVAL", "30"))
+# Rows fetched per round trip by astream()
+DB_STREAM_BATCH_SIZE = int(os.getenv("DB_STREAM_BATCH_SIZE", "1000"))
+
+if DB_BACKEND == "mysql":
+    import mysql.connector
+    _DRIVER_ERRORS = (mysql.connector.Error,)
+    _INTEGRITY_ERRORS = (mysql.connector.IntegrityError,)
+    _DATA_ERRORS = (mysql.connector.IntegrityError, mysql.connector.DataError)
+elif DB_BACKEND == "sqlite":
+    _DRIVER_ERRORS = (sqlite3.Error,)
+    _INTEGRITY_ERRORS = (sqlite3.IntegrityError,)
+    # Binding a value sqlite can't store is a ProgrammingError (InterfaceError before Python 3.11)
+    _DATA_ERRORS = (sqlite3.IntegrityError, sqlite3.DataError, sqlite3.ProgrammingError, sqlite3.InterfaceError)
+else:
+    raise RuntimeError(f"Unsupported DB_BACKEND: {DB_BACKEND}")
+
+# Store/return DATETIME columns as datetime objects, same as mysql.connector does
+sqlite3.register_adapter(datetime, lambda d: d.isoformat(sep=" "))
+sqlite3.register_converter("DATETIME", lambda b: datetime.fromisoformat(b.decode()))
+
+SQLITE_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username VARCHAR(255) NOT NULL UNIQUE,
+        email VARCHAR(255) NOT NULL UNIQUE,
+        hashed_password VARCHAR(255) NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS usage_log (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id VARCHAR(255) NOT NULL,
+        model_name VARCHAR(255) NOT NULL,
+        input_tokens INT NOT NULL,
+        output_tokens INT NOT NULL,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+        cost_usd DECIMAL(12, 6) NULL,
+        cache_hit BOOLEAN NOT NULL DEFAULT 0
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_usage_log_user_time ON usage_log (user_id, timestamp, id)",
+    """
+    CREATE TABLE IF NOT EXISTS usage_rollup_hourly (
+        user_id VARCHAR(255) NOT NULL,
+        model_name VARCHAR(255) NOT NULL,
+        bucket_start DATETIME NOT NULL,
+        requests INT NOT NULL DEFAULT 0,
+        input_tokens BIGINT NOT NULL DEFAULT 0,
+        output_tokens BIGINT NOT NULL DEFAULT 0,
+        cost_usd DECIMAL(16, 6) NOT NULL DEFAULT 0,
+        cache_hits INT NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, model_name, bucket_start)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS usage_rollup_daily (
+        user_id VARCHAR(255) NOT NULL,
+        model_name VARCHAR(255) NOT NULL,
+        bucket_start DATETIME NOT NULL,
+        requests INT NOT NULL DEFAULT 0,
+        input_tokens BIGINT NOT NULL DEFAULT 0,
+        output_tokens BIGINT NOT NULL DEFAULT 0,
+        cost_usd DECIMAL(16, 6) NOT NULL DEFAULT 0,
+        cache_hits INT NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, model_name, bucket_start)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS usage_rollup_total (
+        user_id VARCHAR(255) NOT NULL,
+        model_name VARCHAR(255) NOT NULL,
+        requests INT NOT NULL DEFAULT 0,
+        input_tokens BIGINT NOT NULL DEFAULT 0,
+        output_tokens BIGINT NOT NULL DEFAULT 0,
+        cost_usd DECIMAL(16, 6) NOT NULL DEFAULT 0,
+        cache_hits INT NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, model_name)
+    )
+    """,
+]
+
+
+class DatabaseError(Exception):
+    pass
+
+
+class DataError(DatabaseError):
+    # The statement's values were rejected: retrying it unchanged fails the same way
+    pass
+
+
+class IntegrityError(DataError):
+    pass
+
+
+class PoolTimeout(DatabaseError):
+    pass
+
+
+def _connect():
+    if DB_BACKEND == "sqlite":
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False, detect_types=sqlite3.PARSE_DECLTYPES)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
     return mysql.connector.connect(
         host=DB_HOST,
         user=DB_USER,
         password=DB_PASSWORD,
         database=DB_NAME,
         auth_plugin='mysql_native_password'
-    )
\ No newline at end of file
+    )
+
+
+def _is_healthy(conn) -> bool:
+    try:
+        if DB_BACKEND == "sqlite":
+            conn.execute("SELECT 1")
+        else:
+            conn.ping(reconnect=False)
+        return True
+    except _DRIVER_ERRORS:
+        return False
+
+
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except _DRIVER_ERRORS:
+        pass
+
+
+@lru_cache(maxsize=512)
+def _translate(query: str) -> str:
+    # Queries are written with mysql's %s placeholders; sqlite wants ?
+    if DB_BACKEND != "sqlite":
+        return query
+    return re.sub(r"%(s|%)", lambda m: "?" if m.group(1) == "s" else "%", query)
+
+
+def _as_dicts(cursor, rows) -> list[dict]:
+    columns = [col[0] for col in cursor.description]
+    return [dict(zip(columns, row)) for row in rows]
+
+
+class ConnectionPool:
+    """
+    Fixed-size, thread-safe pool of database connections.
+
+    Connections are created lazily up to `size`, reused LIFO so the hottest
+    ones stay warm, and health-checked before reuse if they sat idle for
+    longer than `healthcheck_interval` seconds.
+    """
+
+    def __init__(self, connect, size: int, timeout: float, healthcheck_interval: float):
+        self._connect = connect
+        self._size = size
+        self._timeout = timeout
+        self._healthcheck_interval = healthcheck_interval
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._in_use = 0
+        self._created = 0
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def acquire(self):
+        if self._closed:
+            raise DatabaseError("Connection pool is closed")
+        if not self._slots.acquire(timeout=self._timeout):
+            raise PoolTimeout(f"No database connection available within {self._timeout}s")
+        try:
+            conn = self._checkout_idle()
+            if conn is None:
+                conn = self._connect()
+                with self._lock:
+                    self._created += 1
+        except BaseException as e:
+            self._slots.release()
+            if isinstance(e, _DRIVER_ERRORS):
+                raise DatabaseError(str(e)) from e
+            raise
+        with self._lock:
+            self._in_use += 1
+        return conn
+
+    def _checkout_idle(self):
+        while True:
+            try:
+                conn, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                return None
+            if time.monotonic() - last_used < self._healthcheck_interval or _is_healthy(conn):
+                return conn
+            _close_quietly(conn)
+
+    def release(self, conn, discard: bool = False):
+        with self._lock:
+            self._in_use -= 1
+        try:
+            if discard or self._closed:
+                _close_quietly(conn)
+            else:
+                self._idle.put((conn, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        except _DATA_ERRORS:
+            # The statement was rejected; the connection itself is fine
+            self._release_after_error(conn)
+            raise
+        except _DRIVER_ERRORS:
+            # The connection may be in an unknown state; don't hand it out again
+            self.release(conn, discard=True)
+            raise
+        except BaseException:
+            self._release_after_error(conn)
+            raise
+        else:
+            self.release(conn)
+
+    def _release_after_error(self, conn):
+        # A connection that can't roll back is discarded; the caller's error propagates either way
+        try:
+            conn.rollback()
+        except _DRIVER_ERRORS:
+            self.release(conn, discard=True)
+        else:
+            self.release(conn)
+
+    def prefill(self, count: int):
+        conns = []
+        try:
+            for _ in range(min(count, self._size)):
+                conns.append(self.acquire())
+        finally:
+            for conn in conns:
+                self.release(conn)
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            _close_quietly(conn)
+
+    def stats(self) -> dict:
+        return {
+            "size": self._size,
+            "created": self._created,
+            "in_use": self._in_use,
+            "idle": self._idle.qsize(),
+        }
+
+
+class Transaction:
+    """
+    A pooled connection plus cursor. Commits on clean exit, rolls back on error.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        # Buffered so a fetch_one never leaves unread rows on a mysql connection
+        self.cursor = conn.cursor(buffered=True) if DB_BACKEND == "mysql" else conn.cursor()
+
+    def execute(self, query: str, params: Iterable[Any] = ()) -> int:
+        self.cursor.execute(_translate(query), tuple(params))
+        return self.cursor.rowcount
+
+    def executemany(self, query: str, seq_params: list) -> int:
+        if not seq_params:
+            return 0
+        self.cursor.executemany(_translate(query), seq_params)
+        return self.cursor.rowcount
+
+    def fetch_one(self, query: str, params: Iterable[Any] = ()) -> Optional[dict]:
+        self.cursor.execute(_translate(query), tuple(params))
+        row = self.cursor.fetchone()
+        return _as_dicts(self.cursor, [row])[0] if row else None
+
+    def fetch_all(self, query: str, params: Iterable[Any] = ()) -> list[dict]:
+        self.cursor.execute(_translate(query), tuple(params))
+        return _as_dicts(self.cursor, self.cursor.fetchall())
+
+    @property
+    def lastrowid(self):
+        return self.cursor.lastrowid
+
+
+_pool: Optional[ConnectionPool] = None
+_pool_lock = threading.Lock()
+
+# Dedicated threads for blocking DB calls made from async handlers, so DB waits
+# never eat into the default threadpool FastAPI uses for sync endpoints.
+_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+
+
+def get_pool() -> ConnectionPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(_connect, DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_HEALTHCHECK_INTERVAL)
+    return _pool
+
+
+def init_pool():
+    """
+    Creates the pool, applies the local schema when running on SQLite, and
+    opens DB_POOL_MIN_IDLE connections ahead of the first request.
+    """
+    if DB_BACKEND == "sqlite":
+        with transaction() as tx:
+            for statement in SQLITE_SCHEMA:
+                tx.execute(statement)
+    get_pool().prefill(DB_POOL_MIN_IDLE)
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
+
+
+@contextmanager
+def transaction():
+    # Driver errors are converted only after connection() has seen them and discarded a broken connection
+    try:
+        with get_pool().connection() as conn:
+            tx = Transaction(conn)
+            try:
+                yield tx
+                conn.commit()
+            finally:
+                _close_quietly(tx.cursor)
+    except _INTEGRITY_ERRORS as e:
+        raise IntegrityError(str(e)) from e
+    except _DATA_ERRORS as e:
+        raise DataError(str(e)) from e
+    except _DRIVER_ERRORS as e:
+        raise DatabaseError(str(e)) from e
+
+
+def fetch_one(query: str, params: Iterable[Any] = ()) -> Optional[dict]:
+    with transaction() as tx:
+        return tx.fetch_one(query, params)
+
+
+def fetch_all(query: str, params: Iterable[Any] = ()) -> list[dict]:
+    with transaction() as tx:
+        return tx.fetch_all(query, params)
+
+
+def execute(query: str, params: Iterable[Any] = ()) -> int:
+    with transaction() as tx:
+        return tx.execute(query, params)
+
+
+def executemany(query: str, seq_params: list) -> int:
+    with transaction() as tx:
+        return tx.executemany(query, seq_params)
+
+
+# Async API
+async def run(fn, *args, **kwargs):
+    """
+    Runs a blocking DB function on the DB threadpool and awaits the result.
+    The caller's context goes with it, so tracing spans opened inside `fn`
+    belong to the calling request.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, contextvars.copy_context().run, partial(fn, *args, **kwargs))
+
+
+async def afetch_one(query: str, params: Iterable[Any] = ()) -> Optional[dict]:
+    return await run(fetch_one, query, params)
+
+
+async def afetch_all(query: str, params: Iterable[Any] = ()) -> list[dict]:
+    return await run(fetch_all, query, params)
+
+
+async def aexecute(query: str, params: Iterable[Any] = ()) -> int:
+    return await run(execute, query, params)
+
+
+async def aexecutemany(query: str, seq_params: list) -> int:
+    return await run(executemany, query, seq_params)
+
+
+def iter_batches(query: str, params: Iterable[Any] = (), batch_size: int = DB_STREAM_BATCH_SIZE):
+    """
+    Yields lists of up to batch_size rows (as dicts) from a server-side
+    (unbuffered on mysql) cursor, so memory stays flat however many rows
+    match. Holds one pooled connection until exhausted or closed.
+    """
+    pool = get_pool()
+    conn = pool.acquire()
+    cursor = None
+    exhausted = False
+    broken = False
+    try:
+        cursor = conn.cursor(buffered=False) if DB_BACKEND == "mysql" else conn.cursor()
+        cursor.execute(_translate(query), tuple(params))
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                exhausted = True
+                break
+            yield _as_dicts(cursor, rows)
+    except _DRIVER_ERRORS as e:
+        broken = True
+        raise DatabaseError(str(e)) from e
+    finally:
+        if cursor is not None:
+            try:
+                cursor.close()
+            except _DRIVER_ERRORS:
+                pass
+        # A mysql connection with unread rows can't be reused; drop it
+        discard = broken or (DB_BACKEND == "mysql" and not exhausted)
+        if not discard:
+            try:
+                conn.rollback()
+            except _DRIVER_ERRORS:
+                discard = True
+        pool.release(conn, discard=discard)
+
+
+async def astream(query: str, params: Iterable[Any] = (), batch_size: int = DB_STREAM_BATCH_SIZE):
+    """
+    Async row-by-row view of iter_batches(); each batch is fetched on the DB threadpool.
+    """
+    batches = iter_batches(query, params, batch_size)
+    try:
+        while True:
+            batch = await run(next, batches, None)
+            if batch is None:
+                break
+            for row in batch:
+                yield row
+    finally:
+        await run(batches.close)
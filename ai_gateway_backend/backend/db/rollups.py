@@ -0,0 +1,161 @@
+"""
+Per-user x model usage rollups, kept in step with usage_log.
+
+usage_rollup_hourly and usage_rollup_daily hold one row per user, model and
+hour/day; usage_rollup_total holds one row per user and model for all time.
+They are updated in the same transaction that inserts the usage_log rows, so
+they never drift from it. If they do (e.g. rows were written by hand), rebuild
+them from usage_log:
+
+    python -m backend.db.rollups rebuild [--user-id ID]
+"""
+import argparse
+from collections import defaultdict
+from datetime import datetime
+from typing import Iterable, Optional
+
+from backend.db import database
+from backend.services.pricing import MODEL_COSTS, DEFAULT_MODEL_COST, calculate_cost
+
+# table -> bucket granularity (None: one row per user and model)
+ROLLUP_TABLES = {
+    "usage_rollup_hourly": "hour",
+    "usage_rollup_daily": "day",
+    "usage_rollup_total": None,
+}
+_MEASURES = ("requests", "input_tokens", "output_tokens", "cost_usd", "cache_hits")
+
+
+def _bucket(timestamp: datetime, granularity: Optional[str]) -> Optional[datetime]:
+    if granularity == "hour":
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    if granularity == "day":
+        return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+    return None
+
+
+def _key_columns(granularity: Optional[str]) -> list[str]:
+    return ["user_id", "model_name"] + (["bucket_start"] if granularity else [])
+
+
+def _upsert_sql(table: str, granularity: Optional[str]) -> str:
+    columns = _key_columns(granularity) + list(_MEASURES)
+    placeholders = ", ".join(["%s"] * len(columns))
+    if database.DB_BACKEND == "sqlite":
+        conflict = f"ON CONFLICT ({', '.join(_key_columns(granularity))}) DO UPDATE SET " + ", ".join(
+            f"{m} = {m} + excluded.{m}" for m in _MEASURES
+        )
+    else:
+        conflict = "ON DUPLICATE KEY UPDATE " + ", ".join(f"{m} = {m} + VALUES({m})" for m in _MEASURES)
+    return f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders}) {conflict}"
+
+
+def apply(tx: database.Transaction, events: Iterable) -> None:
+    """
+    Folds a batch of UsageEvents into every rollup table. Call inside the
+    transaction that inserts the same events into usage_log.
+    """
+    events = list(events)
+    for table, granularity in ROLLUP_TABLES.items():
+        totals = defaultdict(lambda: [0, 0, 0, 0.0, 0])
+        for event in events:
+            key = (str(event.user_id), event.model_name) + (
+                (_bucket(event.timestamp, granularity),) if granularity else ()
+            )
+            # Events without a recorded cost are priced the same way the request was
+            cost = event.cost_usd if event.cost_usd is not None else calculate_cost(
+                event.model_name, event.input_tokens, event.output_tokens
+            )
+            total = totals[key]
+            total[0] += 1
+            total[1] += event.input_tokens
+            total[2] += event.output_tokens
+            total[3] += float(cost)
+            total[4] += 1 if event.cache_hit else 0
+        # Sorted so concurrent writers lock rollup rows in the same order
+        rows = [key + tuple(total) for key, total in sorted(totals.items())]
+        if rows:
+            tx.executemany(_upsert_sql(table, granularity), rows)
+
+
+def _bucket_expression(granularity: Optional[str]) -> str:
+    pattern = "%Y-%m-%d %H:00:00" if granularity == "hour" else "%Y-%m-%d 00:00:00"
+    if database.DB_BACKEND == "sqlite":
+        return f"strftime('{pattern}', timestamp)"
+    return f"DATE_FORMAT(timestamp, '{pattern}')"
+
+
+def _cost_expression() -> str:
+    # calculate_cost as SQL, for usage_log rows written before cost_usd was recorded
+    cases = " ".join(
+        f"WHEN '{model}' THEN (input_tokens * {cost['input']} + output_tokens * {cost['output']}) / 1000"
+        for model, cost in MODEL_COSTS.items()
+    )
+    default = f"(input_tokens * {DEFAULT_MODEL_COST['input']} + output_tokens * {DEFAULT_MODEL_COST['output']}) / 1000"
+    return f"COALESCE(cost_usd, CASE LOWER(model_name) {cases} ELSE {default} END)"
+
+
+def rebuild(user_id: Optional[str] = None) -> None:
+    """
+    Recomputes the rollups from usage_log, for one user or everyone, in a
+    single transaction. Hourly and daily buckets from before the oldest row
+    still in usage_log are kept, since those rows may have been archived;
+    the totals are then re-summed from the daily rollups.
+    """
+    user_clause = "user_id = %s" if user_id is not None else "1 = 1"
+    params = (str(user_id),) if user_id is not None else ()
+    with database.transaction() as tx:
+        oldest = tx.fetch_one(
+            f"SELECT timestamp AS oldest FROM usage_log WHERE {user_clause} ORDER BY timestamp LIMIT 1", params
+        )
+        if oldest is not None:
+            # Buckets are aligned to days, and archiving to months, so no bucket straddles the boundary
+            boundary = _bucket(oldest["oldest"], "day")
+            for table, granularity in ROLLUP_TABLES.items():
+                if granularity is None:
+                    continue
+                tx.execute(f"DELETE FROM {table} WHERE {user_clause} AND bucket_start >= %s", params + (boundary,))
+                tx.execute(
+                    f"""
+                    INSERT INTO {table} ({', '.join(_key_columns(granularity) + list(_MEASURES))})
+                    SELECT user_id, model_name, {_bucket_expression(granularity)},
+                        COUNT(*), SUM(input_tokens), SUM(output_tokens),
+                        SUM({_cost_expression()}),
+                        SUM(CASE WHEN cache_hit THEN 1 ELSE 0 END)
+                    FROM usage_log
+                    WHERE {user_clause} AND timestamp >= %s
+                    GROUP BY 1, 2, 3
+                    """,
+                    params + (boundary,)
+                )
+        tx.execute(f"DELETE FROM usage_rollup_total WHERE {user_clause}", params)
+        tx.execute(
+            f"""
+            INSERT INTO usage_rollup_total ({', '.join(_key_columns(None) + list(_MEASURES))})
+            SELECT user_id, model_name, {', '.join(f'SUM({m})' for m in _MEASURES)}
+            FROM usage_rollup_daily
+            WHERE {user_clause}
+            GROUP BY user_id, model_name
+            """,
+            params
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain the usage rollup tables")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    rebuild_parser = subcommands.add_parser("rebuild", help="Recompute rollups from usage_log")
+    rebuild_parser.add_argument("--user-id", help="Only rebuild this user's rollups")
+    args = parser.parse_args()
+
+    database.init_pool()
+    try:
+        if args.command == "rebuild":
+            rebuild(args.user_id)
+            print(f"Rebuilt usage rollups for {'user ' + args.user_id if args.user_id else 'all users'}")
+    finally:
+        database.close_pool()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,333 @@
+"""
+Time-partitioned usage_log storage with retention and a Parquet archive.
+
+On MySQL usage_log is RANGE-partitioned by month on `timestamp` (see
+Untitled.sql); maintain() keeps USAGE_PARTITIONS_AHEAD months of empty
+partitions ready and, once a partition is older than USAGE_RETENTION_DAYS,
+exports it to a zstd-compressed Parquet file and drops it. On SQLite the
+same month ranges are exported and deleted.
+
+Archived rows stay queryable through read_archive(); the usage rollups keep
+covering them. Run maintenance by hand with:
+
+    python -m backend.db.usage_archive maintain
+"""
+import os
+import re
+import glob
+import fcntl
+import asyncio
+import argparse
+from datetime import datetime, timedelta
+from typing import Iterator, Optional
+
+from backend.db import database
+
+# Rows older than this many days are moved to the archive; 0 keeps everything in usage_log
+USAGE_RETENTION_DAYS = int(os.getenv("USAGE_RETENTION_DAYS", "0"))
+USAGE_ARCHIVE_DIR = os.getenv("USAGE_ARCHIVE_DIR", "usage_archive")
+USAGE_PARTITIONS_AHEAD = int(os.getenv("USAGE_PARTITIONS_AHEAD", "3"))
+USAGE_MAINTENANCE_INTERVAL = float(os.getenv("USAGE_MAINTENANCE_INTERVAL", "3600"))
+
+ARCHIVE_COLUMNS = ["id", "user_id", "model_name", "input_tokens", "output_tokens", "timestamp", "cost_usd", "cache_hit"]
+_ARCHIVE_FILE = re.compile(r"usage_log-(\d{8})-\d+\.parquet$")
+
+
+def _month_start(value: datetime) -> datetime:
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _next_month(value: datetime) -> datetime:
+    return _month_start(_month_start(value) + timedelta(days=32))
+
+
+def _partition_name(upper: datetime) -> str:
+    return f"p{upper:%Y%m%d}"
+
+
+def _arrow():
+    # Only needed once retention is configured or the archive is read
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("The usage archive requires pyarrow (pip install pyarrow)")
+    return pyarrow, pyarrow.parquet
+
+
+def _mysql_partitions() -> list[tuple[str, Optional[datetime]]]:
+    # (name, exclusive upper bound or None for MAXVALUE), in order
+    rows = database.fetch_all(
+        """
+        SELECT PARTITION_NAME AS name, PARTITION_DESCRIPTION AS bound
+        FROM information_schema.PARTITIONS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'usage_log' AND PARTITION_NAME IS NOT NULL
+        ORDER BY PARTITION_ORDINAL_POSITION
+        """
+    )
+    partitions = []
+    for row in rows:
+        bound = row["bound"].strip("'")
+        partitions.append((row["name"], None if bound == "MAXVALUE" else datetime.fromisoformat(bound)))
+    return partitions
+
+
+def ensure_partitions(now: Optional[datetime] = None) -> int:
+    """
+    Splits the MAXVALUE partition so the current month and the next
+    USAGE_PARTITIONS_AHEAD months each have their own. Returns the number of
+    partitions added; a no-op on SQLite or an unpartitioned table.
+    """
+    if database.DB_BACKEND != "mysql":
+        return 0
+    partitions = _mysql_partitions()
+    if not partitions or partitions[-1][1] is not None:
+        print("usage_log is not partitioned by month with a MAXVALUE partition; skipping")
+        return 0
+    bounds = [bound for _, bound in partitions if bound is not None]
+    upper = _next_month(now or datetime.utcnow())
+    wanted = []
+    for _ in range(USAGE_PARTITIONS_AHEAD + 1):
+        if not bounds or upper > bounds[-1]:
+            wanted.append(upper)
+        upper = _next_month(upper)
+    if not wanted:
+        return 0
+    definitions = ", ".join(
+        f"PARTITION {_partition_name(bound)} VALUES LESS THAN ('{bound:%Y-%m-%d}')" for bound in wanted
+    )
+    database.execute(
+        f"ALTER TABLE usage_log REORGANIZE PARTITION {partitions[-1][0]} INTO "
+        f"({definitions}, PARTITION pmax VALUES LESS THAN (MAXVALUE))"
+    )
+    return len(wanted)
+
+
+def _expired_ranges(cutoff: datetime) -> list[tuple[Optional[str], Optional[datetime], datetime]]:
+    # (mysql partition name, inclusive lower bound, exclusive upper bound) entirely older than cutoff
+    if database.DB_BACKEND == "mysql":
+        ranges = []
+        lower = None
+        for name, upper in _mysql_partitions():
+            if upper is None or upper > cutoff:
+                break
+            ranges.append((name, lower, upper))
+            lower = upper
+        return ranges
+    # Not MIN(): sqlite would hand that back as a string rather than a DATETIME
+    row = database.fetch_one("SELECT timestamp AS oldest FROM usage_log ORDER BY timestamp LIMIT 1")
+    if row is None or row["oldest"] is None:
+        return []
+    ranges = []
+    lower = _month_start(row["oldest"])
+    while _next_month(lower) <= cutoff:
+        ranges.append((None, lower, _next_month(lower)))
+        lower = _next_month(lower)
+    return ranges
+
+
+def _archived_max_id(upper: datetime) -> int:
+    # Highest id already archived for the month ending at `upper`, from the files' column statistics
+    _, pq = _arrow()
+    column = ARCHIVE_COLUMNS.index("id")
+    max_id = 0
+    for file_upper, path in archive_files():
+        if file_upper != upper:
+            continue
+        metadata = pq.read_metadata(path)
+        for index in range(metadata.num_row_groups):
+            statistics = metadata.row_group(index).column(column).statistics
+            if statistics is not None and statistics.has_min_max:
+                max_id = max(max_id, statistics.max)
+            else:
+                ids = pq.read_table(path, columns=["id"])["id"].to_pylist()
+                max_id = max([max_id] + ids)
+                break
+    return max_id
+
+
+def _export(lower: Optional[datetime], upper: datetime, after_id: int = 0) -> tuple[int, int]:
+    """
+    Streams the rows of one range of usage_log with an id above `after_id`
+    into a new Parquet file, which only appears under its final name once
+    complete. Returns (rows, highest id).
+    """
+    pa, pq = _arrow()
+    schema = pa.schema([
+        ("id", pa.int64()),
+        ("user_id", pa.string()),
+        ("model_name", pa.string()),
+        ("input_tokens", pa.int64()),
+        ("output_tokens", pa.int64()),
+        ("timestamp", pa.timestamp("us")),
+        ("cost_usd", pa.float64()),
+        ("cache_hit", pa.bool_()),
+    ])
+    clauses = ["timestamp < %s", "id > %s"]
+    params = [upper, after_id]
+    if lower is not None:
+        clauses.append("timestamp >= %s")
+        params.append(lower)
+    os.makedirs(USAGE_ARCHIVE_DIR, exist_ok=True)
+    path = os.path.join(USAGE_ARCHIVE_DIR, f"usage_log-{upper:%Y%m%d}-{datetime.utcnow():%Y%m%d%H%M%S%f}.parquet")
+    tmp_path = path + ".tmp"
+    exported = 0
+    max_id = 0
+    with pq.ParquetWriter(tmp_path, schema, compression="zstd") as writer:
+        for batch in database.iter_batches(
+            f"SELECT {', '.join(ARCHIVE_COLUMNS)} FROM usage_log WHERE {' AND '.join(clauses)}", params
+        ):
+            columns = {column: [row[column] for row in batch] for column in ARCHIVE_COLUMNS}
+            columns["user_id"] = [str(value) for value in columns["user_id"]]
+            columns["cost_usd"] = [float(value) if value is not None else None for value in columns["cost_usd"]]
+            columns["cache_hit"] = [bool(value) for value in columns["cache_hit"]]
+            writer.write_table(pa.Table.from_pydict(columns, schema=schema))
+            exported += len(batch)
+            max_id = max(max_id, max(columns["id"]))
+    if exported:
+        with open(tmp_path, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    else:
+        os.unlink(tmp_path)
+    return exported, max_id
+
+
+def archive_expired(now: Optional[datetime] = None) -> int:
+    """
+    Moves every month that ended more than USAGE_RETENTION_DAYS ago out of
+    usage_log into the archive. Returns the number of rows moved.
+
+    Each pass exports only rows above the highest id already archived for
+    the month, so rows that arrive late, or survive a crash between export
+    and drop, are archived once rather than re-exporting the whole month.
+    """
+    if USAGE_RETENTION_DAYS <= 0:
+        return 0
+    cutoff = (now or datetime.utcnow()) - timedelta(days=USAGE_RETENTION_DAYS)
+    moved = 0
+    for name, lower, upper in _expired_ranges(cutoff):
+        archived_id = _archived_max_id(upper)
+        exported, max_id = _export(lower, upper, archived_id)
+        max_id = max(max_id, archived_id)
+        moved += exported
+        # Only what was exported is removed: ids only grow, so rows that
+        # arrived late (e.g. replayed from the spool) have a higher one
+        if name is not None:
+            late = database.fetch_one(f"SELECT COUNT(*) AS n FROM usage_log PARTITION ({name}) WHERE id > %s", (max_id,))
+            if late["n"] == 0:
+                database.execute(f"ALTER TABLE usage_log DROP PARTITION {name}")
+        else:
+            database.execute("DELETE FROM usage_log WHERE timestamp >= %s AND timestamp < %s AND id <= %s",
+                             (lower, upper, max_id))
+    return moved
+
+
+def archive_files() -> list[tuple[datetime, str]]:
+    # (exclusive upper bound of the rows it holds, path), newest first
+    files = []
+    for path in glob.glob(os.path.join(USAGE_ARCHIVE_DIR, "usage_log-*.parquet")):
+        match = _ARCHIVE_FILE.search(path)
+        if match:
+            files.append((datetime.strptime(match.group(1), "%Y%m%d"), path))
+    return sorted(files, reverse=True)
+
+
+def archived_before() -> Optional[datetime]:
+    """
+    Rows older than this may live in the archive; None if nothing is archived.
+    """
+    files = archive_files()
+    return files[0][0] if files else None
+
+
+def read_archive(user_id: int, since: Optional[datetime] = None, until: Optional[datetime] = None,
+                 model: Optional[str] = None, before: Optional[tuple[datetime, int]] = None) -> Iterator[dict]:
+    """
+    Yields a user's archived rows newest first, with the same filters as
+    /usage: since (inclusive), until (exclusive), model, and `before`, a
+    (timestamp, id) keyset position. Each file is read with those filters
+    pushed down, so only the user's matching rows are loaded.
+    """
+    files = archive_files()
+    if not files:
+        return
+    pa, pq = _arrow()
+    import pyarrow.compute as pc
+
+    condition = pc.field("user_id") == str(user_id)
+    if since is not None:
+        condition &= pc.field("timestamp") >= pa.scalar(since, pa.timestamp("us"))
+    if until is not None:
+        condition &= pc.field("timestamp") < pa.scalar(until, pa.timestamp("us"))
+    if model is not None:
+        condition &= pc.field("model_name") == model
+    if before is not None:
+        timestamp = pa.scalar(before[0], pa.timestamp("us"))
+        condition &= (pc.field("timestamp") < timestamp) | (
+            (pc.field("timestamp") == timestamp) & (pc.field("id") < before[1])
+        )
+
+    seen = set()
+    for upper, path in files:
+        if since is not None and upper <= since:
+            break
+        table = pq.read_table(path, columns=ARCHIVE_COLUMNS, filters=condition)
+        table = table.sort_by([("timestamp", "descending"), ("id", "descending")])
+        for row in table.to_pylist():
+            if row["id"] in seen:
+                continue
+            seen.add(row["id"])
+            yield row
+
+
+def maintain(now: Optional[datetime] = None) -> dict:
+    """
+    One maintenance pass. Only one process per host runs it at a time; the
+    others return immediately.
+    """
+    os.makedirs(USAGE_ARCHIVE_DIR, exist_ok=True)
+    with open(os.path.join(USAGE_ARCHIVE_DIR, ".maintenance.lock"), "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return {"skipped": True}
+        return {
+            "partitions_added": ensure_partitions(now),
+            "rows_archived": archive_expired(now),
+        }
+
+
+def maintenance_enabled() -> bool:
+    # Partitions need managing on MySQL; SQLite only has work to do once retention is set
+    return database.DB_BACKEND == "mysql" or USAGE_RETENTION_DAYS > 0
+
+
+async def maintenance_loop():
+    while True:
+        try:
+            result = await database.run(maintain)
+            if result.get("partitions_added") or result.get("rows_archived"):
+                print(f"Usage maintenance: {result}")
+        except Exception as e:
+            # Never let the loop die; the next pass retries
+            print(f"Usage maintenance error: {e}")
+        await asyncio.sleep(USAGE_MAINTENANCE_INTERVAL)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage usage_log partitions and the usage archive")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    subcommands.add_parser("maintain", help="Add upcoming partitions and archive expired ones")
+    args = parser.parse_args()
+
+    database.init_pool()
+    try:
+        if args.command == "maintain":
+            print(maintain())
+    finally:
+        database.close_pool()
+
+
+if __name__ == "__main__":
+    main()
@@ -4,9 +4,6 @@ from typing import Optional
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import HTTPException, status
-from dotenv import load_dotenv
-
-load_dotenv()
 
 # JWT config
 SECRET_KEY = os.getenv("SECRET_KEY", "CHANGE_THIS_TO_SOMETHING_SECURE")
@@ -1,39 +1,48 @@
 import os
-from datetime import datetime, timedelta
-from typing import Optional
+import io
+import math
+import time
+import csv
+import json
+import base64
+import asyncio
+import binascii
+import itertools
+from contextlib import aclosing
+from datetime import datetime, timedelta, timezone
+from typing import Literal, Optional
 
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Query, status
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jose import JWTError, jwt
-from passlib.context import CryptContext
-from pydantic import BaseModel, EmailStr
-import mysql.connector
-from dotenv import load_dotenv
+from pydantic import BaseModel, EmailStr, Field
 from fastapi.middleware.cors import CORSMiddleware # <--- ADD THIS IMPORT
 
-# Load env variables
-load_dotenv()
-
-# DB config
-DB_HOST = os.getenv("DB_HOST", "localhost")
-DB_USER = os.getenv("DB_USER", "root")
-DB_PASSWORD = os.getenv("DB_PASSWORD", "")
-DB_NAME = os.getenv("DB_NAME", "ai_gateway")
+from backend.db import database, usage_archive
+from backend.services.usage_writer import usage_writer, UsageEvent
+from backend.services.token_cache import token_cache
+from backend.services.pricing import calculate_cost
+from backend.services.providers import registry
+from backend.services.password_hasher import password_hasher
+from backend.services import metrics, tracing
 
 # JWT config
 SECRET_KEY = os.getenv("SECRET_KEY", "CHANGE_THIS_TO_SOMETHING_SECURE")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-# Models cost - adjust as needed
-MODEL_COSTS = {
-    "gpt-4": {"input": 0.03, "output": 0.06},
-    "gpt-3.5-turbo": {"input": 0.0015, "output": 0.002},
-    "claude-3-opus-20240229": {"input": 0.008, "output": 0.024}
-}
+# Comma-separated usernames allowed to see cross-user analytics
+ADMIN_USERNAMES = {name.strip() for name in os.getenv("ADMIN_USERNAMES", "").split(",") if name.strip()}
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# /generate/batch limits: items per request, and items of one batch in flight per provider
+GENERATE_BATCH_MAX_ITEMS = int(os.getenv("GENERATE_BATCH_MAX_ITEMS", "1000"))
+GENERATE_BATCH_CONCURRENCY = int(os.getenv("GENERATE_BATCH_CONCURRENCY", "8"))
+# How long a batch item may wait out the caller's rate limit before failing with 429
+GENERATE_BATCH_RATE_LIMIT_WAIT = float(os.getenv("GENERATE_BATCH_RATE_LIMIT_WAIT", "60"))
+# Largest max_tokens a request may ask for; it is charged up front against token limits and budgets
+GENERATE_MAX_TOKENS = int(os.getenv("GENERATE_MAX_TOKENS", "32768"))
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
@@ -49,6 +58,13 @@ app.add_middleware(
 )
 # <--- END CORS MIDDLEWARE BLOCK ---
 
+if tracing.TRACING_ENABLED:
+    app.add_middleware(tracing.TracingMiddleware)
+
+if metrics.METRICS_ENABLED:
+    # Added last so it is outermost and times the whole request, CORS included
+    app.add_middleware(metrics.MetricsMiddleware)
+
 # Pydantic models
 class User(BaseModel):
     id: int
@@ -70,57 +86,82 @@ class Token(BaseModel):
 class RequestPayload(BaseModel):
     prompt: str
     model_name: str
+    max_tokens: int = Field(100, gt=0, le=GENERATE_MAX_TOKENS)
+    temperature: float = 0.7
+    # "use" the response cache, "bypass" it entirely, or "refresh" the cached entry
+    cache: Literal["use", "bypass", "refresh"] = "use"
+    # Batch work queues behind interactive requests for a provider slot
+    priority: Literal["interactive", "batch"] = "interactive"
+    # Seconds the whole request may take, GENERATE_DEADLINE by default
+    timeout: Optional[float] = Field(None, gt=0)
 
-# DB helper
-def get_connection():
-    return mysql.connector.connect(
-        host=DB_HOST,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        database=DB_NAME,
-        auth_plugin='mysql_native_password'
-    )
+class BatchItem(BaseModel):
+    prompt: str
+    model_name: str
+    max_tokens: int = Field(100, gt=0, le=GENERATE_MAX_TOKENS)
+    temperature: float = 0.7
+
+class BatchPayload(BaseModel):
+    items: list[BatchItem]
+    cache: Literal["use", "bypass", "refresh"] = "use"
+    priority: Literal["interactive", "batch"] = "batch"
+    # Stream NDJSON results as items finish instead of one JSON body in item order
+    stream: bool = False
+    # Per item, counted from when the item starts
+    timeout: Optional[float] = Field(None, gt=0)
+
+class EstimatePayload(BaseModel):
+    prompt: str
+    model_name: str
+    max_tokens: int = Field(100, gt=0, le=GENERATE_MAX_TOKENS)
+
+class SessionCreate(BaseModel):
+    model_name: str
+    system: Optional[str] = None
+
+class SessionMessage(BaseModel):
+    content: str
+    max_tokens: int = Field(100, gt=0, le=GENERATE_MAX_TOKENS)
+    temperature: float = 0.7
+    priority: Literal["interactive", "batch"] = "interactive"
+    timeout: Optional[float] = Field(None, gt=0)
 
 # User functions
 def get_user_by_username(username: str) -> Optional[UserInDB]:
-    conn = get_connection()
-    cursor = conn.cursor(dictionary=True)
-    try:
-        cursor.execute("SELECT * FROM users WHERE username = %s", (username,))
-        row = cursor.fetchone()
-        if row:
-            return UserInDB(**row)
-        return None
-    finally:
-        cursor.close()
-        conn.close()
+    with metrics.db_seconds.timer(("get_user_by_username",)), tracing.span("db.get_user_by_username"):
+        row = database.fetch_one("SELECT * FROM users WHERE username = %s", (username,))
+    if row:
+        return UserInDB(**row)
+    return None
 
-def create_user(username: str, email: str, password: str):
-    hashed = pwd_context.hash(password)
-    conn = get_connection()
-    cursor = conn.cursor()
+async def create_user(username: str, email: str, password: str):
+    hashed = await password_hasher.hash(password)
     try:
-        cursor.execute(
+        await database.run(
+            database.execute,
             "INSERT INTO users (username, email, hashed_password) VALUES (%s, %s, %s)",
             (username, email, hashed)
         )
-        conn.commit()
-    except mysql.connector.Error as e:
-        # More informative error on duplicate username or email
+    except database.IntegrityError:
+        # More informative error on duplicate username or email; any other DB error is a 5xx
         raise HTTPException(status_code=400, detail="Username or Email already exists")
-    finally:
-        cursor.close()
-        conn.close()
-
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    token_cache.invalidate_user(username)
 
-def authenticate_user(username: str, password: str) -> Optional[UserInDB]:
-    user = get_user_by_username(username)
+async def authenticate_user(username: str, password: str) -> Optional[UserInDB]:
+    user = await database.run(get_user_by_username, username)
     if not user:
         return None
-    if not verify_password(password, user.hashed_password):
+    verified, new_hash = await password_hasher.verify_and_update(password, user.hashed_password)
+    if not verified:
         return None
+    if new_hash is not None:
+        # Stored with an older scheme or lower cost: upgrade it now that the password is known
+        await database.run(
+            database.execute,
+            "UPDATE users SET hashed_password = %s WHERE id = %s AND hashed_password = %s",
+            (new_hash, user.id, user.hashed_password)
+        )
+        password_hasher.rehashed += 1
     return user
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
@@ -136,93 +177,778 @@ async def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
+    with tracing.span("auth.get_current_user") as auth_span:
+        cached = token_cache.get(token)
+        if auth_span is not None:
+            auth_span.set(token_cache_hit=cached is not None)
+        if cached is not None:
+            return cached[1]
+        try:
+            with metrics.jwt_decode_seconds.timer(), tracing.span("auth.jwt_decode"):
+                payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            username: str = payload.get("sub")
+            if username is None:
+                raise credentials_exception
+        except JWTError:
+            raise credentials_exception
+        user = await database.run(get_user_by_username, username)
+        if user is None:
             raise credentials_exception
-    except JWTError:
-        raise credentials_exception
-    user = get_user_by_username(username)
-    if user is None:
-        raise credentials_exception
-    return User(id=user.id, username=user.username, email=user.email)
+        current_user = User(id=user.id, username=user.username, email=user.email)
+        token_cache.put(token, payload, current_user)
+        return current_user
+
+async def get_admin_user(current_user: User = Depends(get_current_user)) -> User:
+    if current_user.username not in ADMIN_USERNAMES:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required")
+    return current_user
 
 # Usage logging
-def log_usage(user_id: int, model_name: str, input_tokens: int, output_tokens: int):
-    conn = None
-    cursor = None
-    try:
-        conn = get_connection()
-        cursor = conn.cursor()
-        query = """
-            INSERT INTO usage_log (user_id, model_name, input_tokens, output_tokens, timestamp)
-            VALUES (%s, %s, %s, %s, %s)
-        """
-        cursor.execute(query, (user_id, model_name, input_tokens, output_tokens, datetime.utcnow()))
-        conn.commit()
-    except mysql.connector.Error as e:
-        print("DB log usage error:", e)
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
+def log_usage(user_id: int, model_name: str, input_tokens: int, output_tokens: int,
+              cost_usd: Optional[float] = None, cache_hit: bool = False):
+    # Spooled and written to usage_log in batches by the background writer
+    event = UsageEvent(user_id, model_name, input_tokens, output_tokens, cost_usd=cost_usd, cache_hit=cache_hit)
+    with metrics.db_seconds.timer(("log_usage",)), tracing.span("log_usage"):
+        usage_writer.record(event)
+    _count_usage([event])
 
-def calculate_cost(model_name: str, input_tokens: int, output_tokens: int) -> float:
-    model_cost = MODEL_COSTS.get(model_name.lower(), {"input": 0.001, "output": 0.002})
-    cost = ((input_tokens / 1000) * model_cost["input"]) + ((output_tokens / 1000) * model_cost["output"])
-    return round(cost, 6)
+def _count_usage(events: list[UsageEvent]):
+    # Cache hits and coalesced requests cost nothing upstream, so only billed usage is counted
+    for event in events:
+        if event.cache_hit:
+            continue
+        model = registry.metric_label(event.model_name)
+        metrics.tokens_total.inc((model, "input"), event.input_tokens)
+        metrics.tokens_total.inc((model, "output"), event.output_tokens)
+        cost = event.cost_usd
+        if cost is None:
+            cost = calculate_cost(event.model_name, event.input_tokens, event.output_tokens)
+        metrics.cost_usd_total.inc((model,), cost)
 
 # Import your existing model router logic
-from backend.services.model_router import route_model
+from backend.services.model_router import route_model, route_model_stream, warm_up_providers, router, provider_for
+from backend.services import http_clients
+from backend.services.response_cache import response_cache, make_cache_key, RESPONSE_CACHE_ENABLED
+from backend.services.similarity_cache import similarity_cache
+from backend.services.singleflight import singleflight, COALESCE_ENABLED
+from backend.services.scheduler import scheduler, Overloaded
+from backend.services.rate_limiter import rate_limiter, RateLimited
+from backend.services.resilience import Deadline, DeadlineExceeded, ProviderError
+from backend.services.analytics import analytics_cache
+from backend.services.usage_events import usage_broker
+from backend.services.sessions import session_store
+from backend.services import tokenizer
 
 # Import the new dashboard router
-from backend.routers import dashboard_router
+from backend.routers import dashboard_router, analytics_router, admin_router
+
+# Lifecycle
+@app.on_event("startup")
+async def startup():
+    await database.run(database.init_pool)
+    password_hasher.start()
+    await usage_writer.start()
+    session_store.start()
+    tracing.trace_exporter.start()
+    tracing.stack_sampler.start()
+    if usage_archive.maintenance_enabled():
+        app.state.usage_maintenance = asyncio.create_task(usage_archive.maintenance_loop())
+    # Provider SDKs are imported and connected in the background; requests that arrive first load them on demand
+    app.state.provider_warm_up = asyncio.create_task(warm_up_providers())
+    # Local tokenizers load on their own threads; prompts are counted approximately until they are ready
+    tokenizer.warm_up()
+
+@app.on_event("shutdown")
+async def shutdown():
+    maintenance = getattr(app.state, "usage_maintenance", None)
+    if maintenance is not None:
+        maintenance.cancel()
+    app.state.provider_warm_up.cancel()
+    await tracing.stack_sampler.stop()
+    await tracing.slow_requests.flush()
+    # Before the HTTP clients close: the last traces may go to a collector
+    await tracing.trace_exporter.stop()
+    await http_clients.close_all()
+    await usage_writer.stop()
+    database.close_pool()
+    response_cache.close()
+    session_store.close()
+    password_hasher.stop()
 
 # Routes
 @app.post("/register", summary="Register a new user")
-def register(user: UserCreate):
-    create_user(user.username, user.email, user.password)
+async def register(user: UserCreate):
+    try:
+        await create_user(user.username, user.email, user.password)
+    except Overloaded as oe:
+        raise _too_many_requests(oe)
+    except database.PoolTimeout as pt:
+        raise HTTPException(status_code=503, detail=str(pt))
     return {"msg": "User registered successfully"}
 
 @app.post("/token", response_model=Token, summary="Get JWT token")
-def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
-    user = authenticate_user(form_data.username, form_data.password)
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
+    try:
+        user = await authenticate_user(form_data.username, form_data.password)
+    except Overloaded as oe:
+        raise _too_many_requests(oe)
     if not user:
         raise HTTPException(status_code=400, detail="Incorrect username or password")
     access_token = create_access_token(data={"sub": user.username})
     return {"access_token": access_token, "token_type": "bearer"}
 
+def _request_keys(payload: RequestPayload) -> tuple[str, Optional[str]]:
+    # (coalescing key, response-cache key or None when the cache is not used)
+    request_key = make_cache_key(payload.model_name, payload.prompt,
+                                 max_tokens=payload.max_tokens, temperature=payload.temperature)
+    if not RESPONSE_CACHE_ENABLED or payload.cache == "bypass":
+        return request_key, None
+    return request_key, request_key
+
+def _fingerprint(payload: RequestPayload):
+    # Near-duplicate cache fingerprint, or None when that cache is not used for this request
+    if payload.cache == "bypass" or not similarity_cache.enabled_for(payload.model_name):
+        return None
+    return similarity_cache.fingerprint(payload.model_name, payload.prompt,
+                                        max_tokens=payload.max_tokens, temperature=payload.temperature)
+
+async def _generate(payload: RequestPayload, user_id: int, log=log_usage, requests: int = 1) -> dict:
+    # One non-streaming generation; `log` takes log_usage's arguments. Batch items pass requests=0:
+    # the batch was charged against the request-rate buckets once
+    request_key, cache_key = _request_keys(payload)
+    if cache_key is not None and payload.cache == "use":
+        with tracing.span("response_cache.get") as cache_span:
+            cached = await response_cache.get(cache_key)
+            if cache_span is not None:
+                cache_span.set(hit=cached is not None)
+        if cached is not None:
+            content, input_tokens, output_tokens = cached
+            log(user_id, payload.model_name, input_tokens, output_tokens, cost_usd=0.0, cache_hit=True)
+            return {
+                "response": content.strip(),
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+                "estimated_cost_usd": 0.0,
+                "cached": True,
+                "coalesced": False
+            }
+    fingerprint = _fingerprint(payload)
+    if fingerprint is not None and payload.cache == "use":
+        with tracing.span("similarity_cache.get") as cache_span:
+            similar = similarity_cache.get(fingerprint)
+            if cache_span is not None:
+                cache_span.set(hit=similar is not None)
+        if similar is not None:
+            (content, input_tokens, output_tokens), similarity = similar
+            log(user_id, payload.model_name, input_tokens, output_tokens, cost_usd=0.0, cache_hit=True)
+            return {
+                "response": content.strip(),
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+                "estimated_cost_usd": 0.0,
+                "cached": True,
+                "similarity": round(similarity, 4),
+                "coalesced": False
+            }
+
+    # Enforced only for requests that may reach upstream; cache hits are free
+    with tracing.span("rate_limiter.reserve"):
+        reservation = await rate_limiter.reserve(user_id, payload.model_name, payload.prompt, payload.max_tokens,
+                                                 requests)
+    deadline = Deadline.after(payload.timeout)
+
+    async def fetch():
+        # Bills the caller that triggered the upstream call, even if it disconnects
+        completion = await route_model(
+            payload.model_name, payload.prompt, payload.max_tokens, payload.temperature, payload.priority, deadline
+        )
+        # Billed against the model that actually served it, which may be a fallback
+        cost = calculate_cost(completion.model_name, completion.input_tokens, completion.output_tokens,
+                              completion.cached_input_tokens)
+        log(user_id, completion.model_name, completion.input_tokens, completion.output_tokens, cost_usd=cost)
+        await rate_limiter.settle(reservation, completion.input_tokens, completion.output_tokens, cost)
+        if cache_key is not None and completion.output_tokens > 0:
+            await response_cache.set(cache_key, completion[:3])
+        if fingerprint is not None and completion.output_tokens > 0:
+            similarity_cache.set(fingerprint, completion[:3])
+        return completion, cost
+
+    try:
+        with tracing.span("generate", model=payload.model_name) as generate_span:
+            if COALESCE_ENABLED:
+                (completion, cost), shared = await singleflight.do(request_key, fetch)
+            else:
+                (completion, cost), shared = await fetch(), False
+            if generate_span is not None:
+                generate_span.set(served_model=completion.model_name, coalesced=shared,
+                                  input_tokens=completion.input_tokens, output_tokens=completion.output_tokens)
+    except Exception:
+        await rate_limiter.settle(reservation)
+        raise
+    content, input_tokens, output_tokens, served_model, _ = completion
+    if shared:
+        await rate_limiter.settle(reservation)
+        # Rode along on another caller's upstream call: logged like a cache hit
+        cost = 0.0
+        log(user_id, served_model, input_tokens, output_tokens, cost_usd=0.0, cache_hit=True)
+    return {
+        "response": content.strip(),
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "estimated_cost_usd": cost,
+        "model": served_model,
+        "cached": False,
+        "coalesced": shared
+    }
+
 @app.post("/generate", summary="Generate text (auth required)")
 async def generate(payload: RequestPayload, current_user: User = Depends(get_current_user)):
     try:
-        content, input_tokens, output_tokens = route_model(payload.model_name, payload.prompt)
-        log_usage(current_user.id, payload.model_name, input_tokens, output_tokens)
-        cost = calculate_cost(payload.model_name, input_tokens, output_tokens)
-        return {
-            "response": content.strip(),
-            "input_tokens": input_tokens,
-            "output_tokens": output_tokens,
-            "estimated_cost_usd": cost
-        }
+        return await _generate(payload, current_user.id)
     except ValueError as ve:
         raise HTTPException(status_code=400, detail=str(ve))
+    except (Overloaded, RateLimited) as oe:
+        raise _too_many_requests(oe)
+    except (ProviderError, DeadlineExceeded) as ue:
+        raise _upstream_error(ue)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Unexpected error: {e}")
 
-@app.get("/usage", summary="Get usage logs for current user")
-def get_usage(current_user: User = Depends(get_current_user)):
-    conn = get_connection()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute(
-        "SELECT model_name, input_tokens, output_tokens, timestamp FROM usage_log WHERE user_id = %s ORDER BY timestamp DESC",
-        (current_user.id,)
+class _BatchUsage:
+    """
+    Collects a batch's usage so it is spooled as one write when the batch
+    ends. Items still finishing after that (e.g. a coalesced upstream call
+    outliving a disconnect) are logged one by one.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.closed = False
+
+    def log(self, user_id: int, model_name: str, input_tokens: int, output_tokens: int,
+            cost_usd: Optional[float] = None, cache_hit: bool = False):
+        if self.closed:
+            log_usage(user_id, model_name, input_tokens, output_tokens, cost_usd=cost_usd, cache_hit=cache_hit)
+        else:
+            self.events.append(UsageEvent(user_id, model_name, input_tokens, output_tokens,
+                                          cost_usd=cost_usd, cache_hit=cache_hit))
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            with metrics.db_seconds.timer(("log_usage",)):
+                usage_writer.record_many(self.events)
+            _count_usage(self.events)
+
+def _item_error(error: Exception) -> dict:
+    # The status /generate would have answered with
+    if isinstance(error, ValueError):
+        return {"status": 400, "detail": str(error)}
+    if isinstance(error, (Overloaded, RateLimited)):
+        return {"status": 429, "detail": str(error), "retry_after": error.retry_after}
+    if isinstance(error, (ProviderError, DeadlineExceeded)):
+        http_error = _upstream_error(error)
+        return {"status": http_error.status_code, "detail": http_error.detail,
+                **({"retry_after": int(http_error.headers["Retry-After"])} if http_error.headers else {})}
+    return {"status": 500, "detail": f"Unexpected error: {error}"}
+
+async def _batch_item(index: int, item: BatchItem, payload: BatchPayload, user_id: int, limits: dict,
+                      usage: _BatchUsage) -> dict:
+    request = RequestPayload(prompt=item.prompt, model_name=item.model_name, max_tokens=item.max_tokens,
+                             temperature=item.temperature, cache=payload.cache, priority=payload.priority,
+                             timeout=payload.timeout)
+    deadline = time.monotonic() + GENERATE_BATCH_RATE_LIMIT_WAIT
+    try:
+        limit = limits.setdefault(provider_for(item.model_name), asyncio.Semaphore(GENERATE_BATCH_CONCURRENCY))
+        while True:
+            try:
+                async with limit:
+                    result = await _generate(request, user_id, log=usage.log, requests=0)
+                return {"index": index, **result}
+            except RateLimited as e:
+                # A batch is expected to outrun the per-user token rate: pace it rather than fail, within limits
+                if time.monotonic() + e.retry_after > deadline:
+                    raise
+                await asyncio.sleep(e.retry_after)
+    except Exception as e:
+        return {"index": index, "error": _item_error(e)}
+
+def _batch_totals(results: list[dict]) -> dict:
+    succeeded = [result for result in results if "error" not in result]
+    return {
+        "items": len(results),
+        "succeeded": len(succeeded),
+        "failed": len(results) - len(succeeded),
+        "input_tokens": sum(result["input_tokens"] for result in succeeded),
+        "output_tokens": sum(result["output_tokens"] for result in succeeded),
+        "estimated_cost_usd": round(sum(result["estimated_cost_usd"] for result in succeeded), 6),
+    }
+
+async def _batch_lines(tasks: list, usage: _BatchUsage):
+    results = []
+    try:
+        for next_result in asyncio.as_completed(tasks):
+            result = await next_result
+            results.append(result)
+            yield json.dumps(result) + "\n"
+        usage.close()
+        yield json.dumps({"usage": _batch_totals(results)}) + "\n"
+    finally:
+        for task in tasks:
+            task.cancel()
+        usage.close()
+
+@app.post("/generate/batch", summary="Generate text for many prompts in one request (auth required)")
+async def generate_batch(payload: BatchPayload, current_user: User = Depends(get_current_user)):
+    if not payload.items:
+        raise HTTPException(status_code=400, detail="No items")
+    if len(payload.items) > GENERATE_BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {GENERATE_BATCH_MAX_ITEMS} items per batch")
+    # One request against the request-rate limits for the whole batch; items are paced by tokens and budget
+    try:
+        await rate_limiter.reserve_requests(current_user.id, {item.model_name for item in payload.items})
+    except RateLimited as rl:
+        raise _too_many_requests(rl)
+    usage = _BatchUsage()
+    limits = {}
+    tasks = [
+        asyncio.create_task(_batch_item(index, item, payload, current_user.id, limits, usage))
+        for index, item in enumerate(payload.items)
+    ]
+    if payload.stream:
+        return StreamingResponse(_batch_lines(tasks, usage), media_type="application/x-ndjson")
+    try:
+        results = await asyncio.gather(*tasks)
+    finally:
+        # All of the batch's usage in one spool write and one flush
+        usage.close()
+    return {"results": results, "usage": _batch_totals(results)}
+
+def _too_many_requests(error: Exception) -> HTTPException:
+    # Overloaded and RateLimited both carry a Retry-After hint in seconds
+    return HTTPException(status_code=429, detail=str(error), headers={"Retry-After": str(error.retry_after)})
+
+def _upstream_error(error: Exception) -> HTTPException:
+    # 504 when the request ran out of time, 502 when the provider failed; Retry-After if it gave one
+    if isinstance(error, DeadlineExceeded):
+        return HTTPException(status_code=504, detail=str(error))
+    headers = {"Retry-After": str(math.ceil(error.retry_after))} if error.retry_after is not None else None
+    return HTTPException(status_code=502, detail=str(error), headers=headers)
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def _cached_stream_events(cached: tuple, user_id: int, model_name: str, similarity: Optional[float] = None):
+    content, input_tokens, output_tokens = cached
+    log_usage(user_id, model_name, input_tokens, output_tokens, cost_usd=0.0, cache_hit=True)
+    yield _sse("delta", {"text": content})
+    yield _sse("usage", {
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "estimated_cost_usd": 0.0,
+        "cached": True,
+        **({"similarity": round(similarity, 4)} if similarity is not None else {}),
+        "coalesced": False
+    })
+
+async def _metered_stream(chunks, user_id: int, model_name: str, cache_key: Optional[str] = None,
+                          reservation=None, fingerprint=None, prompt: Optional[str] = None):
+    # Wraps the upstream stream: bills the caller that started it and fills the cache
+    input_tokens = 0
+    output_tokens = 0
+    parts = []
+    try:
+        async with aclosing(chunks):
+            async for text, chunk_input_tokens, chunk_output_tokens in chunks:
+                input_tokens = max(input_tokens, chunk_input_tokens)
+                output_tokens = max(output_tokens, chunk_output_tokens)
+                if text:
+                    parts.append(text)
+                yield text, chunk_input_tokens, chunk_output_tokens
+        if output_tokens > 0:
+            if cache_key is not None:
+                await response_cache.set(cache_key, ("".join(parts), input_tokens, output_tokens))
+            if fingerprint is not None:
+                similarity_cache.set(fingerprint, ("".join(parts), input_tokens, output_tokens))
+    finally:
+        # Runs once the stream is done, including when it is abandoned
+        if parts and not output_tokens and prompt is not None:
+            # Ended before upstream reported usage, e.g. the client left: bill the local count
+            input_tokens = input_tokens or tokenizer.count_prompt(model_name, prompt)
+            output_tokens = tokenizer.count_text(model_name, "".join(parts))
+        cost = calculate_cost(model_name, input_tokens, output_tokens)
+        if input_tokens or output_tokens:
+            log_usage(user_id, model_name, input_tokens, output_tokens, cost_usd=cost)
+        if reservation is not None:
+            await rate_limiter.settle(reservation, input_tokens, output_tokens, cost)
+
+async def _stream_events(chunks, user_id: int, model_name: str, shared: bool = False, reservation=None):
+    input_tokens = 0
+    output_tokens = 0
+    try:
+        async with aclosing(chunks):
+            async for text, chunk_input_tokens, chunk_output_tokens in chunks:
+                input_tokens = max(input_tokens, chunk_input_tokens)
+                output_tokens = max(output_tokens, chunk_output_tokens)
+                if text:
+                    yield _sse("delta", {"text": text})
+        yield _sse("usage", {
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "estimated_cost_usd": 0.0 if shared else calculate_cost(model_name, input_tokens, output_tokens),
+            "model": model_name,
+            "cached": False,
+            "coalesced": shared
+        })
+    except Exception as e:
+        yield _sse("error", {"detail": f"Unexpected error: {e}"})
+    finally:
+        if shared and (input_tokens or output_tokens):
+            log_usage(user_id, model_name, input_tokens, output_tokens, cost_usd=0.0, cache_hit=True)
+        if shared and reservation is not None:
+            await rate_limiter.settle(reservation)
+
+async def _primed(chunks):
+    # Waits for the first chunk before the response starts, so a request that
+    # cannot get a provider slot, or whose provider fails before answering, is
+    # answered with a 429/502/504 rather than an SSE error
+    error = None
+    first = None
+    try:
+        first = await anext(chunks, None)
+    except (Overloaded, ProviderError, DeadlineExceeded):
+        raise
+    except Exception as e:
+        error = e
+
+    async def replay():
+        async with aclosing(chunks):
+            if error is not None:
+                raise error
+            if first is not None:
+                yield first
+            async for chunk in chunks:
+                yield chunk
+    return replay()
+
+@app.post("/generate/stream", summary="Stream generated text as server-sent events (auth required)")
+async def generate_stream(payload: RequestPayload, current_user: User = Depends(get_current_user)):
+    sse_headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    request_key, cache_key = _request_keys(payload)
+    if cache_key is not None and payload.cache == "use":
+        cached = await response_cache.get(cache_key)
+        if cached is not None:
+            return StreamingResponse(
+                _cached_stream_events(cached, current_user.id, payload.model_name),
+                media_type="text/event-stream",
+                headers=sse_headers
+            )
+    fingerprint = _fingerprint(payload)
+    if fingerprint is not None and payload.cache == "use":
+        similar = similarity_cache.get(fingerprint)
+        if similar is not None:
+            return StreamingResponse(
+                _cached_stream_events(similar[0], current_user.id, payload.model_name, similar[1]),
+                media_type="text/event-stream",
+                headers=sse_headers
+            )
+
+    try:
+        reservation = await rate_limiter.reserve(current_user.id, payload.model_name, payload.prompt,
+                                                 payload.max_tokens)
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    except RateLimited as rl:
+        raise _too_many_requests(rl)
+
+    def open_stream():
+        served_model, chunks = route_model_stream(
+            payload.model_name, payload.prompt, payload.max_tokens, payload.temperature, payload.priority,
+            Deadline.after(payload.timeout)
+        )
+        return served_model, _metered_stream(chunks, current_user.id, served_model, cache_key, reservation,
+                                             fingerprint, payload.prompt)
+
+    try:
+        if COALESCE_ENABLED:
+            served_model, chunks, shared = singleflight.stream(request_key, open_stream)
+        else:
+            (served_model, chunks), shared = open_stream(), False
+        chunks = await _primed(chunks)
+    except ValueError as ve:
+        await rate_limiter.settle(reservation)
+        raise HTTPException(status_code=400, detail=str(ve))
+    except Overloaded as oe:
+        await rate_limiter.settle(reservation)
+        raise _too_many_requests(oe)
+    except (ProviderError, DeadlineExceeded) as ue:
+        await rate_limiter.settle(reservation)
+        raise _upstream_error(ue)
+    return StreamingResponse(
+        _stream_events(chunks, current_user.id, served_model, shared, reservation),
+        media_type="text/event-stream",
+        headers=sse_headers
     )
-    rows = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    return {"usage": rows}
+
+USAGE_COLUMNS = ["id", "model_name", "input_tokens", "output_tokens", "timestamp", "cost_usd", "cache_hit"]
+
+@app.post("/estimate", summary="Estimate a request's tokens and worst-case cost without sending it (auth required)")
+async def estimate(payload: EstimatePayload, current_user: User = Depends(get_current_user)):
+    try:
+        result = tokenizer.estimate(payload.model_name, payload.prompt, payload.max_tokens)
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    rejection = result.rejection()
+    return {
+        "model": result.model_name,
+        "provider": result.provider,
+        "encoding": result.encoding,
+        "input_tokens": result.input_tokens,
+        "max_output_tokens": result.max_output_tokens,
+        "context_window": result.context_window,
+        "input_cost_usd": result.input_cost_usd,
+        "worst_case_cost_usd": result.max_cost_usd,
+        "accepted": rejection is None,
+        "rejection": rejection
+    }
+
+def _session_info(session) -> dict:
+    return {
+        "session_id": session.session_id,
+        "model_name": session.model_name,
+        "system": session.system,
+        "turns": session.turns,
+        "input_tokens": session.input_tokens,
+        "output_tokens": session.output_tokens,
+        "cached_input_tokens": session.cached_input_tokens,
+        "estimated_cost_usd": session.cost_usd,
+        "created_at": session.created_at,
+        "updated_at": session.updated_at,
+    }
+
+async def _user_session(session_id: str, user_id: int):
+    session = await session_store.get(session_id, user_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return session
+
+@app.post("/sessions", summary="Start a conversation kept by the gateway (auth required)")
+async def create_session(payload: SessionCreate, current_user: User = Depends(get_current_user)):
+    try:
+        provider_for(payload.model_name)
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+    session = await session_store.create(current_user.id, payload.model_name, payload.system)
+    return _session_info(session)
+
+@app.get("/sessions/{session_id}", summary="Get a conversation and its history (auth required)")
+async def get_session(session_id: str, current_user: User = Depends(get_current_user)):
+    session = await _user_session(session_id, current_user.id)
+    return {**_session_info(session), "messages": session.messages}
+
+@app.delete("/sessions/{session_id}", summary="End a conversation (auth required)")
+async def delete_session(session_id: str, current_user: User = Depends(get_current_user)):
+    await _user_session(session_id, current_user.id)
+    await session_store.delete(session_id)
+    return {"msg": "Session deleted"}
+
+@app.post("/sessions/{session_id}/messages", summary="Send the next turn of a conversation (auth required)")
+async def send_session_message(session_id: str, message: SessionMessage,
+                               current_user: User = Depends(get_current_user)):
+    # Checked before locking, so unknown ids never get a lock entry
+    await _user_session(session_id, current_user.id)
+    # Turns of one conversation run one at a time, each seeing the previous reply
+    async with session_store.lock(session_id):
+        # Again under the lock: the session may have been deleted while this turn waited
+        session = await _user_session(session_id, current_user.id)
+        prompt = session.prompt(message.content)
+        try:
+            with tracing.span("rate_limiter.reserve"):
+                reservation = await rate_limiter.reserve(current_user.id, session.model_name, prompt,
+                                                         message.max_tokens)
+        except ValueError as ve:
+            raise HTTPException(status_code=400, detail=str(ve))
+        except RateLimited as rl:
+            raise _too_many_requests(rl)
+        try:
+            with tracing.span("generate", model=session.model_name, session=True):
+                completion = await route_model(session.model_name, prompt, message.max_tokens, message.temperature,
+                                               message.priority, Deadline.after(message.timeout))
+        except Exception as e:
+            await rate_limiter.settle(reservation)
+            if isinstance(e, ValueError):
+                raise HTTPException(status_code=400, detail=str(e))
+            if isinstance(e, (Overloaded, RateLimited)):
+                raise _too_many_requests(e)
+            if isinstance(e, (ProviderError, DeadlineExceeded)):
+                raise _upstream_error(e)
+            raise HTTPException(status_code=500, detail=f"Unexpected error: {e}")
+        content, input_tokens, output_tokens, served_model, cached_input_tokens = completion
+        # Provider prompt caching discounts the repeated history
+        cost = calculate_cost(served_model, input_tokens, output_tokens, cached_input_tokens)
+        log_usage(current_user.id, served_model, input_tokens, output_tokens, cost_usd=cost)
+        await rate_limiter.settle(reservation, input_tokens, output_tokens, cost)
+        session.add_turn(message.content, content.strip(), input_tokens, output_tokens, cached_input_tokens, cost)
+        await session_store.put(session)
+    return {
+        "response": content.strip(),
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "cached_input_tokens": cached_input_tokens,
+        "estimated_cost_usd": cost,
+        "model": served_model,
+        "turns": session.turns
+    }
+
+def _encode_cursor(row: dict) -> str:
+    raw = json.dumps([row["timestamp"].isoformat(), row["id"]])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def _decode_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        timestamp, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(timestamp), int(row_id)
+    except (ValueError, TypeError, binascii.Error):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def _naive_utc(value: Optional[datetime]) -> Optional[datetime]:
+    # usage_log timestamps are naive UTC
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def _usage_query(user_id: int, before: Optional[tuple[datetime, int]], since: Optional[datetime],
+                 until: Optional[datetime], model: Optional[str]) -> tuple[str, list]:
+    # Newest first; the (timestamp, id) keyset walks idx_usage_log_user_time
+    clauses = ["user_id = %s"]
+    params = [str(user_id)]
+    if since is not None:
+        clauses.append("timestamp >= %s")
+        params.append(since)
+    if until is not None:
+        clauses.append("timestamp < %s")
+        params.append(until)
+    if model is not None:
+        clauses.append("model_name = %s")
+        params.append(model)
+    if before is not None:
+        timestamp, row_id = before
+        clauses.append("(timestamp < %s OR (timestamp = %s AND id < %s))")
+        params.extend([timestamp, timestamp, row_id])
+    query = (f"SELECT {', '.join(USAGE_COLUMNS)} FROM usage_log WHERE {' AND '.join(clauses)} "
+             "ORDER BY timestamp DESC, id DESC")
+    return query, params
+
+def _json_value(value):
+    # Same representation the JSON responses use: ISO timestamps, numbers for DECIMAL
+    return value.isoformat() if isinstance(value, datetime) else float(value)
+
+async def _archived_rows(filters: dict, limit: Optional[int] = None):
+    # Archived rows (newest first), read off the event loop a thousand at a time
+    if usage_archive.archived_before() is None:
+        return
+    rows = usage_archive.read_archive(**filters)
+    while limit is None or limit > 0:
+        batch = await asyncio.to_thread(lambda: list(itertools.islice(rows, 1000 if limit is None else min(limit, 1000))))
+        if not batch:
+            return
+        for row in batch:
+            yield {column: row[column] for column in USAGE_COLUMNS}
+        if limit is not None:
+            limit -= len(batch)
+
+async def _all_usage_rows(query: str, params: list, filters: dict):
+    # Live rows first, then the archive (all older unless rows were replayed late)
+    async for row in database.astream(query, params):
+        yield row
+    async for row in _archived_rows(filters):
+        yield row
+
+async def _ndjson_rows(rows):
+    async for row in rows:
+        yield json.dumps(row, default=_json_value) + "\n"
+
+async def _csv_rows(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(USAGE_COLUMNS)
+    async for row in rows:
+        writer.writerow([row[column] for column in USAGE_COLUMNS])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+@app.get("/usage", summary="Get usage logs for current user")
+async def get_usage(
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    model: Optional[str] = None,
+    format: Literal["json", "ndjson", "csv"] = "json",
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Pages of `limit` rows, newest first; pass `next_cursor` back as `cursor`
+    for the next page. format=ndjson or csv streams every matching row
+    instead (limit is ignored). Rows moved to the usage archive are included.
+    """
+    filters = {
+        "user_id": current_user.id,
+        "since": _naive_utc(since),
+        "until": _naive_utc(until),
+        "model": model,
+        "before": _decode_cursor(cursor) if cursor is not None else None,
+    }
+    query, params = _usage_query(**filters)
+    if format == "ndjson":
+        return StreamingResponse(_ndjson_rows(_all_usage_rows(query, params, filters)),
+                                 media_type="application/x-ndjson")
+    if format == "csv":
+        return StreamingResponse(_csv_rows(_all_usage_rows(query, params, filters)), media_type="text/csv",
+                                 headers={"Content-Disposition": "attachment; filename=usage.csv"})
+
+    rows = await database.afetch_all(query + " LIMIT %s", params + [limit + 1])
+    archived_before = usage_archive.archived_before()
+    if archived_before is not None and (len(rows) <= limit or rows[-1]["timestamp"] < archived_before):
+        # The page reaches into archived time: merge in the archive's newest matching rows
+        merged = {row["id"]: row for row in rows}
+        async for row in _archived_rows(filters, limit + 1):
+            merged.setdefault(row["id"], row)
+        rows = sorted(merged.values(), key=lambda row: (row["timestamp"], row["id"]), reverse=True)[:limit + 1]
+    next_cursor = _encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return {"usage": rows[:limit], "next_cursor": next_cursor}
+
+@app.get("/stats", summary="Gateway cache and queue statistics (auth required)")
+def get_stats(current_user: User = Depends(get_current_user)):
+    return {
+        "token_cache": token_cache.stats(),
+        "usage_writer": usage_writer.stats(),
+        "db_pool": database.get_pool().stats(),
+        "response_cache": response_cache.stats(),
+        "similarity_cache": similarity_cache.stats(),
+        "coalescing": singleflight.stats(),
+        "routing": router.stats(),
+        "scheduler": scheduler.stats(),
+        "rate_limits": rate_limiter.stats(),
+        "analytics_cache": analytics_cache.stats(),
+        "usage_stream": usage_broker.stats(),
+        "password_hashing": password_hasher.stats(),
+        "tracing": tracing.stats(),
+        "sessions": session_store.stats(),
+        "tokenizer": tokenizer.stats(),
+    }
+
+@app.get("/metrics", summary="Prometheus metrics", include_in_schema=False)
+def get_metrics(request: Request):
+    if not metrics.METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if metrics.METRICS_TOKEN and request.headers.get("authorization") != f"Bearer {metrics.METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return Response(metrics.registry.render(), media_type=metrics.CONTENT_TYPE)
 
 # Include the new dashboard router
-app.include_router(dashboard_router.router)
\ No newline at end of file
+app.include_router(dashboard_router.router)
+app.include_router(analytics_router.router)
+app.include_router(admin_router.router)
\ No newline at end of file
@@ -0,0 +1,25 @@
+from datetime import datetime, timezone
+from typing import Literal, Optional
+from fastapi import APIRouter, Depends, Query
+from backend.main import get_admin_user, User
+from backend.services import tracing
+
+router = APIRouter(prefix="/admin")
+
+
+@router.get("/traces/slow", summary="Recent slow requests with their span trees and profiles (admin only)")
+async def slow_traces(
+    limit: int = Query(20, ge=1, le=100),
+    order: Literal["duration", "recent"] = "duration",
+    since: Optional[datetime] = None,
+    current_user: User = Depends(get_admin_user)
+):
+    # A naive `since` is taken as UTC, like the usage timestamps
+    if since is not None and since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    since_ts = since.timestamp() if since is not None else None
+    if order == "recent":
+        traces = tracing.slow_requests.recent(limit, since_ts)
+    else:
+        traces = tracing.slow_requests.slowest(limit, since_ts)
+    return {"threshold_s": tracing.TRACE_SLOW_THRESHOLD, "traces": traces}
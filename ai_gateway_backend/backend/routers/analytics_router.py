@@ -0,0 +1,68 @@
+from datetime import datetime, timedelta, timezone
+from typing import Literal, Optional
+from fastapi import APIRouter, Depends, HTTPException, Query
+from backend.main import get_current_user, get_admin_user, User
+from backend.services import analytics
+
+router = APIRouter(prefix="/usage/analytics")
+
+DEFAULT_RANGE = timedelta(days=30)
+
+
+def _naive_utc(value: datetime) -> datetime:
+    # Usage timestamps and rollup buckets are naive UTC
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _range(since: Optional[datetime], until: Optional[datetime]) -> tuple[datetime, datetime]:
+    # An open range ends at the next hour boundary rather than "now", so repeated calls share a cache entry
+    until = _naive_utc(until) if until is not None else (
+        datetime.utcnow().replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    )
+    since = _naive_utc(since) if since is not None else until - DEFAULT_RANGE
+    if since >= until:
+        raise HTTPException(status_code=400, detail="since must be before until")
+    return since, until
+
+
+@router.get("/cost", summary="Cost, requests and tokens per day or hour per model (auth required)")
+async def cost_timeseries(
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    bucket: Literal["day", "hour"] = "day",
+    model: Optional[str] = None,
+    current_user: User = Depends(get_current_user)
+):
+    since, until = _range(since, until)
+    return await analytics.cached("cost", current_user.id, analytics.cost_timeseries, user_id=current_user.id,
+                                  since=since, until=until, bucket=bucket, model=model)
+
+
+@router.get("/tokens", summary="Token-per-request percentiles per model (auth required)")
+async def token_percentiles(
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    percentiles: list[float] = Query([50, 95, 99]),
+    model: Optional[str] = None,
+    current_user: User = Depends(get_current_user)
+):
+    if not percentiles or any(p < 0 or p > 100 for p in percentiles):
+        raise HTTPException(status_code=400, detail="percentiles must be between 0 and 100")
+    since, until = _range(since, until)
+    return await analytics.cached("tokens", current_user.id, analytics.token_percentiles, user_id=current_user.id,
+                                  since=since, until=until, percentiles=sorted(set(percentiles)), model=model)
+
+
+@router.get("/top-users", summary="Users with the highest spend (admin only)")
+async def top_users(
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    limit: int = Query(10, ge=1, le=100),
+    model: Optional[str] = None,
+    current_user: User = Depends(get_admin_user)
+):
+    since, until = _range(since, until)
+    return await analytics.cached("top-users", None, analytics.top_users,
+                                  since=since, until=until, limit=limit, model=model)
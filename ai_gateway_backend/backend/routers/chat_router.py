@@ -1,7 +1,9 @@
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
-from backend.db.database import get_connection
+from backend.db import database
 from backend.services.model_router import route_model
+from backend.services.usage_writer import usage_writer, UsageEvent
+from backend.services.pricing import calculate_cost
 from backend.models.usage_model import UsageLog
 
 router = APIRouter()
@@ -12,34 +14,26 @@ class RequestPayload(BaseModel):
     model_name: str
 
 def log_usage(user_id: str, model_name: str, input_tokens: int, output_tokens: int):
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        INSERT INTO usage_log (user_id, model_name, input_tokens, output_tokens, timestamp)
-        VALUES (%s, %s, %s, %s, NOW())
-        """,
-        (user_id, model_name, input_tokens, output_tokens)
-    )
-    conn.commit()
-    cursor.close()
-    conn.close()
+    usage_writer.record(UsageEvent(user_id, model_name, input_tokens, output_tokens))
 
 @router.post("/generate")
 async def generate(payload: RequestPayload):
     try:
-        # route_model now returns 4 values
-        response, input_tokens, output_tokens, estimated_cost_usd = route_model(payload.model_name, payload.prompt)
+        response, input_tokens, output_tokens, served_model, cached_input_tokens = await route_model(
+            payload.model_name, payload.prompt
+        )
+
+        estimated_cost_usd = calculate_cost(served_model, input_tokens, output_tokens, cached_input_tokens)
 
         # Log usage
-        log_usage(payload.user_id, payload.model_name, input_tokens, output_tokens)
+        log_usage(payload.user_id, served_model, input_tokens, output_tokens)
 
         return {
             "response": response,
             "input_tokens": input_tokens,
             "output_tokens": output_tokens,
             "estimated_cost_usd": estimated_cost_usd,
-            "model": payload.model_name
+            "model": served_model
         }
 
     except ValueError as e:
@@ -48,17 +42,12 @@ async def generate(payload: RequestPayload):
         raise HTTPException(status_code=500, detail=f"Unexpected error: {e}")
 
 @router.get("/usage/{user_id}", response_model=list[UsageLog])
-def get_usage(user_id: str):
-    conn = get_connection()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute(
+async def get_usage(user_id: str):
+    rows = await database.afetch_all(
         """
         SELECT id, user_id, model_name, input_tokens, output_tokens, timestamp 
         FROM usage_log WHERE user_id = %s ORDER BY timestamp DESC
         """,
         (user_id,)
     )
-    rows = cursor.fetchall()
-    cursor.close()
-    conn.close()
     return rows
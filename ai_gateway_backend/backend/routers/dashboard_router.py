@@ -1,73 +1,80 @@
+import json
 from fastapi import APIRouter, Depends
-from backend.db.database import get_connection
+from fastapi.responses import StreamingResponse
+from backend.db import database
 from backend.main import get_current_user, User
 from backend.models.dashboard_model import UsageSummary
+from backend.services.usage_events import usage_broker, USAGE_STREAM_HEARTBEAT
+from backend.services.usage_writer import usage_writer
 
 router = APIRouter()
 
 def get_usage_summary_from_db(user: User):
-    conn = get_connection()
-    cursor = conn.cursor(dictionary=True)
-    try:
-        cursor.execute(
-            """
-            SELECT
-                COUNT(*) as total_requests,
-                SUM(input_tokens) as total_input_tokens,
-                SUM(output_tokens) as total_output_tokens,
-                model_name,
-                SUM(CASE WHEN model_name = %s THEN input_tokens ELSE 0 END) as gpt_input,
-                SUM(CASE WHEN model_name = %s THEN output_tokens ELSE 0 END) as gpt_output,
-                SUM(CASE WHEN model_name LIKE 'claude%%' THEN input_tokens ELSE 0 END) as claude_input,
-                SUM(CASE WHEN model_name LIKE 'claude%%' THEN output_tokens ELSE 0 END) as claude_output,
-                SUM(CASE WHEN model_name LIKE 'llama%%' THEN input_tokens ELSE 0 END) as llama_input,
-                SUM(CASE WHEN model_name LIKE 'llama%%' THEN output_tokens ELSE 0 END) as llama_output
-            FROM usage_log
-            WHERE user_id = %s
-            GROUP BY model_name
-            """,
-            ("gpt-3.5-turbo", "gpt-3.5-turbo", user.id)
-        )
-        all_results = cursor.fetchall()
+    # One row per model the user has used, whatever the length of their history
+    rows = database.fetch_all(
+        """
+        SELECT model_name, requests, input_tokens, output_tokens, cost_usd
+        FROM usage_rollup_total
+        WHERE user_id = %s
+        """,
+        (str(user.id),)
+    )
+
+    total_requests = 0
+    total_input_tokens = 0
+    total_output_tokens = 0
+    estimated_total_cost_usd = 0.0
+    model_usage = {}
 
-        total_requests = 0
-        total_input_tokens = 0
-        total_output_tokens = 0
-        model_usage = {'gpt': {'input_tokens': 0, 'output_tokens': 0, 'requests': 0},
-                       'claude': {'input_tokens': 0, 'output_tokens': 0, 'requests': 0},
-                       'llama': {'input_tokens': 0, 'output_tokens': 0, 'requests': 0}}
+    for row in rows:
+        total_requests += row['requests']
+        total_input_tokens += row['input_tokens']
+        total_output_tokens += row['output_tokens']
+        estimated_total_cost_usd += float(row['cost_usd'])
+        model_usage[row['model_name']] = {
+            'input_tokens': row['input_tokens'],
+            'output_tokens': row['output_tokens'],
+            'requests': row['requests']
+        }
 
-        for row in all_results:
-            total_requests += row.get('total_requests', 0) or 0
-            total_input_tokens += row.get('total_input_tokens', 0) or 0
-            total_output_tokens += row.get('total_output_tokens', 0) or 0
-            model_name = row.get('model_name', '')
-            if 'gpt' in model_name:
-                model_usage['gpt']['input_tokens'] += row.get('gpt_input', 0) or 0
-                model_usage['gpt']['output_tokens'] += row.get('gpt_output', 0) or 0
-                # Increment request count per model if needed
-            elif 'claude' in model_name:
-                model_usage['claude']['input_tokens'] += row.get('claude_input', 0) or 0
-                model_usage['claude']['output_tokens'] += row.get('claude_output', 0) or 0
-            elif 'llama' in model_name:
-                model_usage['llama']['input_tokens'] += row.get('llama_input', 0) or 0
-                model_usage['llama']['output_tokens'] += row.get('llama_output', 0) or 0
-            # Increment request count per model if needed
+    return UsageSummary(
+        total_requests=total_requests,
+        total_input_tokens=total_input_tokens,
+        total_output_tokens=total_output_tokens,
+        estimated_total_cost_usd=round(estimated_total_cost_usd, 6),
+        model_usage=model_usage
+    )
+
+@router.get("/usage/summary", response_model=UsageSummary, dependencies=[Depends(get_current_user)])
+async def get_usage_summary(current_user: User = Depends(get_current_user)):
+    summary = await database.run(get_usage_summary_from_db, current_user)
+    return summary
 
-        estimated_total_cost_usd = 0.000005 * (float(total_input_tokens) + float(total_output_tokens))
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
-        return UsageSummary(
-            total_requests=total_requests,
-            total_input_tokens=total_input_tokens,
-            total_output_tokens=total_output_tokens,
-            estimated_total_cost_usd=estimated_total_cost_usd,
-            model_usage=model_usage
-        )
+async def _summary_events(subscription, summary: UsageSummary):
+    # One snapshot, then only deltas: the dashboard never re-runs the summary query
+    try:
+        yield _sse("snapshot", summary.model_dump())
+        while True:
+            delta = await subscription.next(USAGE_STREAM_HEARTBEAT)
+            # Comment lines keep proxies from closing an idle stream
+            yield ": keep-alive\n\n" if delta is None else _sse("delta", delta)
     finally:
-        cursor.close()
-        conn.close()
+        usage_broker.unsubscribe(subscription)
 
-@router.get("/usage/summary", response_model=UsageSummary, dependencies=[Depends(get_current_user)])
-def get_usage_summary(current_user: User = Depends(get_current_user)):
-    summary = get_usage_summary_from_db(current_user)
-    return summary
\ No newline at end of file
+@router.get("/usage/summary/stream", summary="Live usage summary as server-sent events (auth required)")
+async def stream_usage_summary(current_user: User = Depends(get_current_user)):
+    # Subscribed before the snapshot is read, with no batch mid-commit, so no event is missed or counted twice
+    subscription = usage_broker.subscribe(current_user.id)
+    try:
+        summary = await usage_writer.between_batches(get_usage_summary_from_db, current_user)
+    except Exception:
+        usage_broker.unsubscribe(subscription)
+        raise
+    return StreamingResponse(
+        _summary_events(subscription, summary),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
@@ -0,0 +1,257 @@
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Optional
+import numpy as np
+
+from backend.db import database, rollups, usage_archive
+from backend.services.pricing import MODEL_COSTS, DEFAULT_MODEL_COST
+from backend.services.usage_writer import usage_writer
+
+ANALYTICS_CACHE_MAX_ENTRIES = int(os.getenv("ANALYTICS_CACHE_MAX_ENTRIES", "1000"))
+ANALYTICS_CACHE_TTL = float(os.getenv("ANALYTICS_CACHE_TTL", "300"))
+
+
+class _Columns:
+    """
+    Query results as NumPy columns, filled batch by batch so rows are never
+    held as Python dicts all at once.
+    """
+
+    def __init__(self, names: list[str]):
+        self._chunks = {name: [] for name in names}
+
+    def extend(self, rows: list[dict]):
+        for name, chunks in self._chunks.items():
+            chunks.append([row[name] for row in rows])
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        values = [value for chunk in self._chunks[name] for value in chunk]
+        if name in ("timestamp", "bucket_start"):
+            return np.array(values, dtype="datetime64[us]")
+        if name in ("model_name", "user_id"):
+            return np.array(values, dtype=object)
+        # DECIMAL and NULL costs come back as Decimal / None; NaN marks the missing ones
+        return np.array([np.nan if value is None else float(value) for value in values], dtype=np.float64)
+
+
+def _load(query: str, params: list, names: list[str]) -> _Columns:
+    columns = _Columns(names)
+    for batch in database.iter_batches(query, params):
+        columns.extend(batch)
+    return columns
+
+
+def _where(user_id: Optional[int], model: Optional[str], column: str, since: datetime,
+           until: datetime) -> tuple[str, list]:
+    clauses = [f"{column} >= %s", f"{column} < %s"]
+    params = [since, until]
+    if user_id is not None:
+        clauses.append("user_id = %s")
+        params.append(str(user_id))
+    if model is not None:
+        clauses.append("model_name = %s")
+        params.append(model)
+    return " AND ".join(clauses), params
+
+
+def _price(models: np.ndarray, input_tokens: np.ndarray, output_tokens: np.ndarray) -> np.ndarray:
+    # MODEL_COSTS applied per row: one rate lookup per distinct model, then whole-array arithmetic
+    names, codes = np.unique(models, return_inverse=True)
+    rates = [MODEL_COSTS.get(str(name).lower(), DEFAULT_MODEL_COST) for name in names]
+    input_rates = np.array([rate["input"] for rate in rates])[codes]
+    output_rates = np.array([rate["output"] for rate in rates])[codes]
+    return (input_tokens * input_rates + output_tokens * output_rates) / 1000
+
+
+def cost_timeseries(user_id: Optional[int], since: datetime, until: datetime, bucket: str = "day",
+                    model: Optional[str] = None) -> dict:
+    """
+    Cost, requests and tokens per time bucket per model, from the hourly or
+    daily rollups. user_id=None covers every user. `since` is rounded down to
+    its bucket, since rollups cannot be split.
+    """
+    table = "usage_rollup_hourly" if bucket == "hour" else "usage_rollup_daily"
+    where, params = _where(user_id, model, "bucket_start", rollups._bucket(since, bucket), until)
+    names = ["bucket_start", "model_name", "requests", "input_tokens", "output_tokens", "cost_usd"]
+    data = _load(f"SELECT {', '.join(names)} FROM {table} WHERE {where}", params, names)
+
+    buckets, bucket_codes = np.unique(data["bucket_start"], return_inverse=True)
+    models, model_codes = np.unique(data["model_name"], return_inverse=True)
+    # One flat index per (model, bucket) cell, summed with bincount in a single pass per measure
+    cells = model_codes * len(buckets) + bucket_codes
+    shape = (len(models), len(buckets))
+    series = {}
+    measures = {}
+    for measure in ("cost_usd", "requests", "input_tokens", "output_tokens"):
+        measures[measure] = np.bincount(cells, weights=data[measure], minlength=shape[0] * shape[1]).reshape(shape)
+    for index, name in enumerate(models):
+        series[str(name)] = {
+            "cost_usd": np.round(measures["cost_usd"][index], 6).tolist(),
+            "requests": measures["requests"][index].astype(int).tolist(),
+            "input_tokens": measures["input_tokens"][index].astype(int).tolist(),
+            "output_tokens": measures["output_tokens"][index].astype(int).tolist(),
+        }
+    return {
+        "bucket": bucket,
+        "buckets": [str(value) for value in buckets.astype("datetime64[s]")],
+        "series": series,
+        "total_cost_usd": round(float(measures["cost_usd"].sum()), 6),
+    }
+
+
+def token_percentiles(user_id: int, since: datetime, until: datetime, percentiles: list[float],
+                      model: Optional[str] = None) -> dict:
+    """
+    Per-request token percentiles per model, over raw usage rows (archived
+    ones included). Also reports per-model request count and cost.
+    """
+    where, params = _where(user_id, model, "timestamp", since, until)
+    names = ["id", "model_name", "input_tokens", "output_tokens", "cost_usd"]
+    data = _load(f"SELECT {', '.join(names)} FROM usage_log WHERE {where}", params, names)
+    models = data["model_name"]
+    input_tokens = data["input_tokens"]
+    output_tokens = data["output_tokens"]
+    cost = data["cost_usd"]
+
+    archived_before = usage_archive.archived_before()
+    if archived_before is not None and since < archived_before:
+        archived = _Columns(names)
+        rows = list(usage_archive.read_archive(user_id, since, until, model))
+        if rows:
+            archived.extend(rows)
+            # Rows exported but not yet deleted (archiving interrupted) are counted once, from the archive
+            live = ~np.isin(data["id"], archived["id"])
+            models = np.concatenate([models[live], archived["model_name"]])
+            input_tokens = np.concatenate([input_tokens[live], archived["input_tokens"]])
+            output_tokens = np.concatenate([output_tokens[live], archived["output_tokens"]])
+            cost = np.concatenate([cost[live], archived["cost_usd"]])
+
+    cost = np.where(np.isnan(cost), _price(models, input_tokens, output_tokens), cost)
+    total_tokens = input_tokens + output_tokens
+
+    # Sort once by model, then every model is a contiguous slice
+    order = np.argsort(models, kind="stable")
+    names_sorted = models[order]
+    boundaries = np.flatnonzero(names_sorted[1:] != names_sorted[:-1]) + 1
+    starts = np.concatenate([[0], boundaries]) if len(order) else np.array([], dtype=int)
+    ends = np.concatenate([boundaries, [len(order)]]) if len(order) else np.array([], dtype=int)
+    result = {}
+    for start, end in zip(starts, ends):
+        rows = order[start:end]
+        quantiles = {}
+        for label, values in (("input_tokens", input_tokens), ("output_tokens", output_tokens),
+                              ("total_tokens", total_tokens)):
+            points = np.percentile(values[rows], percentiles)
+            quantiles[label] = {f"p{p:g}": round(float(v), 2) for p, v in zip(percentiles, points)}
+        result[str(names_sorted[start])] = {
+            "requests": int(end - start),
+            "cost_usd": round(float(cost[rows].sum()), 6),
+            **quantiles,
+        }
+    return {"percentiles": percentiles, "models": result}
+
+
+def top_users(since: datetime, until: datetime, limit: int = 10, model: Optional[str] = None) -> dict:
+    """
+    The `limit` biggest spenders in the range, from the daily rollups (so
+    `since` is rounded down to its day).
+    """
+    where, params = _where(None, model, "bucket_start", rollups._bucket(since, "day"), until)
+    names = ["user_id", "requests", "input_tokens", "output_tokens", "cost_usd"]
+    data = _load(f"SELECT {', '.join(names)} FROM usage_rollup_daily WHERE {where}", params, names)
+    users, codes = np.unique(data["user_id"], return_inverse=True)
+    totals = {measure: np.bincount(codes, weights=data[measure], minlength=len(users))
+              for measure in ("cost_usd", "requests", "input_tokens", "output_tokens")}
+    top = np.argsort(-totals["cost_usd"], kind="stable")[:limit]
+    return {
+        "users": [
+            {
+                "user_id": str(users[index]),
+                "cost_usd": round(float(totals["cost_usd"][index]), 6),
+                "requests": int(totals["requests"][index]),
+                "input_tokens": int(totals["input_tokens"][index]),
+                "output_tokens": int(totals["output_tokens"][index]),
+            }
+            for index in top
+        ]
+    }
+
+
+class AnalyticsCache:
+    """
+    Caches analytics results per (query, parameters). Each entry remembers
+    the data version of the user it covers (or the global version for
+    cross-user queries); new usage events bump those versions, so stale
+    entries are never served, and ANALYTICS_CACHE_TTL bounds the rest.
+    """
+
+    def __init__(self, max_entries: int = ANALYTICS_CACHE_MAX_ENTRIES, ttl: float = ANALYTICS_CACHE_TTL):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._entries: OrderedDict = OrderedDict()  # key -> (version, expires_at, result)
+        self._user_versions: dict[str, int] = {}
+        self._global_version = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def version(self, user_id: Optional[int]) -> int:
+        if user_id is None:
+            return self._global_version
+        return self._user_versions.get(str(user_id), 0)
+
+    def get(self, key: tuple, user_id: Optional[int]):
+        entry = self._entries.get(key)
+        if entry is not None:
+            version, expires_at, result = entry
+            if version == self.version(user_id) and time.time() < expires_at:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return result
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key: tuple, user_id: Optional[int], version: int, result):
+        self._entries[key] = (version, time.time() + self._ttl, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def on_events(self, events: list):
+        # Usage writer listener: a committed batch invalidates its users' results and every cross-user one
+        for user_id in {str(event.user_id) for event in events}:
+            self._user_versions[user_id] = self._user_versions.get(user_id, 0) + 1
+        self._global_version += 1
+        self.invalidations += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "invalidations": self.invalidations,
+        }
+
+
+analytics_cache = AnalyticsCache()
+usage_writer.add_listener(analytics_cache.on_events)
+
+
+async def cached(name: str, scope: Optional[int], fn, **params):
+    """
+    Returns fn(**params) from the cache, computing it on the DB threadpool on
+    a miss. `scope` is the user the result covers, or None for every user.
+    """
+    key = (name, scope, tuple(sorted((k, str(v)) for k, v in params.items())))
+    result = analytics_cache.get(key, scope)
+    if result is None:
+        # Versions are read before computing, so events committed meanwhile still invalidate it
+        version = analytics_cache.version(scope)
+        result = await database.run(fn, **params)
+        analytics_cache.put(key, scope, version, result)
+    return result
@@ -1,26 +1,137 @@
 import os
-from dotenv import load_dotenv
+from typing import AsyncIterator, Optional
 import anthropic
 
-load_dotenv()
+from backend.services import http_clients, tokenizer
+from backend.services.providers import Prompt, prompt_text
+from backend.services.resilience import (
+    ProviderError, ProviderNotConfigured, ProviderRejected, ProviderTimeout, ProviderUnavailable, classify_status
+)
+
 ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
+ANTHROPIC_BASE_URL = os.getenv("ANTHROPIC_BASE_URL", "https://api.anthropic.com")
+USE_ANTHROPIC_MOCK = os.getenv("USE_ANTHROPIC_MOCK", "False").lower() == "true"
+
+_client = None
+# Prompt-cache breakpoint: Anthropic caches the prompt up to and including the marked block
+_CACHE_CONTROL = {"type": "ephemeral"}
+
+
+def get_async_client() -> anthropic.AsyncAnthropic:
+    global _client
+    if _client is None:
+        _client = anthropic.AsyncAnthropic(
+            api_key=ANTHROPIC_API_KEY,
+            base_url=ANTHROPIC_BASE_URL,
+            http_client=http_clients.get_client("anthropic"),
+            # Retries are done by the router, within the request's deadline
+            max_retries=0,
+        )
+    return _client
+
+
+async def warm_up():
+    if USE_ANTHROPIC_MOCK or not ANTHROPIC_API_KEY:
+        return
+    get_async_client()
+    await http_clients.warm_up("anthropic", ANTHROPIC_BASE_URL)
+
+
+def _typed_error(e: anthropic.AnthropicError) -> ProviderError:
+    if isinstance(e, anthropic.APITimeoutError):
+        return ProviderTimeout("Anthropic", str(e))
+    if isinstance(e, anthropic.APIConnectionError):
+        return ProviderUnavailable("Anthropic", str(e))
+    if isinstance(e, anthropic.APIStatusError):
+        return classify_status("Anthropic", e.status_code, str(e), e.response.headers)
+    return ProviderRejected("Anthropic", str(e))
+
+
+def _request(prompt: Prompt) -> dict:
+    """
+    The messages (and system prompt) arguments for a request. A conversation
+    gets cache breakpoints on its system prompt and its last message, so the
+    next turn reads the whole history back from Anthropic's prompt cache.
+    """
+    if isinstance(prompt, str):
+        return {"messages": [{"role": "user", "content": prompt}]}
+    system = [message["content"] for message in prompt if message["role"] == "system"]
+    messages = [
+        {"role": message["role"], "content": [{"type": "text", "text": message["content"]}]}
+        for message in prompt if message["role"] != "system"
+    ]
+    if messages:
+        messages[-1]["content"][-1]["cache_control"] = _CACHE_CONTROL
+    request = {"messages": messages}
+    if system:
+        request["system"] = [{"type": "text", "text": "\n\n".join(system), "cache_control": _CACHE_CONTROL}]
+    return request
+
+
+def _input_tokens(usage) -> tuple[int, int]:
+    # Anthropic reports cache reads and writes apart from input_tokens; the gateway counts them all as input
+    cache_read = getattr(usage, "cache_read_input_tokens", None) or 0
+    cache_write = getattr(usage, "cache_creation_input_tokens", None) or 0
+    return usage.input_tokens + cache_read + cache_write, cache_read
+
+
+async def generate_text_anthropic(prompt: Prompt, model: str, max_tokens: int = 100, temperature: float = 0.7,
+                                  timeout: Optional[float] = None) -> tuple[str, int, int, int]:
+    """
+    Returns (text, input_tokens, output_tokens, cached_input_tokens).
+    """
+    if USE_ANTHROPIC_MOCK:
+        text = prompt_text(prompt)
+        input_tokens = tokenizer.count_prompt(model, prompt)
+        return f"[MOCK] Anthropic response from {model} for prompt: '{text}'", input_tokens, 6, 0
 
-def generate_text_anthropic(prompt: str, model: str) -> tuple[str, int, int]:
     if not ANTHROPIC_API_KEY:
-        return "[Mock] Anthropic API key missing or no credits.", len(prompt.split()), 6
+        # An error, never a placeholder answer: that would be billed as a real response
+        raise ProviderNotConfigured("Anthropic", "missing API key")
 
     try:
-        client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
-        response = client.messages.create(
+        response = await get_async_client().messages.create(
             model=model,
-            max_tokens=100,
-            temperature=0.7,
-            messages=[{"role": "user", "content": prompt}]
+            max_tokens=max_tokens,
+            temperature=temperature,
+            timeout=timeout,
+            **_request(prompt),
         )
         content = response.content[0].text
-        input_tokens = response.usage.input_tokens
+        input_tokens, cached_input_tokens = _input_tokens(response.usage)
         output_tokens = response.usage.output_tokens
-        return content, input_tokens, output_tokens
-    except Exception as e:
-        # Fallback in case Anthropic fails
-        return f"[Mock] Anthropic error: {e}", len(prompt.split()), 6
+        return content, input_tokens, output_tokens, cached_input_tokens
+    except anthropic.AnthropicError as e:
+        # Surface the failure so routing can fall back instead of billing an error string
+        raise _typed_error(e)
+
+
+async def stream_text_anthropic(prompt: Prompt, model: str, max_tokens: int = 100, temperature: float = 0.7,
+                                timeout: Optional[float] = None) -> AsyncIterator[tuple[str, int, int]]:
+    """
+    Streams (text delta, input_tokens, output_tokens); the usage arrives in
+    the last item, once Anthropic reports the final message.
+    """
+    if USE_ANTHROPIC_MOCK:
+        text = prompt_text(prompt)
+        input_tokens = tokenizer.count_prompt(model, prompt)
+        yield f"[MOCK] Anthropic response from {model} for prompt: '{text}'", input_tokens, 6
+        return
+
+    if not ANTHROPIC_API_KEY:
+        raise ProviderNotConfigured("Anthropic", "missing API key")
+
+    try:
+        async with get_async_client().messages.stream(
+            model=model,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            timeout=timeout,
+            **_request(prompt),
+        ) as stream:
+            async for text in stream.text_stream:
+                yield text, 0, 0
+            message = await stream.get_final_message()
+            yield "", _input_tokens(message.usage)[0], message.usage.output_tokens
+    except anthropic.AnthropicError as e:
+        raise _typed_error(e)
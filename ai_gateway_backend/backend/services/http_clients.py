@@ -0,0 +1,57 @@
+import os
+import asyncio
+from typing import Optional
+
+import httpx
+
+# One long-lived client (and connection pool) per upstream provider, so a
+# saturated provider can never starve the others of connections.
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "500"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "100"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "120"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "120"))
+HTTP_POOL_TIMEOUT = float(os.getenv("HTTP_POOL_TIMEOUT", "10"))
+USE_HTTP2 = os.getenv("USE_HTTP2", "True").lower() == "true"
+
+_clients: dict[str, httpx.AsyncClient] = {}
+
+
+def get_client(name: str) -> httpx.AsyncClient:
+    """
+    Returns the shared async HTTP client for a provider, creating it on first use.
+    """
+    client = _clients.get(name)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            http2=USE_HTTP2,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(
+                HTTP_READ_TIMEOUT,
+                connect=HTTP_CONNECT_TIMEOUT,
+                pool=HTTP_POOL_TIMEOUT,
+            ),
+        )
+        _clients[name] = client
+    return client
+
+
+async def warm_up(name: str, url: str, headers: Optional[dict] = None):
+    """
+    Opens (and keeps alive) a connection to the provider so the first real
+    request does not pay for DNS, TCP and TLS setup. The response itself is ignored.
+    """
+    try:
+        await get_client(name).head(url, headers=headers)
+    except httpx.HTTPError as e:
+        print(f"HTTP warm-up for {name} failed: {e}")
+
+
+async def close_all():
+    clients = list(_clients.values())
+    _clients.clear()
+    await asyncio.gather(*(client.aclose() for client in clients), return_exceptions=True)
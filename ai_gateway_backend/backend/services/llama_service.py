@@ -1,25 +1,50 @@
 import os
-from dotenv import load_dotenv
-import requests
 import json
+from typing import AsyncIterator, Optional
+import httpx
+
+from backend.services import http_clients, tokenizer
+from backend.services.providers import Prompt, as_messages, prompt_text
+from backend.services.resilience import (
+    ProviderError, ProviderNotConfigured, ProviderRejected, ProviderTimeout, ProviderUnavailable, classify_status
+)
 
-load_dotenv()
 LLAMA_API_KEY = os.getenv("LLAMA_API_KEY")
 # Using OpenRouter's API endpoint for LLaMA models
-LLAMA_API_URL = "https://openrouter.ai/api/v1/chat/completions"
+LLAMA_API_URL = os.getenv("LLAMA_API_URL", "https://openrouter.ai/api/v1/chat/completions")
 
-# You can add a specific mock flag for LLaMA if you want more granular control,
-# but for now, it falls back to mock if LLAMA_API_KEY is missing.
+# Mock responses only when asked for; a missing LLAMA_API_KEY is an error
 USE_LLAMA_MOCK = os.getenv("USE_LLAMA_MOCK", "False").lower() == "true"
 
 
-def generate_text_llama(prompt: str, model: str) -> tuple[str, int, int]:
+async def warm_up():
+    if USE_LLAMA_MOCK or not LLAMA_API_KEY:
+        return
+    await http_clients.warm_up("llama", LLAMA_API_URL)
+
+
+def _typed_error(e: httpx.HTTPError) -> ProviderError:
+    if isinstance(e, httpx.TimeoutException):
+        return ProviderTimeout("LLaMA", str(e))
+    if isinstance(e, httpx.HTTPStatusError):
+        return classify_status("LLaMA", e.response.status_code, str(e), e.response.headers)
+    # Connection and protocol failures
+    return ProviderUnavailable("LLaMA", str(e))
+
+
+async def generate_text_llama(prompt: Prompt, model: str, max_tokens: int = 100, temperature: float = 0.7,
+                              timeout: Optional[float] = None) -> tuple[str, int, int, int]:
     """
     Generates text using a LLaMA model via OpenRouter API or returns a mock response.
+    Returns (text, input_tokens, output_tokens, cached_input_tokens).
     """
-    if USE_LLAMA_MOCK or not LLAMA_API_KEY:
-        # Returns a mocked response if USE_LLAMA_MOCK is True or API key is missing
-        return f"[MOCK] LLaMA response from {model} for prompt: '{prompt}'", len(prompt.split()), 20
+    if USE_LLAMA_MOCK:
+        text = prompt_text(prompt)
+        input_tokens = tokenizer.count_prompt(model, prompt)
+        return f"[MOCK] LLaMA response from {model} for prompt: '{text}'", input_tokens, 20, 0
+
+    if not LLAMA_API_KEY:
+        raise ProviderNotConfigured("LLaMA", "missing API key")
 
     headers = {
         "Authorization": f"Bearer {LLAMA_API_KEY}",
@@ -27,36 +52,95 @@ def generate_text_llama(prompt: str, model: str) -> tuple[str, int, int]:
     }
     payload = {
         "model": model, # e.g., "meta-llama/llama-3-8b-instruct" or "meta-llama/llama-4-maverick"
-        "messages": [{"role": "user", "content": prompt}],
-        "max_tokens": 100, # Adjust as needed
-        "temperature": 0.7 # Adjust creativity
+        "messages": as_messages(prompt),
+        "max_tokens": max_tokens,
+        "temperature": temperature
     }
 
     try:
-        response = requests.post(LLAMA_API_URL, headers=headers, data=json.dumps(payload))
-        response.raise_for_status()  # Raise HTTPError for bad responses (4xx or 5xx)
+        response = await http_clients.get_client("llama").post(
+            LLAMA_API_URL, headers=headers, json=payload,
+            timeout=timeout if timeout is not None else httpx.USE_CLIENT_DEFAULT
+        )
+        response.raise_for_status()  # Raise HTTPStatusError for bad responses (4xx or 5xx)
 
         result = response.json()
         content = result["choices"][0]["message"]["content"]
         usage = result.get("usage", {})
         input_tokens = usage.get("prompt_tokens", 0)
         output_tokens = usage.get("completion_tokens", 0)
+        # Reported for upstream models with prompt caching
+        cached_input_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
 
-        return content, input_tokens, output_tokens
+        return content, input_tokens, output_tokens, cached_input_tokens
 
-    except requests.exceptions.RequestException as e:
-        # Handles network errors, bad HTTP responses, etc.
+    except httpx.HTTPError as e:
+        # Handles network errors, timeouts, bad HTTP responses, etc.
         print(f"LLaMA API Request Error: {e}")
-        return f"[LLaMA API Error]: {e}", len(prompt.split()), 0 # Fallback token count
-    except json.JSONDecodeError as e:
+        raise _typed_error(e)
+    except ValueError as e:
         # Handles cases where the response is not valid JSON
         print(f"LLaMA API JSON Decode Error: {e}")
-        return f"[LLaMA API Error]: Invalid JSON response: {e}", len(prompt.split()), 0
-    except KeyError as e:
+        raise ProviderRejected("LLaMA", f"invalid JSON response: {e}")
+    except (KeyError, IndexError) as e:
         # Handles cases where expected keys are missing in the JSON response
         print(f"LLaMA API Response Structure Error: Missing key {e}")
-        return f"[LLaMA API Error]: Unexpected response structure (missing key: {e})", len(prompt.split()), 0
-    except Exception as e:
-        # Catch any other unexpected errors
-        print(f"An unexpected error occurred in LLaMA service: {e}")
-        return f"[LLaMA API Error]: An unexpected error occurred: {e}", len(prompt.split()), 0
\ No newline at end of file
+        raise ProviderRejected("LLaMA", f"unexpected response structure (missing key: {e})")
+
+
+async def stream_text_llama(prompt: Prompt, model: str, max_tokens: int = 100, temperature: float = 0.7,
+                            timeout: Optional[float] = None) -> AsyncIterator[tuple[str, int, int]]:
+    """
+    Streams (text delta, input_tokens, output_tokens) from OpenRouter's SSE
+    response; the usage arrives in the last chunk.
+    """
+    if USE_LLAMA_MOCK:
+        text = prompt_text(prompt)
+        input_tokens = tokenizer.count_prompt(model, prompt)
+        yield f"[MOCK] LLaMA response from {model} for prompt: '{text}'", input_tokens, 20
+        return
+
+    if not LLAMA_API_KEY:
+        raise ProviderNotConfigured("LLaMA", "missing API key")
+
+    headers = {
+        "Authorization": f"Bearer {LLAMA_API_KEY}",
+        "Content-Type": "application/json"
+    }
+    payload = {
+        "model": model,
+        "messages": as_messages(prompt),
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "stream": True,
+        "stream_options": {"include_usage": True},
+    }
+
+    try:
+        async with http_clients.get_client("llama").stream(
+            "POST", LLAMA_API_URL, headers=headers, json=payload,
+            timeout=timeout if timeout is not None else httpx.USE_CLIENT_DEFAULT
+        ) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                # Skip blank separators and ": OPENROUTER PROCESSING" keep-alive comments
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                chunk = json.loads(data)
+                choices = chunk.get("choices") or []
+                text = choices[0].get("delta", {}).get("content") if choices else None
+                if text:
+                    yield text, 0, 0
+                usage = chunk.get("usage")
+                if usage:
+                    yield "", usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0)
+
+    except httpx.HTTPError as e:
+        print(f"LLaMA API Stream Error: {e}")
+        raise _typed_error(e)
+    except ValueError as e:
+        print(f"LLaMA API Stream Error: {e}")
+        raise ProviderRejected("LLaMA", f"invalid stream chunk: {e}")
@@ -0,0 +1,218 @@
+import os
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "True").lower() == "true"
+# When set, /metrics requires "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+# Seconds; from a cache hit or token check up to a slow upstream completion
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class _Metric:
+    """
+    Values are kept in one shard per thread, so the event loop and the
+    executor threads (DB calls, usage flushes) each update their own dict
+    without taking a lock. A scrape sums the shards; a copy of a shard is
+    atomic, so it sees each shard at some consistent-enough instant.
+    """
+
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._local = threading.local()
+        self._shards: list[dict] = []
+        # Taken only when a thread touches the metric for the first time
+        self._shards_lock = threading.Lock()
+        registry.register(self)
+
+    def _shard(self) -> dict:
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._shards_lock:
+                self._shards.append(shard)
+            return shard
+
+    def _snapshots(self) -> list[dict]:
+        with self._shards_lock:
+            shards = list(self._shards)
+        return [shard.copy() for shard in shards]
+
+    def _labels(self, values: tuple, extra: str = "") -> str:
+        pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(self.labelnames, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, labels: tuple = (), amount: float = 1.0):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def totals(self) -> dict[tuple, float]:
+        totals: dict[tuple, float] = {}
+        for shard in self._snapshots():
+            for labels, value in shard.items():
+                totals[labels] = totals.get(labels, 0) + value
+        return totals
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        for labels, value in sorted(self.totals().items()):
+            lines.append(f"{self.name}{self._labels(labels)} {_number(value)}")
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, labels: tuple = ()):
+        shard = self._shard()
+        cell = shard.get(labels)
+        if cell is None:
+            # One count per bucket plus +Inf, then sum and count
+            cell = shard[labels] = [0] * (len(self.buckets) + 3)
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-2] += value
+        cell[-1] += 1
+
+    @contextmanager
+    def timer(self, labels: tuple = ()):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, labels)
+
+    def totals(self) -> dict[tuple, list]:
+        totals: dict[tuple, list] = {}
+        for shard in self._snapshots():
+            for labels, cell in shard.items():
+                cell = list(cell)
+                total = totals.get(labels)
+                if total is None:
+                    totals[labels] = cell
+                else:
+                    for i, value in enumerate(cell):
+                        total[i] += value
+        return totals
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        bounds = [_number(bound) for bound in self.buckets] + ["+Inf"]
+        for labels, cell in sorted(self.totals().items()):
+            cumulative = 0
+            for bound, count in zip(bounds, cell):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{self._labels(labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{self._labels(labels)} {_number(cell[-2])}")
+            lines.append(f"{self.name}_count{self._labels(labels)} {cell[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: list[_Metric] = []
+
+    def register(self, metric: _Metric):
+        self._metrics.append(metric)
+
+    def render(self) -> str:
+        """
+        All metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class MetricsMiddleware:
+    """
+    Plain ASGI middleware timing every HTTP request, labelled by the
+    matched route template (not the raw path) and response status. For a
+    streaming response the time runs until the last chunk is sent.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status: Optional[int] = None
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            request_seconds.observe(
+                time.perf_counter() - start,
+                (scope["method"], getattr(route, "path", "unmatched"), str(status or 500))
+            )
+
+
+registry = MetricsRegistry()
+
+request_seconds = Histogram(
+    "gateway_request_seconds", "HTTP request latency, until the response is fully sent",
+    ("method", "route", "status")
+)
+upstream_seconds = Histogram(
+    "gateway_upstream_seconds",
+    "Latency of one provider attempt (for streams, until the first chunk)",
+    ("provider", "call")
+)
+db_seconds = Histogram("gateway_db_seconds", "Time spent in database operations", ("operation",))
+jwt_decode_seconds = Histogram("gateway_jwt_decode_seconds", "Time to decode and verify an access token")
+tokens_total = Counter("gateway_tokens_total", "Tokens billed, by served model", ("model", "direction"))
+cost_usd_total = Counter("gateway_cost_usd_total", "Estimated cost billed in USD, by served model", ("model",))
+errors_total = Counter("gateway_errors_total", "Failed provider calls (after retries), by model and error type",
+                       ("model", "type"))
+similarity_cache_lookups_total = Counter("gateway_similarity_cache_lookups_total",
+                                         "Near-duplicate cache lookups, by model and hit or miss",
+                                         ("model", "result"))
+similarity_cache_similarity = Histogram(
+    "gateway_similarity_cache_similarity",
+    "Estimated similarity of the closest stored prompt, for lookups that found a candidate",
+    ("model", "result"), buckets=(0.5, 0.6, 0.7, 0.75, 0.8, 0.85, 0.9, 0.925, 0.95, 0.975, 0.99, 1.0)
+)
@@ -1,36 +1,113 @@
-import os
-from backend.services.openai_service import generate_text_openai
-from backend.services.anthropic_service import generate_text_anthropic
-from backend.services.llama_service import generate_text_llama  # Import the LLaMA service function
-import unicodedata
-
-def clean_string(s: str) -> str:
-    s = s.lower()
-    s = s.strip()  # Remove leading/trailing whitespace
-    s = "".join(ch for ch in s if ch.isprintable())  # Remove non-printable chars
-    s = unicodedata.normalize('NFKC', s)  # Normalize Unicode
-    return s
-
-def route_model(model_name: str, prompt: str):
-    print(f"Original model_name: {model_name}")  # Debug
-    model_name = clean_string(model_name)
-    print(f"Cleaned model_name: {model_name}")  # Debug
-
-    response = ""
-    input_tokens = 0
-    output_tokens = 0
-
-    if model_name.startswith("gpt"):
-        response, input_tokens, output_tokens = generate_text_openai(prompt, model_name)
-    elif model_name.startswith("claude"):
-        response, input_tokens, output_tokens = generate_text_anthropic(prompt, model_name)
-    elif "llama" in model_name:  # Check if "llama" is a substring
-        print("Routing to LLaMA")  # Debug
-        response, input_tokens, output_tokens = generate_text_llama(prompt, model_name)
-    else:
-        raise ValueError(f"Unsupported model: {model_name}")
-
-    # REMOVE THE ESTIMATED_COST_USD CALCULATION AND RETURN FROM HERE
-    # estimated_cost_usd = 0.000005 * (input_tokens + output_tokens) if input_tokens > 0 or output_tokens > 0 else 0.0
-
-    return response, input_tokens, output_tokens # ONLY RETURN 3 VALUES
\ No newline at end of file
+import asyncio
+from typing import AsyncIterator, NamedTuple, Optional
+from backend.services.providers import Prompt, registry
+from backend.services.routing import Router, RoutingPolicy, ROUTING_POLICY_PATH
+from backend.services.scheduler import scheduler
+from backend.services.resilience import Deadline, DeadlineExceeded, call_with_retries
+from backend.services.metrics import upstream_seconds, errors_total
+from backend.services.tracing import span
+
+async def warm_up_providers():
+    # Import the provider modules (and their SDKs) off the event loop, then open their pooled connections
+    async def warm_up(provider):
+        try:
+            await asyncio.to_thread(provider.module)
+            await provider.warm_up()
+        except Exception as e:
+            print(f"Warm-up for provider {provider.name} failed: {e}")
+
+    await asyncio.gather(*(warm_up(provider) for provider in registry.providers.values()))
+
+provider_for = registry.provider_for
+
+class Completion(NamedTuple):
+    content: str
+    input_tokens: int
+    output_tokens: int
+    # The model that actually served the request (may be a fallback or hedge)
+    model_name: str
+    # Part of input_tokens read from the provider's prompt cache
+    cached_input_tokens: int = 0
+
+router = Router(
+    provider_for,
+    RoutingPolicy.load(ROUTING_POLICY_PATH),
+    admit=lambda model, priority: scheduler.slot(provider_for(model), model, priority),
+)
+
+async def route_model(model_name: str, prompt: Prompt, max_tokens: int = 100, temperature: float = 0.7,
+                      priority: str = "interactive", deadline: Optional[Deadline] = None) -> Completion:
+    model_name, _ = registry.resolve(model_name)  # Unsupported models fail fast with ValueError
+    deadline = deadline or Deadline.after()
+
+    async def call(model: str) -> Completion:
+        provider = registry.get(provider_for(model))
+
+        async def attempt(timeout: float):
+            with upstream_seconds.timer((provider.name, "generate")), \
+                    span("upstream.generate", provider=provider.name, model=model, timeout_s=round(timeout, 3)):
+                return await provider.generate(prompt, model, max_tokens, temperature, timeout)
+
+        try:
+            response, input_tokens, output_tokens, cached_input_tokens = await call_with_retries(
+                attempt, deadline, provider.name
+            )
+        except Exception as e:
+            errors_total.inc((registry.metric_label(model), type(e).__name__))
+            raise
+        return Completion(response, input_tokens, output_tokens, model, cached_input_tokens)
+
+    # The deadline also bounds waiting for a provider slot, fallbacks and hedges
+    deadline.check()
+    with span("route_model", model=model_name, priority=priority):
+        try:
+            return await asyncio.wait_for(router.run(model_name, call, priority), deadline.remaining())
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded("Request deadline exceeded")
+
+async def _retrying_stream(stream, prompt: Prompt, model: str, max_tokens: int, temperature: float,
+                           deadline: Deadline) -> AsyncIterator[tuple[str, int, int]]:
+    # Failed attempts are retried only until the first chunk arrives; after that the client has seen output
+    provider = provider_for(model)
+
+    async def first_chunk(timeout: float):
+        chunks = stream(prompt, model, max_tokens, temperature, timeout)
+        try:
+            with upstream_seconds.timer((provider, "stream")), \
+                    span("upstream.stream_first_chunk", provider=provider, model=model, timeout_s=round(timeout, 3)):
+                return chunks, await anext(chunks, None)
+        except BaseException:
+            await chunks.aclose()
+            raise
+
+    try:
+        chunks, first = await call_with_retries(first_chunk, deadline, provider)
+    except Exception as e:
+        errors_total.inc((registry.metric_label(model), type(e).__name__))
+        raise
+    try:
+        if first is None:
+            return
+        yield first
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        await chunks.aclose()
+
+def route_model_stream(model_name: str, prompt: Prompt, max_tokens: int = 100, temperature: float = 0.7,
+                       priority: str = "interactive",
+                       deadline: Optional[Deadline] = None) -> tuple[str, AsyncIterator[tuple[str, int, int]]]:
+    """
+    Returns (served model, async iterator of (text delta, input_tokens,
+    output_tokens)). The first available candidate is picked up front, so
+    unsupported models raise ValueError before any response has been started.
+    Waiting for a provider slot happens on the first iteration, which raises
+    Overloaded if none can be had. The deadline bounds the wait for the
+    first chunk.
+    """
+    model_name, _ = registry.resolve(model_name)
+    deadline = deadline or Deadline.after()
+
+    served = router.candidates(model_name)[0]
+    chunks = _retrying_stream(registry.get(provider_for(served)).stream, prompt, served, max_tokens, temperature, deadline)
+    return served, router.observe_stream(served, chunks, priority)
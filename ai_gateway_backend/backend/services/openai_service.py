@@ -1,31 +1,112 @@
 import openai
 import os
-from dotenv import load_dotenv
+from typing import AsyncIterator, Optional
 from openai import OpenAIError
 
-load_dotenv()
-openai.api_key = os.getenv("OPENAI_API_KEY")
+from backend.services import http_clients
+from backend.services.providers import Prompt, as_messages, prompt_text
+from backend.services.resilience import (
+    ProviderError, ProviderNotConfigured, ProviderRejected, ProviderTimeout, ProviderUnavailable, classify_status
+)
+
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
 USE_MOCK = os.getenv("USE_OPENAI_MOCK", "False").lower() == "true"
 
-def generate_text_openai(prompt: str, model: str) -> tuple[str, int, int]:
+_client = None
+
+
+def get_async_client() -> openai.AsyncOpenAI:
+    global _client
+    if _client is None:
+        _client = openai.AsyncOpenAI(
+            api_key=OPENAI_API_KEY,
+            base_url=OPENAI_BASE_URL,
+            http_client=http_clients.get_client("openai"),
+            # Retries are done by the router, within the request's deadline
+            max_retries=0,
+        )
+    return _client
+
+
+async def warm_up():
+    if USE_MOCK or not OPENAI_API_KEY:
+        return
+    get_async_client()
+    await http_clients.warm_up("openai", OPENAI_BASE_URL)
+
+
+def _typed_error(e: OpenAIError) -> ProviderError:
+    if isinstance(e, openai.APITimeoutError):
+        return ProviderTimeout("OpenAI", str(e))
+    if isinstance(e, openai.APIConnectionError):
+        return ProviderUnavailable("OpenAI", str(e))
+    if isinstance(e, openai.APIStatusError):
+        return classify_status("OpenAI", e.status_code, str(e), e.response.headers)
+    return ProviderRejected("OpenAI", str(e))
+
+
+async def generate_text_openai(prompt: Prompt, model: str, max_tokens: int = 100, temperature: float = 0.7,
+                               timeout: Optional[float] = None) -> tuple[str, int, int, int]:
+    """
+    Returns (text, input_tokens, output_tokens, cached_input_tokens). OpenAI
+    caches long prompt prefixes by itself; sessions keep the prefix stable
+    so consecutive turns hit it.
+    """
     if USE_MOCK:
-        return f"[MOCKED {model}] You said: {prompt}", 5, 10
+        return f"[MOCKED {model}] You said: {prompt_text(prompt)}", 5, 10, 0
 
-    if not openai.api_key:
-        raise RuntimeError("Missing OpenAI API key.")
+    if not OPENAI_API_KEY:
+        raise ProviderNotConfigured("OpenAI", "missing API key")
 
     try:
-        response = openai.chat.completions.create(
+        response = await get_async_client().chat.completions.create(
             model=model,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.7,
-            max_tokens=100,
+            messages=as_messages(prompt),
+            temperature=temperature,
+            max_tokens=max_tokens,
+            timeout=timeout,
         )
         content = response.choices[0].message.content
         usage = getattr(response, "usage", None)
         input_tokens = usage.prompt_tokens if usage else 0
         output_tokens = usage.completion_tokens if usage else 0
-        return content, input_tokens, output_tokens
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_input_tokens = (details.cached_tokens or 0) if details else 0
+        return content, input_tokens, output_tokens, cached_input_tokens
+
+    except OpenAIError as e:
+        raise _typed_error(e)
+
+
+async def stream_text_openai(prompt: Prompt, model: str, max_tokens: int = 100, temperature: float = 0.7,
+                             timeout: Optional[float] = None) -> AsyncIterator[tuple[str, int, int]]:
+    """
+    Streams (text delta, input_tokens, output_tokens); token counts stay 0
+    until the final chunk, which carries the usage for the whole completion.
+    """
+    if USE_MOCK:
+        yield f"[MOCKED {model}] You said: {prompt_text(prompt)}", 5, 10
+        return
+
+    if not OPENAI_API_KEY:
+        raise ProviderNotConfigured("OpenAI", "missing API key")
+
+    try:
+        stream = await get_async_client().chat.completions.create(
+            model=model,
+            messages=as_messages(prompt),
+            temperature=temperature,
+            max_tokens=max_tokens,
+            timeout=timeout,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content, 0, 0
+            if chunk.usage:
+                yield "", chunk.usage.prompt_tokens, chunk.usage.completion_tokens
 
     except OpenAIError as e:
-        raise RuntimeError(f"OpenAI API call failed: {e}")
+        raise _typed_error(e)
@@ -0,0 +1,122 @@
+import os
+import math
+import time
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import TYPE_CHECKING, Optional
+
+if TYPE_CHECKING:
+    from passlib.context import CryptContext
+
+from backend.services.scheduler import Overloaded
+
+# bcrypt cost for new hashes; hashes with a lower cost are upgraded on the next successful login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Hash/verify calls allowed to wait for a worker before new ones are turned away
+PASSWORD_HASH_MAX_QUEUE = int(os.getenv("PASSWORD_HASH_MAX_QUEUE", "64"))
+
+
+@lru_cache(maxsize=None)
+def _context(rounds: int) -> "CryptContext":
+    # Imported here: only the worker processes hash, so the server never needs passlib loaded
+    from passlib.context import CryptContext
+    return CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__default_rounds=rounds,
+                        bcrypt__min_rounds=rounds)
+
+
+# Run in the worker processes
+def _hash(password: str, rounds: int) -> str:
+    return _context(rounds).hash(password)
+
+
+def _verify_and_update(password: str, hashed_password: str, rounds: int) -> tuple[bool, Optional[str]]:
+    return _context(rounds).verify_and_update(password, hashed_password)
+
+
+class PasswordHasher:
+    """
+    Runs bcrypt in a dedicated process pool, away from the event loop and
+    the DB threadpool, so login bursts cannot starve request handling. At
+    most PASSWORD_HASH_WORKERS hashes run at once; beyond that calls queue,
+    and once PASSWORD_HASH_MAX_QUEUE are waiting new ones fail fast with
+    Overloaded.
+    """
+
+    def __init__(self, workers: int = PASSWORD_HASH_WORKERS, max_queue: int = PASSWORD_HASH_MAX_QUEUE,
+                 rounds: int = BCRYPT_ROUNDS):
+        self._workers = max(1, workers)
+        self._max_queue = max_queue
+        self._rounds = rounds
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._waiting = 0
+        self._running = 0
+        self._avg_seconds = 0.25  # EWMA of one hash, for Retry-After
+        self.completed = 0
+        self.rejected = 0
+        self.rehashed = 0
+
+    def start(self):
+        if self._executor is None:
+            # spawn, not fork: the server process already runs DB and event-loop threads
+            self._executor = ProcessPoolExecutor(max_workers=self._workers,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+            self._slots = asyncio.Semaphore(self._workers)
+
+    def stop(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            self._slots = None
+
+    def _retry_after(self) -> int:
+        return max(1, math.ceil(self._avg_seconds * (self._waiting + 1) / self._workers))
+
+    async def _run(self, fn, *args):
+        self.start()
+        slots = self._slots
+        if self._waiting >= self._max_queue:
+            self.rejected += 1
+            raise Overloaded("Password hashing", self._retry_after())
+        self._waiting += 1
+        try:
+            await slots.acquire()
+        finally:
+            self._waiting -= 1
+        self._running += 1
+        try:
+            started = time.monotonic()
+            result = await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+            self._avg_seconds = 0.8 * self._avg_seconds + 0.2 * (time.monotonic() - started)
+            self.completed += 1
+            return result
+        finally:
+            self._running -= 1
+            slots.release()
+
+    async def hash(self, password: str) -> str:
+        return await self._run(_hash, password, self._rounds)
+
+    async def verify_and_update(self, password: str, hashed_password: str) -> tuple[bool, Optional[str]]:
+        """
+        (matches, new hash or None). A new hash is returned when the stored
+        one was made with an older scheme or a lower cost than BCRYPT_ROUNDS.
+        """
+        return await self._run(_verify_and_update, password, hashed_password, self._rounds)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self._workers,
+            "in_flight": self._running,
+            "waiting": self._waiting,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "rehashed": self.rehashed,
+            "avg_hash_ms": round(self._avg_seconds * 1000, 1),
+        }
+
+
+password_hasher = PasswordHasher()
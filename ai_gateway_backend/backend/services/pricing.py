@@ -0,0 +1,21 @@
+# Models cost per 1K tokens - adjust as needed
+# "cached_input" is the rate for input tokens read from the provider's prompt cache
+MODEL_COSTS = {
+    "gpt-4": {"input": 0.03, "output": 0.06, "cached_input": 0.015},
+    "gpt-3.5-turbo": {"input": 0.0015, "output": 0.002, "cached_input": 0.00075},
+    "claude-3-opus-20240229": {"input": 0.008, "output": 0.024, "cached_input": 0.0008}
+}
+DEFAULT_MODEL_COST = {"input": 0.001, "output": 0.002}
+
+
+def calculate_cost(model_name: str, input_tokens: int, output_tokens: int, cached_input_tokens: int = 0) -> float:
+    """
+    `input_tokens` includes any `cached_input_tokens`, which are billed at
+    the model's cached rate (its full input rate if it has none).
+    """
+    model_cost = MODEL_COSTS.get(model_name.lower(), DEFAULT_MODEL_COST)
+    cached_input_tokens = min(cached_input_tokens, input_tokens)
+    cost = (((input_tokens - cached_input_tokens) / 1000) * model_cost["input"]
+            + (cached_input_tokens / 1000) * model_cost.get("cached_input", model_cost["input"])
+            + (output_tokens / 1000) * model_cost["output"])
+    return round(cost, 6)
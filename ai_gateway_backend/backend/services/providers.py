@@ -0,0 +1,155 @@
+import os
+import json
+import importlib
+import unicodedata
+from functools import lru_cache
+from types import ModuleType
+from typing import AsyncIterator, Optional, Union
+
+PROVIDERS_CONFIG_PATH = os.getenv(
+    "PROVIDERS_CONFIG_PATH", os.path.join(os.path.dirname(os.path.dirname(__file__)), "providers.json")
+)
+
+
+# A single user prompt, or a whole conversation as chat messages ({"role": ..., "content": ...})
+Prompt = Union[str, list[dict]]
+
+
+def as_messages(prompt: Prompt) -> list[dict]:
+    if isinstance(prompt, str):
+        return [{"role": "user", "content": prompt}]
+    return prompt
+
+
+def prompt_text(prompt: Prompt) -> str:
+    # For token estimates and mocks
+    if isinstance(prompt, str):
+        return prompt
+    return "\n".join(message["content"] for message in prompt)
+
+
+def normalize(model_name: str) -> str:
+    model_name = model_name.lower().strip()
+    model_name = "".join(ch for ch in model_name if ch.isprintable())
+    return unicodedata.normalize("NFKC", model_name)
+
+
+class Provider:
+    """
+    One upstream provider, declared in providers.json by the module that
+    implements it and the names of its generate / stream / warm_up
+    functions. The module (and with it the provider's SDK) is only imported
+    the first time the provider is used.
+    """
+
+    def __init__(self, name: str, config: dict):
+        self.name = name
+        self.module_path = config["module"]
+        self.generate_name = config.get("generate", "generate")
+        self.stream_name = config.get("stream", "stream")
+        self.warm_up_name = config.get("warm_up", "warm_up")
+        # "tiktoken" where the provider's tokenizer is available locally, else "approximate"
+        self.tokenizer = config.get("tokenizer", "approximate")
+        self._module: Optional[ModuleType] = None
+
+    def module(self) -> ModuleType:
+        if self._module is None:
+            self._module = importlib.import_module(self.module_path)
+        return self._module
+
+    async def generate(self, prompt: Prompt, model: str, max_tokens: int, temperature: float,
+                       timeout: Optional[float] = None) -> tuple[str, int, int, int]:
+        return await getattr(self.module(), self.generate_name)(prompt, model, max_tokens, temperature, timeout)
+
+    def stream(self, prompt: Prompt, model: str, max_tokens: int, temperature: float,
+               timeout: Optional[float] = None) -> AsyncIterator[tuple[str, int, int]]:
+        return getattr(self.module(), self.stream_name)(prompt, model, max_tokens, temperature, timeout)
+
+    async def warm_up(self):
+        warm_up = getattr(self.module(), self.warm_up_name, None)
+        if warm_up is not None:
+            await warm_up()
+
+
+class ProviderRegistry:
+    """
+    Providers and the model names they serve, loaded from JSON:
+
+        {
+          "providers": {
+            "openai": {"module": "backend.services.openai_service",
+                       "generate": "generate_text_openai", "stream": "stream_text_openai",
+                       "models": ["gpt-4"], "prefixes": ["gpt"], "contains": []}
+          },
+          "aliases": {"gpt4": "gpt-4"}
+        }
+
+    A model name is normalized, mapped through the aliases, then matched by
+    exact name, longest prefix, and finally substring. Resolutions are
+    memoized, so the per-request cost is one dict lookup.
+    """
+
+    def __init__(self, config: dict):
+        self.providers = {name: Provider(name, spec) for name, spec in config.get("providers", {}).items()}
+        self.aliases = {normalize(alias): normalize(model) for alias, model in config.get("aliases", {}).items()}
+        self._exact: dict[str, str] = {}
+        self._prefixes: dict[str, str] = {}
+        self._contains: list[tuple[str, str]] = []
+        for name, spec in config.get("providers", {}).items():
+            for model in spec.get("models", []):
+                self._exact.setdefault(normalize(model), name)
+            for prefix in spec.get("prefixes", []):
+                self._prefixes.setdefault(normalize(prefix), name)
+            for fragment in spec.get("contains", []):
+                self._contains.append((normalize(fragment), name))
+        # Longest first, so "gpt-4o" can belong to a different provider than "gpt"
+        self._prefix_lengths = sorted({len(prefix) for prefix in self._prefixes}, reverse=True)
+        # Names that get their own metric series; anything matched only by prefix or substring does not
+        self._declared = set(self._exact) | set(self.aliases.values())
+        self.resolve = lru_cache(maxsize=4096)(self._resolve)
+
+    @classmethod
+    def load(cls, path: str) -> "ProviderRegistry":
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def canonical(self, model_name: str) -> str:
+        """
+        The normalized, de-aliased model name (whether or not any provider serves it).
+        """
+        model_name = normalize(model_name)
+        return self.aliases.get(model_name, model_name)
+
+    def _resolve(self, model_name: str) -> tuple[str, str]:
+        model = self.canonical(model_name)
+        provider = self._exact.get(model)
+        if provider is None:
+            provider = next(
+                (self._prefixes[model[:length]] for length in self._prefix_lengths if model[:length] in self._prefixes),
+                None
+            )
+        if provider is None:
+            provider = next((name for fragment, name in self._contains if fragment in model), None)
+        if provider is None:
+            raise ValueError(f"Unsupported model: {model_name}")
+        return model, provider
+
+    def metric_label(self, model_name: str) -> str:
+        """
+        The model's label on metrics: its canonical name if providers.json
+        declares it, "unknown" otherwise, so clients cannot mint new series.
+        """
+        try:
+            model, _ = self.resolve(model_name)
+        except ValueError:
+            return "unknown"
+        return model if model in self._declared else "unknown"
+
+    def provider_for(self, model_name: str) -> str:
+        return self.resolve(model_name)[1]
+
+    def get(self, name: str) -> Provider:
+        return self.providers[name]
+
+
+registry = ProviderRegistry.load(PROVIDERS_CONFIG_PATH)
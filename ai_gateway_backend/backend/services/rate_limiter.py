@@ -0,0 +1,347 @@
+import os
+import time
+import asyncio
+import sqlite3
+import threading
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+
+from backend.db import database
+from backend.services import tokenizer
+from backend.services.providers import Prompt, registry
+
+
+def _parse_rates(value: str) -> dict[str, float]:
+    # "gpt-4=1,claude-3-opus=0.5" -> {"gpt-4": 1.0, "claude-3-opus-20240229": 0.5}; keyed like requests are
+    rates = {}
+    for item in value.split(","):
+        if "=" in item:
+            name, rate = item.rsplit("=", 1)
+            rates[registry.canonical(name)] = float(rate)
+    return rates
+
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "True").lower() == "true"
+# "memory" keeps state per worker; "sqlite" shares it between workers on one host
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_SQLITE_PATH = os.getenv("RATE_LIMIT_SQLITE_PATH", "rate_limits.db")
+# Per-user token buckets, across all models
+USER_REQUESTS_PER_SECOND = float(os.getenv("USER_REQUESTS_PER_SECOND", "5"))
+USER_REQUEST_BURST = float(os.getenv("USER_REQUEST_BURST", "10"))
+USER_TOKENS_PER_MINUTE = float(os.getenv("USER_TOKENS_PER_MINUTE", "100000"))
+# Tighter per-user limits for individual models, e.g. "gpt-4=1"
+MODEL_REQUESTS_PER_SECOND = _parse_rates(os.getenv("MODEL_REQUESTS_PER_SECOND", ""))
+MODEL_TOKENS_PER_MINUTE = _parse_rates(os.getenv("MODEL_TOKENS_PER_MINUTE", ""))
+# Spend caps per user in USD; 0 disables
+USER_DAILY_BUDGET_USD = float(os.getenv("USER_DAILY_BUDGET_USD", "0"))
+USER_MONTHLY_BUDGET_USD = float(os.getenv("USER_MONTHLY_BUDGET_USD", "0"))
+
+
+class RateLimited(Exception):
+    """
+    A request limit, token limit or budget was hit. retry_after is in whole
+    seconds: when the bucket refills or the budget period rolls over.
+    """
+
+    def __init__(self, reason: str, retry_after: float):
+        self.retry_after = max(1, int(retry_after + 0.999))
+        super().__init__(f"{reason}, retry after {self.retry_after}s")
+
+
+class MemoryBackend:
+    """
+    Bucket and spend state for this process only.
+    """
+
+    blocking = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets: dict[str, tuple[float, float]] = {}  # key -> (tokens, updated)
+        self._spend: dict[str, float] = {}
+
+    def take(self, key: str, amount: float, rate: float, capacity: float) -> float:
+        """
+        Takes `amount` from the bucket; returns 0 on success, otherwise the
+        seconds until that much will be available (nothing is taken).
+        """
+        with self._lock:
+            now = time.time()
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            if tokens >= amount:
+                self._buckets[key] = (tokens - amount, now)
+                return 0.0
+            self._buckets[key] = (tokens, now)
+            return (amount - tokens) / rate
+
+    def give(self, key: str, amount: float, capacity: float):
+        with self._lock:
+            if key in self._buckets:
+                tokens, updated = self._buckets[key]
+                self._buckets[key] = (min(capacity, tokens + amount), updated)
+
+    def has_spend(self, key: str) -> bool:
+        return key in self._spend
+
+    def add_spend(self, key: str, amount: float, limit: Optional[float] = None, seed: float = 0.0) -> bool:
+        """
+        Adds `amount` to the key's spend unless that would exceed `limit`.
+        `seed` initialises a key seen for the first time.
+        """
+        with self._lock:
+            spent = self._spend.get(key, seed)
+            if limit is not None and amount > 0 and spent + amount > limit:
+                self._spend[key] = spent
+                return False
+            self._spend[key] = spent + amount
+            return True
+
+
+class SQLiteBackend:
+    """
+    Bucket and spend state in a local SQLite file, so every uvicorn worker on
+    the host enforces the same limits. Each operation is one IMMEDIATE
+    transaction; calls block and are meant to run off the event loop.
+    """
+
+    blocking = True
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS rate_buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS rate_spend (key TEXT PRIMARY KEY, amount REAL NOT NULL)")
+
+    def _transaction(self, fn: Callable):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self._conn)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return result
+
+    def take(self, key: str, amount: float, rate: float, capacity: float) -> float:
+        def take(conn):
+            now = time.time()
+            row = conn.execute("SELECT tokens, updated FROM rate_buckets WHERE key = ?", (key,)).fetchone()
+            tokens, updated = row if row else (capacity, now)
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            wait = 0.0 if tokens >= amount else (amount - tokens) / rate
+            if not wait:
+                tokens -= amount
+            conn.execute("INSERT OR REPLACE INTO rate_buckets VALUES (?, ?, ?)", (key, tokens, now))
+            return wait
+        return self._transaction(take)
+
+    def give(self, key: str, amount: float, capacity: float):
+        self._transaction(lambda conn: conn.execute(
+            "UPDATE rate_buckets SET tokens = MIN(?, tokens + ?) WHERE key = ?", (capacity, amount, key)
+        ))
+
+    def has_spend(self, key: str) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM rate_spend WHERE key = ?", (key,)).fetchone() is not None
+
+    def add_spend(self, key: str, amount: float, limit: Optional[float] = None, seed: float = 0.0) -> bool:
+        def add(conn):
+            row = conn.execute("SELECT amount FROM rate_spend WHERE key = ?", (key,)).fetchone()
+            spent = row[0] if row else seed
+            allowed = limit is None or amount <= 0 or spent + amount <= limit
+            conn.execute("INSERT OR REPLACE INTO rate_spend VALUES (?, ?)", (key, spent + amount if allowed else spent))
+            return allowed
+        return self._transaction(add)
+
+
+def _spent_since(user_id: int, since: datetime) -> float:
+    # Daily rollups rather than usage_log, which may already have been archived
+    row = database.fetch_one(
+        "SELECT SUM(cost_usd) AS spent FROM usage_rollup_daily WHERE user_id = %s AND bucket_start >= %s",
+        (str(user_id), since)
+    )
+    return float(row["spent"] or 0) if row else 0.0
+
+
+def _budget_periods(now: datetime) -> list[tuple[str, datetime, datetime, float]]:
+    # (period name, start, end, budget) for each configured budget
+    day = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    month = day.replace(day=1)
+    next_month = (month + timedelta(days=32)).replace(day=1)
+    periods = []
+    if USER_DAILY_BUDGET_USD > 0:
+        periods.append((f"day:{day:%Y-%m-%d}", day, day + timedelta(days=1), USER_DAILY_BUDGET_USD))
+    if USER_MONTHLY_BUDGET_USD > 0:
+        periods.append((f"month:{month:%Y-%m}", month, next_month, USER_MONTHLY_BUDGET_USD))
+    return periods
+
+
+@dataclass
+class Reservation:
+    """
+    What a request was charged up front; settle() trues it up once the
+    actual usage is known.
+    """
+    user_id: int
+    model_name: str
+    tokens: float = 0.0
+    cost: float = 0.0
+    spend_keys: list = field(default_factory=list)
+    settled: bool = False
+
+
+class RateLimiter:
+    """
+    Per-user request and token buckets (optionally tightened per model) and
+    daily/monthly USD budgets, checked before any upstream call.
+
+    reserve() charges the prompt plus max_tokens against the token buckets
+    and the worst-case cost against the budgets; settle() refunds whatever
+    the request did not use. Budget spend is seeded from the daily rollups
+    the first time a user/period is seen, so it survives restarts.
+    """
+
+    def __init__(self, backend=None):
+        if backend is None:
+            backend = SQLiteBackend(RATE_LIMIT_SQLITE_PATH) if RATE_LIMIT_BACKEND == "sqlite" else MemoryBackend()
+        self._backend = backend
+        self.allowed = 0
+        self.limited = 0
+        self.over_budget = 0
+
+    async def _call(self, fn: Callable, *args):
+        if self._backend.blocking:
+            return await asyncio.to_thread(fn, *args)
+        return fn(*args)
+
+    def _buckets(self, user_id: int, model_name: str, tokens: float,
+                 requests: int = 1) -> list[tuple[str, str, float, float, float]]:
+        # (description, key, amount, refill rate per second, capacity); request buckets are left out for requests=0
+        buckets = [
+            ("request rate", f"rps:{user_id}", requests, USER_REQUESTS_PER_SECOND, USER_REQUEST_BURST),
+            ("token rate", f"tpm:{user_id}", tokens, USER_TOKENS_PER_MINUTE / 60, USER_TOKENS_PER_MINUTE),
+        ]
+        if model_name in MODEL_REQUESTS_PER_SECOND:
+            rate = MODEL_REQUESTS_PER_SECOND[model_name]
+            buckets.append((f"{model_name} request rate", f"rps:{user_id}:{model_name}", requests, rate,
+                            max(1.0, rate)))
+        if model_name in MODEL_TOKENS_PER_MINUTE:
+            rate = MODEL_TOKENS_PER_MINUTE[model_name]
+            buckets.append((f"{model_name} token rate", f"tpm:{user_id}:{model_name}", tokens, rate / 60, rate))
+        # A single request larger than a bucket could never pass; cap it at the bucket size
+        return [(what, key, min(amount, capacity), rate, capacity)
+                for what, key, amount, rate, capacity in buckets if rate > 0 and amount > 0]
+
+    async def reserve_requests(self, user_id: int, model_names: set[str]):
+        """
+        Charges one request against the request-rate buckets for a whole
+        batch: the user's, and each listed model's that has one. Its items
+        then reserve with requests=0 and are limited by tokens and budget only.
+        """
+        if not RATE_LIMIT_ENABLED:
+            return
+        models = set()
+        for model_name in model_names:
+            try:
+                models.add(registry.resolve(model_name)[0])
+            except ValueError:
+                # Its items fail on their own with a 400
+                pass
+        buckets = {}
+        # With no valid model at all, only the user's own request bucket
+        for model in models or {""}:
+            for what, key, amount, rate, capacity in self._buckets(user_id, model, 0):
+                buckets[key] = (what, key, amount, rate, capacity)
+        taken = []
+        try:
+            for what, key, amount, rate, capacity in buckets.values():
+                wait = await self._call(self._backend.take, key, amount, rate, capacity)
+                if wait:
+                    self.limited += 1
+                    raise RateLimited(f"Rate limit exceeded ({what})", wait)
+                taken.append((key, amount, capacity))
+        except RateLimited:
+            for key, amount, capacity in taken:
+                await self._call(self._backend.give, key, amount, capacity)
+            raise
+
+    async def reserve(self, user_id: int, model_name: str, prompt: Prompt, max_tokens: int,
+                      requests: int = 1) -> Reservation:
+        """
+        Raises RateLimited if any bucket or budget would be exceeded; nothing
+        is charged in that case. Raises tokenizer.PromptRejected, before any
+        bucket is touched, for a prompt too large for the model or too costly.
+        """
+        # Locally counted prompt size plus the most the completion may use, at its worst-case cost
+        estimate = tokenizer.preflight(model_name, prompt, max_tokens)
+        # Per-model buckets are keyed on the canonical model, however the request spelled it
+        model_name = estimate.model_name
+        reservation = Reservation(user_id, model_name, tokens=estimate.input_tokens + max_tokens)
+        if not RATE_LIMIT_ENABLED:
+            return reservation
+
+        taken = []
+        try:
+            for what, key, amount, rate, capacity in self._buckets(user_id, model_name, reservation.tokens, requests):
+                wait = await self._call(self._backend.take, key, amount, rate, capacity)
+                if wait:
+                    self.limited += 1
+                    raise RateLimited(f"Rate limit exceeded ({what})", wait)
+                taken.append((key, amount, capacity))
+
+            cost = estimate.max_cost_usd
+            now = datetime.utcnow()
+            for period, start, end, budget in _budget_periods(now):
+                key = f"spend:{user_id}:{period}"
+                seed = 0.0
+                if not await self._call(self._backend.has_spend, key):
+                    seed = await database.run(_spent_since, user_id, start)
+                if not await self._call(self._backend.add_spend, key, cost, budget, seed):
+                    self.over_budget += 1
+                    raise RateLimited(f"Budget of ${budget:g} per {period.split(':')[0]} exhausted",
+                                      (end - now).total_seconds())
+                reservation.spend_keys.append(key)
+                reservation.cost = cost
+        except RateLimited:
+            for key, amount, capacity in taken:
+                await self._call(self._backend.give, key, amount, capacity)
+            for key in reservation.spend_keys:
+                await self._call(self._backend.add_spend, key, -cost)
+            raise
+        self.allowed += 1
+        return reservation
+
+    async def settle(self, reservation: Reservation, input_tokens: int = 0, output_tokens: int = 0,
+                     cost_usd: float = 0.0):
+        """
+        Refunds the unused part of a reservation. Pass zero usage for a
+        request that never reached upstream (failed, coalesced or cached).
+        """
+        if reservation.settled or not RATE_LIMIT_ENABLED:
+            return
+        reservation.settled = True
+        unused = reservation.tokens - (input_tokens + output_tokens)
+        if unused > 0:
+            for _, key, amount, _, capacity in self._buckets(reservation.user_id, reservation.model_name, unused):
+                if key.startswith("tpm:"):
+                    await self._call(self._backend.give, key, amount, capacity)
+        for key in reservation.spend_keys:
+            await self._call(self._backend.add_spend, key, cost_usd - reservation.cost)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": RATE_LIMIT_ENABLED,
+            "backend": RATE_LIMIT_BACKEND,
+            "allowed": self.allowed,
+            "rate_limited": self.limited,
+            "over_budget": self.over_budget,
+        }
+
+
+rate_limiter = RateLimiter()
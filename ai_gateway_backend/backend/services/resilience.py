@@ -0,0 +1,151 @@
+import os
+import time
+import random
+import asyncio
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Mapping, Optional, TypeVar
+
+# Default and maximum time a /generate request may take end to end, in seconds
+GENERATE_DEADLINE = float(os.getenv("GENERATE_DEADLINE", "60"))
+GENERATE_DEADLINE_MAX = float(os.getenv("GENERATE_DEADLINE_MAX", "300"))
+# Cap on a single upstream attempt, so a hung call can still be retried within the deadline
+PROVIDER_ATTEMPT_TIMEOUT = float(os.getenv("PROVIDER_ATTEMPT_TIMEOUT", "30"))
+PROVIDER_MAX_RETRIES = int(os.getenv("PROVIDER_MAX_RETRIES", "3"))
+PROVIDER_RETRY_BASE = float(os.getenv("PROVIDER_RETRY_BASE", "0.25"))
+# Longest wait before a retry; a longer Retry-After is left to the router's fallbacks instead
+PROVIDER_RETRY_MAX = float(os.getenv("PROVIDER_RETRY_MAX", "8"))
+
+T = TypeVar("T")
+
+
+class DeadlineExceeded(Exception):
+    """
+    The request's deadline passed before an upstream call could complete.
+    """
+
+
+class Deadline:
+    """
+    A point in time by which a request must be answered, created when the
+    request arrives and passed down to every upstream call it makes.
+    """
+
+    def __init__(self, expires_at: float):
+        self.expires_at = expires_at
+
+    @classmethod
+    def after(cls, seconds: Optional[float] = None) -> "Deadline":
+        seconds = GENERATE_DEADLINE if seconds is None else min(seconds, GENERATE_DEADLINE_MAX)
+        return cls(time.monotonic() + seconds)
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def check(self):
+        if self.remaining() <= 0:
+            raise DeadlineExceeded("Request deadline exceeded")
+
+
+class ProviderError(Exception):
+    """
+    An upstream call failed. `retryable` errors (timeouts, 429, 5xx,
+    connection failures) may succeed if tried again, after `retry_after`
+    seconds when the provider said so.
+    """
+
+    retryable = False
+
+    def __init__(self, provider: str, message: str, status: Optional[int] = None,
+                 retry_after: Optional[float] = None):
+        super().__init__(f"{provider} API call failed: {message}")
+        self.provider = provider
+        self.status = status
+        self.retry_after = retry_after
+
+
+class ProviderTimeout(ProviderError):
+    retryable = True
+
+
+class ProviderUnavailable(ProviderError):
+    # 5xx, 429 or a connection failure
+    retryable = True
+
+
+class ProviderRejected(ProviderError):
+    # Any other 4xx, or a response that could not be understood
+    pass
+
+
+class ProviderNotConfigured(ProviderError):
+    pass
+
+
+def classify_status(provider: str, status: int, message: str,
+                    headers: Optional[Mapping[str, str]] = None) -> ProviderError:
+    """
+    The typed error for an upstream HTTP error status.
+    """
+    retry_after = parse_retry_after(headers)
+    if status in (408, 409, 429) or status >= 500:
+        return ProviderUnavailable(provider, message, status, retry_after)
+    return ProviderRejected(provider, message, status, retry_after)
+
+
+def parse_retry_after(headers: Optional[Mapping[str, str]]) -> Optional[float]:
+    # Retry-After is delta-seconds or an HTTP date; retry-after-ms is a common extension
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return max(0.0, float(value) / 1000)
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff(attempt: int) -> float:
+    # Full jitter: uniform over [0, base * 2^attempt], capped
+    return random.uniform(0, min(PROVIDER_RETRY_MAX, PROVIDER_RETRY_BASE * 2 ** attempt))
+
+
+async def call_with_retries(attempt: Callable[[float], Awaitable[T]], deadline: Deadline,
+                            provider: str) -> T:
+    """
+    Calls `attempt(timeout)` until it succeeds, retrying retryable
+    ProviderErrors with jittered exponential backoff (or the provider's
+    Retry-After). Gives up with the last error once PROVIDER_MAX_RETRIES is
+    reached, the provider asks for more than PROVIDER_RETRY_MAX seconds, or
+    the next try could not start before the deadline.
+    """
+    tries = 0
+    while True:
+        deadline.check()
+        timeout = min(PROVIDER_ATTEMPT_TIMEOUT, deadline.remaining())
+        try:
+            return await asyncio.wait_for(attempt(timeout), timeout)
+        except asyncio.TimeoutError:
+            if deadline.remaining() <= 0:
+                raise DeadlineExceeded(f"Request deadline exceeded waiting for {provider}")
+            error = ProviderTimeout(provider, f"no response within {timeout:.1f}s")
+        except ProviderError as e:
+            error = e
+        if not error.retryable or tries >= PROVIDER_MAX_RETRIES:
+            raise error
+        delay = error.retry_after if error.retry_after is not None else backoff(tries)
+        if delay > PROVIDER_RETRY_MAX or delay >= deadline.remaining():
+            raise error
+        tries += 1
+        await asyncio.sleep(delay)
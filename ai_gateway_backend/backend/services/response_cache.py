@@ -0,0 +1,161 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from backend.services.providers import registry
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "True").lower() == "true"
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "10000"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+# Set to a file path to keep cached responses across restarts
+RESPONSE_CACHE_DISK_PATH = os.getenv("RESPONSE_CACHE_DISK_PATH", "")
+RESPONSE_CACHE_DISK_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_DISK_MAX_ENTRIES", "1000000"))
+
+
+def make_cache_key(model_name: str, prompt: str, **params) -> str:
+    """
+    Exact-match key over the canonical model name, the prompt and the
+    generation parameters.
+    """
+    material = json.dumps([registry.canonical(model_name), prompt, params], sort_keys=True)
+    return hashlib.sha256(material.encode()).hexdigest()
+
+
+class _DiskTier:
+    """
+    SQLite-backed second tier. Calls are blocking and meant to run off the event loop.
+    """
+
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path: str, max_entries: int):
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS response_cache (
+                cache_key TEXT PRIMARY KEY,
+                content TEXT NOT NULL,
+                input_tokens INT NOT NULL,
+                output_tokens INT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_expires ON response_cache (expires_at)")
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[tuple]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT content, input_tokens, output_tokens, expires_at FROM response_cache WHERE cache_key = ?",
+                (key,)
+            ).fetchone()
+        if row is None or row[3] <= time.time():
+            return None
+        return row
+
+    def set(self, key: str, value: tuple, expires_at: float):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?, ?)",
+                (key, value[0], value[1], value[2], expires_at)
+            )
+            self._writes += 1
+            if self._writes % self.PRUNE_EVERY == 0:
+                self._prune()
+            self._conn.commit()
+
+    def _prune(self):
+        self._conn.execute("DELETE FROM response_cache WHERE expires_at <= ?", (time.time(),))
+        self._conn.execute(
+            """
+            DELETE FROM response_cache WHERE cache_key IN (
+                SELECT cache_key FROM response_cache ORDER BY expires_at DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (self._max_entries,)
+        )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class ResponseCache:
+    """
+    Exact-match cache of completed generations: an in-memory LRU tier with a
+    TTL, optionally backed by a disk tier that survives restarts. Values are
+    (content, input_tokens, output_tokens) as returned by route_model.
+    """
+
+    def __init__(self, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES, ttl: float = RESPONSE_CACHE_TTL,
+                 disk_path: str = RESPONSE_CACHE_DISK_PATH):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._entries: OrderedDict = OrderedDict()  # key -> (value, expires_at)
+        self._disk = _DiskTier(disk_path, RESPONSE_CACHE_DISK_MAX_ENTRIES) if disk_path else None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def get(self, key: str) -> Optional[tuple[str, int, int]]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, expires_at = entry
+            if time.time() < expires_at:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+        if self._disk is not None:
+            row = await asyncio.to_thread(self._disk.get, key)
+            if row is not None:
+                value = (row[0], row[1], row[2])
+                self._put_memory(key, value, row[3])
+                self.disk_hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, value: tuple[str, int, int]):
+        expires_at = time.time() + self._ttl
+        self._put_memory(key, value, expires_at)
+        if self._disk is not None:
+            await asyncio.to_thread(self._disk.set, key, value, expires_at)
+
+    def _put_memory(self, key: str, value: tuple, expires_at: float):
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def close(self):
+        if self._disk is not None:
+            self._disk.close()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "enabled": RESPONSE_CACHE_ENABLED,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_ratio": round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+
+response_cache = ResponseCache()
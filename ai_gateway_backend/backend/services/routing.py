@@ -0,0 +1,324 @@
+import os
+import json
+import time
+import asyncio
+from contextlib import nullcontext
+from typing import Any, AsyncContextManager, AsyncIterator, Awaitable, Callable, Optional
+
+from backend.services.resilience import DeadlineExceeded, ProviderNotConfigured, ProviderRejected, ProviderUnavailable
+
+ROUTING_POLICY_PATH = os.getenv(
+    "ROUTING_POLICY_PATH", os.path.join(os.path.dirname(os.path.dirname(__file__)), "routing_policy.json")
+)
+# Breaker trips after this many consecutive failures, or when the EWMA error
+# rate crosses BREAKER_ERROR_RATE once at least BREAKER_MIN_SAMPLES calls were seen
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_ERROR_RATE = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+BREAKER_MIN_SAMPLES = int(os.getenv("BREAKER_MIN_SAMPLES", "20"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))
+EWMA_ALPHA = float(os.getenv("ROUTING_EWMA_ALPHA", "0.2"))
+
+# The request's fault, its time budget or the gateway's configuration, not the provider's health:
+# never counted against the breaker and never retried on another candidate
+_NOT_PROVIDER_FAULTS = (ValueError, DeadlineExceeded, ProviderRejected, ProviderNotConfigured)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class ProviderHealth:
+    """
+    EWMA latency / error rate for one provider, plus its circuit breaker.
+
+    An open breaker rejects traffic for BREAKER_COOLDOWN seconds, then lets a
+    single probe call through (half-open); the probe's outcome closes or
+    re-opens it.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.ewma_latency: Optional[float] = None
+        self.ewma_error_rate = 0.0
+        self.samples = 0
+        self.consecutive_failures = 0
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.probing = False
+
+    def cooldown_remaining(self) -> float:
+        # Seconds until an open breaker lets a probe through; 0 once it is half-open
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, BREAKER_COOLDOWN - (time.monotonic() - self.opened_at))
+
+    def is_available(self) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and time.monotonic() - self.opened_at >= BREAKER_COOLDOWN:
+            self.state = HALF_OPEN
+        return self.state == HALF_OPEN and not self.probing
+
+    def begin(self):
+        if self.state != CLOSED:
+            self.probing = True
+
+    def record_success(self, latency: float):
+        self.samples += 1
+        self.ewma_latency = latency if self.ewma_latency is None else (
+            EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * self.ewma_latency
+        )
+        self.ewma_error_rate = (1 - EWMA_ALPHA) * self.ewma_error_rate
+        self.consecutive_failures = 0
+        self.state = CLOSED
+        self.probing = False
+
+    def record_failure(self):
+        self.samples += 1
+        self.ewma_error_rate = EWMA_ALPHA + (1 - EWMA_ALPHA) * self.ewma_error_rate
+        self.consecutive_failures += 1
+        tripped = (
+            self.consecutive_failures >= BREAKER_FAILURE_THRESHOLD
+            or (self.samples >= BREAKER_MIN_SAMPLES and self.ewma_error_rate >= BREAKER_ERROR_RATE)
+        )
+        if self.state == HALF_OPEN or tripped:
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+    def record_cancelled(self):
+        # A hedge loser or abandoned call tells us nothing about health
+        self.probing = False
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "ewma_latency_s": round(self.ewma_latency, 4) if self.ewma_latency is not None else None,
+            "ewma_error_rate": round(self.ewma_error_rate, 4),
+            "consecutive_failures": self.consecutive_failures,
+            "samples": self.samples,
+        }
+
+
+class RoutingPolicy:
+    """
+    Declarative routing rules, loaded from JSON:
+
+        {
+          "equivalence_groups": [["gpt-4", "claude-3-opus-20240229"], ...],
+          "fallbacks": {"gpt-4": ["claude-3-opus-20240229"]},
+          "hedging": {"enabled": false, "after_ms": 3000, "models": {"gpt-4": 5000}}
+        }
+
+    Explicit fallback chains win; otherwise a model falls back to the other
+    members of its equivalence group. Hedging sends a second request to the
+    next candidate once the first has been running for after_ms.
+
+    Fallback to another vendor's model is opt-in: the shipped
+    routing_policy.json declares none, routing_policy.example.json shows how.
+    """
+
+    def __init__(self, config: dict):
+        self.equivalents: dict[str, list[str]] = {}
+        for group in config.get("equivalence_groups", []):
+            group = [model.lower() for model in group]
+            for model in group:
+                self.equivalents[model] = [other for other in group if other != model]
+        self.fallbacks = {
+            model.lower(): [other.lower() for other in chain]
+            for model, chain in config.get("fallbacks", {}).items()
+        }
+        hedging = config.get("hedging", {})
+        self.hedging_enabled = bool(hedging.get("enabled", False))
+        self.hedge_after_ms = hedging.get("after_ms")
+        self.hedge_after_ms_by_model = {model.lower(): ms for model, ms in hedging.get("models", {}).items()}
+
+    @classmethod
+    def load(cls, path: str) -> "RoutingPolicy":
+        if not os.path.exists(path):
+            return cls({})
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def alternatives(self, model: str) -> list[str]:
+        if model in self.fallbacks:
+            return self.fallbacks[model]
+        return self.equivalents.get(model, [])
+
+    def hedge_delay(self, model: str) -> Optional[float]:
+        if not self.hedging_enabled:
+            return None
+        ms = self.hedge_after_ms_by_model.get(model, self.hedge_after_ms)
+        return ms / 1000 if ms is not None else None
+
+
+class Router:
+    """
+    Runs a model call with breaker-aware fallback and optional hedging.
+    `provider_for` maps a model name to the provider whose health it shares;
+    `admit(model, priority)`, if given, returns an async context manager held
+    around each upstream call (e.g. a concurrency slot). Admission failures
+    are not counted against the provider's health.
+    """
+
+    def __init__(self, provider_for: Callable[[str], str], policy: RoutingPolicy,
+                 admit: Optional[Callable[[str, str], AsyncContextManager]] = None):
+        self._provider_for = provider_for
+        self.policy = policy
+        self._admit = admit or (lambda model, priority: nullcontext())
+        self._health: dict[str, ProviderHealth] = {}
+        self.fallbacks = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def health(self, model: str) -> ProviderHealth:
+        provider = self._provider_for(model)
+        if provider not in self._health:
+            self._health[provider] = ProviderHealth(provider)
+        return self._health[provider]
+
+    def candidates(self, model: str) -> list[str]:
+        """
+        The requested model followed by its alternatives (explicit chains in
+        order, group members fastest-first), minus any whose breaker is open.
+        Raises a retryable ProviderUnavailable, with Retry-After set to the
+        shortest remaining cooldown, if every breaker is open: calls are shed
+        rather than sent to a provider that would keep its breaker open.
+        """
+        alternatives = [other for other in self.policy.alternatives(model) if other != model and self._routable(other)]
+        if model not in self.policy.fallbacks:
+            alternatives.sort(key=self._latency_rank)
+        chain = [model] + alternatives
+        available = [candidate for candidate in chain if self.health(candidate).is_available()]
+        if not available:
+            # A half-open breaker whose probe is in flight has no cooldown left; ask for a second
+            retry_after = max(1.0, min(self.health(candidate).cooldown_remaining() for candidate in chain))
+            raise ProviderUnavailable(self._provider_for(model), "circuit breaker open", 503, retry_after)
+        return available
+
+    def _routable(self, model: str) -> bool:
+        try:
+            self._provider_for(model)
+            return True
+        except ValueError:
+            print(f"Routing policy names unsupported model: {model}")
+            return False
+
+    def _latency_rank(self, model: str) -> float:
+        latency = self.health(model).ewma_latency
+        return latency if latency is not None else 0.0
+
+    async def _observed(self, model: str, call: Callable[[str], Awaitable[Any]], priority: str):
+        async with self._admit(model, priority):
+            health = self.health(model)
+            health.begin()
+            start = time.monotonic()
+            try:
+                result = await call(model)
+            except asyncio.CancelledError:
+                health.record_cancelled()
+                raise
+            except _NOT_PROVIDER_FAULTS:
+                health.record_cancelled()
+                raise
+            except Exception:
+                health.record_failure()
+                raise
+            health.record_success(time.monotonic() - start)
+            return result
+
+    async def _hedged(self, primary: str, hedge: Optional[str], call: Callable[[str], Awaitable[Any]], priority: str):
+        delay = self.policy.hedge_delay(primary)
+        if hedge is None or delay is None:
+            return await self._observed(primary, call, priority)
+
+        first = asyncio.ensure_future(self._observed(primary, call, priority))
+        pending = {first}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if done and first.exception() is None:
+                return first.result()
+            if done and isinstance(first.exception(), _NOT_PROVIDER_FAULTS):
+                raise first.exception()
+            if done:
+                # Primary failed before the hedge was due; the hedge target is the plain fallback
+                self.fallbacks += 1
+            else:
+                self.hedges += 1
+            second = asyncio.ensure_future(self._observed(hedge, call, priority))
+            pending.add(second)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def run(self, model: str, call: Callable[[str], Awaitable[Any]], priority: str = "interactive"):
+        """
+        Calls `call(candidate)` for the best available candidate, hedging to
+        the next one if configured, and falling through the chain on errors.
+        """
+        candidates = self.candidates(model)
+        tried = set()
+        error = None
+        for index, candidate in enumerate(candidates):
+            if candidate in tried:
+                continue
+            hedge = next((other for other in candidates[index + 1:] if other not in tried), None)
+            if hedge is not None and self.policy.hedge_delay(candidate) is not None:
+                tried.add(hedge)
+            tried.add(candidate)
+            if index > 0:
+                self.fallbacks += 1
+            try:
+                return await self._hedged(candidate, hedge, call, priority)
+            except _NOT_PROVIDER_FAULTS:
+                raise
+            except Exception as e:
+                error = e
+        raise error
+
+    async def observe_stream(self, model: str, chunks: AsyncIterator, priority: str = "interactive") -> AsyncIterator:
+        """
+        Passes a provider stream through, recording its total latency or
+        failure. Admission is held until the stream is finished or closed.
+        """
+        try:
+            async with self._admit(model, priority):
+                health = self.health(model)
+                health.begin()
+                start = time.monotonic()
+                completed = False
+                try:
+                    async for chunk in chunks:
+                        yield chunk
+                    completed = True
+                except _NOT_PROVIDER_FAULTS:
+                    health.record_cancelled()
+                    raise
+                except Exception:
+                    health.record_failure()
+                    raise
+                finally:
+                    if completed:
+                        health.record_success(time.monotonic() - start)
+                    elif health.probing:
+                        health.record_cancelled()
+        finally:
+            await chunks.aclose()
+
+    def stats(self) -> dict:
+        return {
+            "providers": {name: health.stats() for name, health in self._health.items()},
+            "fallbacks": self.fallbacks,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+        }
@@ -0,0 +1,202 @@
+import os
+import math
+import time
+import heapq
+import asyncio
+import itertools
+from contextlib import asynccontextmanager
+from typing import Optional
+
+
+def _parse_limits(value: str) -> dict[str, int]:
+    # "openai=32,anthropic=16" -> {"openai": 32, "anthropic": 16}
+    limits = {}
+    for item in value.split(","):
+        if "=" in item:
+            name, limit = item.rsplit("=", 1)
+            limits[name.strip().lower()] = int(limit)
+    return limits
+
+
+# Concurrent upstream calls allowed per provider, and optionally per model on top of that
+PROVIDER_CONCURRENCY_DEFAULT = int(os.getenv("PROVIDER_CONCURRENCY_DEFAULT", "16"))
+PROVIDER_CONCURRENCY_LIMITS = _parse_limits(os.getenv("PROVIDER_CONCURRENCY_LIMITS", ""))
+MODEL_CONCURRENCY_LIMITS = _parse_limits(os.getenv("MODEL_CONCURRENCY_LIMITS", ""))
+# Callers waiting for a slot, per provider/model; beyond this requests are rejected outright
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", "100"))
+# How long each priority class may wait for a slot before giving up
+SCHEDULER_MAX_WAIT = {
+    "interactive": float(os.getenv("SCHEDULER_INTERACTIVE_MAX_WAIT", "10")),
+    "batch": float(os.getenv("SCHEDULER_BATCH_MAX_WAIT", "120")),
+}
+PRIORITIES = {"interactive": 0, "batch": 1}
+EWMA_ALPHA = 0.2
+
+
+class Overloaded(Exception):
+    """
+    No slot could be had for a provider or model: the queue was full or the
+    wait ran past the deadline. retry_after is a hint in whole seconds.
+    """
+
+    def __init__(self, name: str, retry_after: int):
+        super().__init__(f"{name} is overloaded, retry after {retry_after}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class _Limiter:
+    """
+    A counting semaphore with a bounded priority queue. Freed slots are
+    handed directly to the best waiter (lowest priority value, then FIFO),
+    so a new arrival cannot overtake the queue.
+    """
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = limit
+        self.active = 0
+        self._waiters: list = []  # heap of (priority, seq, future)
+        self._seq = itertools.count()
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.ewma_wait: Optional[float] = None
+        self.max_wait = 0.0
+        self.ewma_service: Optional[float] = None
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def retry_after(self) -> int:
+        # Time for the queue ahead to drain through the available slots
+        service = self.ewma_service or 1.0
+        return max(1, math.ceil(service * (self.queued + 1) / self.limit))
+
+    async def acquire(self, priority: int, timeout: float):
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            self._admitted(0.0)
+            return
+        if self.queued >= SCHEDULER_MAX_QUEUE:
+            self.rejected += 1
+            raise Overloaded(self.name, self.retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._seq), future)
+        heapq.heappush(self._waiters, entry)
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self._abandon(entry)
+            self.timed_out += 1
+            raise Overloaded(self.name, self.retry_after())
+        except asyncio.CancelledError:
+            self._abandon(entry)
+            raise
+        self._admitted(time.monotonic() - start)
+
+    def _abandon(self, entry: tuple):
+        future = entry[2]
+        if future.done() and not future.cancelled():
+            # The slot was handed over just as we gave up; pass it on
+            self.release()
+        elif entry in self._waiters:
+            self._waiters.remove(entry)
+            heapq.heapify(self._waiters)
+
+    def _admitted(self, waited: float):
+        self.admitted += 1
+        self.ewma_wait = waited if self.ewma_wait is None else (
+            EWMA_ALPHA * waited + (1 - EWMA_ALPHA) * self.ewma_wait
+        )
+        self.max_wait = max(self.max_wait, waited)
+
+    def release(self, service_time: Optional[float] = None):
+        if service_time is not None:
+            self.ewma_service = service_time if self.ewma_service is None else (
+                EWMA_ALPHA * service_time + (1 - EWMA_ALPHA) * self.ewma_service
+            )
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "ewma_wait_s": round(self.ewma_wait, 4) if self.ewma_wait is not None else None,
+            "max_wait_s": round(self.max_wait, 4),
+            "ewma_service_s": round(self.ewma_service, 4) if self.ewma_service is not None else None,
+        }
+
+
+class Scheduler:
+    """
+    Caps concurrent upstream calls per provider (and per model where a model
+    limit is configured). Callers over the cap queue by priority class for up
+    to that class's max wait; a full queue or an expired wait raises
+    Overloaded instead of letting requests pile up.
+    """
+
+    def __init__(self):
+        self._providers: dict[str, _Limiter] = {}
+        self._models: dict[str, _Limiter] = {}
+
+    def _provider_limiter(self, provider: str) -> _Limiter:
+        if provider not in self._providers:
+            limit = PROVIDER_CONCURRENCY_LIMITS.get(provider, PROVIDER_CONCURRENCY_DEFAULT)
+            self._providers[provider] = _Limiter(provider, limit)
+        return self._providers[provider]
+
+    def _model_limiter(self, model: str) -> Optional[_Limiter]:
+        if model not in MODEL_CONCURRENCY_LIMITS:
+            return None
+        if model not in self._models:
+            self._models[model] = _Limiter(model, MODEL_CONCURRENCY_LIMITS[model])
+        return self._models[model]
+
+    @asynccontextmanager
+    async def slot(self, provider: str, model: str, priority: str = "interactive"):
+        """
+        Holds one provider slot (and model slot, if limited) for the duration
+        of the block. The deadline covers waiting for both.
+        """
+        deadline = time.monotonic() + SCHEDULER_MAX_WAIT[priority]
+        rank = PRIORITIES[priority]
+        # Always model first, then provider, so waiters never hold one while blocking on the other in reverse
+        limiters = [limiter for limiter in (self._model_limiter(model), self._provider_limiter(provider)) if limiter]
+        held = []
+        try:
+            for limiter in limiters:
+                await limiter.acquire(rank, max(0.0, deadline - time.monotonic()))
+                held.append(limiter)
+            start = time.monotonic()
+        except BaseException:
+            for limiter in reversed(held):
+                limiter.release()
+            raise
+        try:
+            yield
+        finally:
+            service_time = time.monotonic() - start
+            for limiter in reversed(held):
+                limiter.release(service_time)
+
+    def stats(self) -> dict:
+        return {
+            "providers": {name: limiter.stats() for name, limiter in self._providers.items()},
+            "models": {name: limiter.stats() for name, limiter in self._models.items()},
+        }
+
+
+scheduler = Scheduler()
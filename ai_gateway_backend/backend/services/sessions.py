@@ -0,0 +1,252 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import sqlite3
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field, asdict
+from typing import Optional
+
+# Sessions kept in memory; the least recently used beyond this are spilled to disk, or dropped without one
+SESSION_MAX_IN_MEMORY = int(os.getenv("SESSION_MAX_IN_MEMORY", "1000"))
+# Set to a file path to spill sessions to SQLite and keep them across restarts
+SESSION_DISK_PATH = os.getenv("SESSION_DISK_PATH", "")
+# Sessions idle for longer than this are gone
+SESSION_TTL = float(os.getenv("SESSION_TTL", str(24 * 3600)))
+# History beyond this many messages is trimmed, oldest first
+SESSION_MAX_MESSAGES = int(os.getenv("SESSION_MAX_MESSAGES", "200"))
+
+
+@dataclass
+class Session:
+    session_id: str
+    user_id: int
+    model_name: str
+    system: Optional[str] = None
+    messages: list[dict] = field(default_factory=list)
+    created_at: float = field(default_factory=time.time)
+    updated_at: float = field(default_factory=time.time)
+    turns: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cached_input_tokens: int = 0
+    cost_usd: float = 0.0
+
+    def prompt(self, content: str) -> list[dict]:
+        """
+        The full conversation for the next turn. Earlier turns are sent
+        exactly as before, so the provider sees the same prefix every time
+        and can serve it from its prompt cache.
+        """
+        system = [{"role": "system", "content": self.system}] if self.system else []
+        return system + self.messages + [{"role": "user", "content": content}]
+
+    def add_turn(self, content: str, reply: str, input_tokens: int, output_tokens: int,
+                 cached_input_tokens: int, cost_usd: float):
+        self.messages.append({"role": "user", "content": content})
+        self.messages.append({"role": "assistant", "content": reply})
+        if len(self.messages) > SESSION_MAX_MESSAGES:
+            # Trimmed by half at once rather than a turn at a time: every trim changes
+            # the prefix and costs a cache miss, so it should happen rarely
+            keep = max(2, SESSION_MAX_MESSAGES // 2) // 2 * 2
+            self.messages = self.messages[-keep:]
+        self.turns += 1
+        self.input_tokens += input_tokens
+        self.output_tokens += output_tokens
+        self.cached_input_tokens += cached_input_tokens
+        self.cost_usd = round(self.cost_usd + cost_usd, 6)
+        self.updated_at = time.time()
+
+    def expired(self, now: float) -> bool:
+        return now - self.updated_at > SESSION_TTL
+
+
+class _DiskStore:
+    """
+    SQLite-backed spill store. Calls are blocking and meant to run off the event loop.
+    """
+
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                user_id INT NOT NULL,
+                data TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions (updated_at)")
+        self._conn.commit()
+
+    def take(self, session_id: str) -> Optional[Session]:
+        # Loads and removes a session: it lives in memory from here on
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            self._conn.commit()
+        return Session(**json.loads(row[0]))
+
+    def put_many(self, sessions: list[Session]):
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)",
+                [(session.session_id, session.user_id, json.dumps(asdict(session)), session.updated_at)
+                 for session in sessions]
+            )
+            self._writes += len(sessions)
+            if self._writes >= self.PRUNE_EVERY:
+                self._writes = 0
+                self._conn.execute("DELETE FROM sessions WHERE updated_at < ?", (time.time() - SESSION_TTL,))
+            self._conn.commit()
+
+    def delete(self, session_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            self._conn.commit()
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class SessionStore:
+    """
+    Conversations kept in the gateway, so clients send only the new turn.
+    Each session is either in the in-memory LRU tier or, once evicted, in
+    the disk store; loading it from disk moves it back into memory. Turns of
+    one session are serialized by a per-session lock.
+
+    Sessions are per worker process: with several uvicorn workers, a turn
+    can reach a worker that does not hold the session and gets a 404. Run a
+    single worker, or route clients to workers by session id. A shared
+    SESSION_DISK_PATH does not help while a session is in another worker's
+    memory.
+    """
+
+    def __init__(self, max_in_memory: int = SESSION_MAX_IN_MEMORY, disk_path: str = SESSION_DISK_PATH):
+        self._max_in_memory = max_in_memory
+        self._disk_path = disk_path
+        self._sessions: OrderedDict[str, Session] = OrderedDict()
+        self._locks: dict[str, asyncio.Lock] = {}
+        self._disk: Optional[_DiskStore] = None
+        self.created = 0
+        self.disk_loads = 0
+        self.spilled = 0
+        self.dropped = 0
+
+    async def create(self, user_id: int, model_name: str, system: Optional[str] = None) -> Session:
+        session = Session(uuid.uuid4().hex, user_id, model_name, system)
+        self.created += 1
+        await self._insert(session)
+        return session
+
+    def start(self):
+        # Opened from the startup hook, so importing the module creates no file
+        if self._disk_path and self._disk is None:
+            self._disk = _DiskStore(self._disk_path)
+
+    def lock(self, session_id: str) -> asyncio.Lock:
+        """
+        The session's turn lock. Only take it for a session that exists:
+        locks are dropped when their session is deleted, expires or is evicted.
+        """
+        lock = self._locks.get(session_id)
+        if lock is None:
+            lock = self._locks[session_id] = asyncio.Lock()
+        return lock
+
+    async def get(self, session_id: str, user_id: int) -> Optional[Session]:
+        """
+        The user's session, or None if it does not exist, has expired or
+        belongs to someone else.
+        """
+        session = self._sessions.get(session_id)
+        if session is not None:
+            self._sessions.move_to_end(session_id)
+        elif self._disk is not None:
+            session = await asyncio.to_thread(self._disk.take, session_id)
+            if session is not None:
+                self.disk_loads += 1
+                await self._insert(session)
+        if session is None:
+            return None
+        if session.expired(time.time()):
+            await self.delete(session_id)
+            return None
+        return session if session.user_id == user_id else None
+
+    async def put(self, session: Session):
+        """
+        Stores a session after a turn. Normally it is still in memory and this
+        only refreshes its position; if it was spilled during the turn the
+        stale disk copy is replaced.
+        """
+        if session.session_id in self._sessions:
+            self._sessions.move_to_end(session.session_id)
+            return
+        if self._disk is not None:
+            await asyncio.to_thread(self._disk.delete, session.session_id)
+        await self._insert(session)
+
+    async def delete(self, session_id: str):
+        self._sessions.pop(session_id, None)
+        self._locks.pop(session_id, None)
+        if self._disk is not None:
+            await asyncio.to_thread(self._disk.delete, session_id)
+
+    async def _insert(self, session: Session):
+        self._sessions[session.session_id] = session
+        evicted = []
+        while len(self._sessions) > self._max_in_memory:
+            _, oldest = self._sessions.popitem(last=False)
+            lock = self._locks.get(oldest.session_id)
+            if lock is not None and not lock.locked():
+                del self._locks[oldest.session_id]
+            if not oldest.expired(time.time()):
+                evicted.append(oldest)
+        if not evicted:
+            return
+        if self._disk is None:
+            self.dropped += len(evicted)
+            return
+        await asyncio.to_thread(self._disk.put_many, evicted)
+        self.spilled += len(evicted)
+
+    def close(self):
+        # Everything still in memory is written out, so sessions survive a restart
+        if self._disk is None:
+            return
+        now = time.time()
+        self._disk.put_many([session for session in self._sessions.values() if not session.expired(now)])
+        self._sessions.clear()
+        self._disk.close()
+        self._disk = None
+
+    def stats(self) -> dict:
+        return {
+            "in_memory": len(self._sessions),
+            "on_disk": self._disk.count() if self._disk is not None else 0,
+            "created": self.created,
+            "disk_loads": self.disk_loads,
+            "spilled": self.spilled,
+            "dropped": self.dropped,
+        }
+
+
+session_store = SessionStore()
@@ -0,0 +1,198 @@
+import os
+import re
+import time
+import itertools
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+from backend.services import metrics
+from backend.services.providers import registry
+
+# Comma-separated model names whose prompts may be answered from a similar earlier prompt, or "*"
+SIMILARITY_CACHE_MODELS = {
+    name.strip() for name in os.getenv("SIMILARITY_CACHE_MODELS", "").split(",") if name.strip()
+}
+# Estimated Jaccard similarity of the prompts' word shingles needed to serve a stored response
+SIMILARITY_CACHE_THRESHOLD = float(os.getenv("SIMILARITY_CACHE_THRESHOLD", "0.9"))
+SIMILARITY_CACHE_MAX_ENTRIES = int(os.getenv("SIMILARITY_CACHE_MAX_ENTRIES", "10000"))
+SIMILARITY_CACHE_TTL = float(os.getenv("SIMILARITY_CACHE_TTL", "3600"))
+# Words per shingle; smaller is more forgiving of changed words in short prompts
+SIMILARITY_CACHE_SHINGLE_SIZE = int(os.getenv("SIMILARITY_CACHE_SHINGLE_SIZE", "3"))
+# LSH banding: BANDS * ROWS MinHash values per prompt. Prompts become candidates when one band
+# matches entirely, which is likely above a similarity of about (1 / BANDS) ** (1 / ROWS)
+SIMILARITY_CACHE_BANDS = int(os.getenv("SIMILARITY_CACHE_BANDS", "16"))
+SIMILARITY_CACHE_ROWS = int(os.getenv("SIMILARITY_CACHE_ROWS", "4"))
+# Upper bound on stored prompts compared per lookup
+SIMILARITY_CACHE_MAX_CANDIDATES = int(os.getenv("SIMILARITY_CACHE_MAX_CANDIDATES", "64"))
+
+_WORD = re.compile(r"\w+")
+_MASK = (1 << 64) - 1
+
+
+class Fingerprint(NamedTuple):
+    # Only prompts with the same model and generation parameters are compared
+    namespace: tuple
+    model_name: str
+    signature: np.ndarray
+    band_keys: tuple
+
+
+class _Entry:
+    __slots__ = ("fingerprint", "value", "expires_at")
+
+    def __init__(self, fingerprint: Fingerprint, value: tuple, expires_at: float):
+        self.fingerprint = fingerprint
+        self.value = value
+        self.expires_at = expires_at
+
+
+def _shingle_hashes(prompt: str, size: int) -> np.ndarray:
+    # Lowercased words only, so whitespace, casing and punctuation differences disappear.
+    # Python's string hashing is salted per process, which is fine for an in-memory index
+    words = _WORD.findall(prompt.lower())
+    if len(words) <= size:
+        shingles = {tuple(words)} if words else set()
+    else:
+        shingles = {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+    return np.fromiter((hash(shingle) & _MASK for shingle in shingles), dtype=np.uint64, count=len(shingles))
+
+
+class SimilarityCache:
+    """
+    Near-duplicate cache of completed generations, for template-generated
+    prompts that an exact-match cache misses. Prompts are fingerprinted with
+    MinHash over word shingles and indexed by LSH bands, so a lookup compares
+    only the few stored prompts that share a band instead of all of them.
+    Values are (content, input_tokens, output_tokens) like the response cache;
+    entries are kept in LRU order with a TTL.
+    """
+
+    def __init__(self, models: set[str] = SIMILARITY_CACHE_MODELS, threshold: float = SIMILARITY_CACHE_THRESHOLD,
+                 max_entries: int = SIMILARITY_CACHE_MAX_ENTRIES, ttl: float = SIMILARITY_CACHE_TTL,
+                 bands: int = SIMILARITY_CACHE_BANDS, rows: int = SIMILARITY_CACHE_ROWS, seed: int = 1):
+        self._models = {name if name == "*" else registry.canonical(name) for name in models}
+        self.threshold = threshold
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._bands = bands
+        self._rows = rows
+        # Multiply-shift hashing: odd multipliers, arithmetic wraps at 64 bits
+        generator = np.random.default_rng(seed)
+        self._multipliers = generator.integers(1, 2 ** 63, size=(bands * rows, 1), dtype=np.uint64) * 2 + 1
+        self._offsets = generator.integers(0, 2 ** 63, size=(bands * rows, 1), dtype=np.uint64)
+        self._ids = itertools.count()
+        self._entries: OrderedDict[int, _Entry] = OrderedDict()
+        self._buckets: dict[tuple, set[int]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.replaced = 0
+        self._lookup_seconds = 0.0
+
+    def enabled_for(self, model_name: str) -> bool:
+        return bool(self._models) and ("*" in self._models or registry.canonical(model_name) in self._models)
+
+    def fingerprint(self, model_name: str, prompt: str, **params) -> Optional[Fingerprint]:
+        """
+        None for a prompt without words, which is never served from here.
+        """
+        hashes = _shingle_hashes(prompt, SIMILARITY_CACHE_SHINGLE_SIZE)
+        if not hashes.size:
+            return None
+        signature = ((self._multipliers * hashes + self._offsets) >> np.uint64(32)).min(axis=1)
+        model = registry.canonical(model_name)
+        namespace = (model, tuple(sorted(params.items())))
+        bands = signature.reshape(self._bands, self._rows)
+        band_keys = tuple((namespace, band, bands[band].tobytes()) for band in range(self._bands))
+        return Fingerprint(namespace, model, signature, band_keys)
+
+    def get(self, fingerprint: Fingerprint) -> Optional[tuple[tuple[str, int, int], float]]:
+        """
+        The stored value of the most similar earlier prompt and its estimated
+        similarity, if that reaches the threshold.
+        """
+        start = time.perf_counter()
+        entry_id, similarity = self._closest(fingerprint)
+        hit = entry_id is not None and similarity >= self.threshold
+        if hit:
+            self._entries.move_to_end(entry_id)
+            self.hits += 1
+        else:
+            self.misses += 1
+        self._lookup_seconds += time.perf_counter() - start
+        result = "hit" if hit else "miss"
+        model = registry.metric_label(fingerprint.model_name)
+        metrics.similarity_cache_lookups_total.inc((model, result))
+        if entry_id is not None:
+            # Hits near the threshold, or misses just under it, show whether it is set right
+            metrics.similarity_cache_similarity.observe(similarity, (model, result))
+        return (self._entries[entry_id].value, similarity) if hit else None
+
+    def set(self, fingerprint: Fingerprint, value: tuple[str, int, int]):
+        # A prompt close enough to be served by an existing entry replaces it rather than adding a
+        # near-copy, which would only crowd the buckets that template traffic hashes into
+        entry_id, similarity = self._closest(fingerprint)
+        if entry_id is not None and similarity >= self.threshold:
+            self._remove(entry_id)
+            self.replaced += 1
+        entry_id = next(self._ids)
+        self._entries[entry_id] = _Entry(fingerprint, value, time.time() + self._ttl)
+        for key in fingerprint.band_keys:
+            self._buckets.setdefault(key, set()).add(entry_id)
+        while len(self._entries) > self._max_entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _closest(self, fingerprint: Fingerprint) -> tuple[Optional[int], float]:
+        candidates = []
+        seen = set()
+        for key in fingerprint.band_keys:
+            for entry_id in self._buckets.get(key, ()):
+                if entry_id not in seen:
+                    seen.add(entry_id)
+                    candidates.append(entry_id)
+            if len(candidates) >= SIMILARITY_CACHE_MAX_CANDIDATES:
+                candidates = candidates[:SIMILARITY_CACHE_MAX_CANDIDATES]
+                break
+        now = time.time()
+        live = []
+        for entry_id in candidates:
+            if self._entries[entry_id].expires_at <= now:
+                self._remove(entry_id)
+            else:
+                live.append(entry_id)
+        if not live:
+            return None, 0.0
+        signatures = np.stack([self._entries[entry_id].fingerprint.signature for entry_id in live])
+        matches = np.count_nonzero(signatures == fingerprint.signature, axis=1)
+        best = int(matches.argmax())
+        return live[best], float(matches[best]) / fingerprint.signature.size
+
+    def _remove(self, entry_id: int):
+        entry = self._entries.pop(entry_id)
+        for key in entry.fingerprint.band_keys:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[key]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "models": sorted(self._models),
+            "threshold": self.threshold,
+            "entries": len(self._entries),
+            "buckets": len(self._buckets),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "replaced": self.replaced,
+            "avg_lookup_us": round(self._lookup_seconds / lookups * 1e6, 1) if lookups else 0.0,
+        }
+
+
+similarity_cache = SimilarityCache()
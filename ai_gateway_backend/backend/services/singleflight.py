@@ -0,0 +1,130 @@
+import os
+import asyncio
+from contextlib import aclosing
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+COALESCE_ENABLED = os.getenv("COALESCE_ENABLED", "True").lower() == "true"
+
+
+class _Broadcast:
+    """
+    Fans one upstream async iterator out to any number of subscribers. Late
+    subscribers first replay what has already been received.
+    """
+
+    def __init__(self, meta: Any, on_abandon: Callable[[], None]):
+        self.meta = meta
+        self.items: list = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.task = None
+        self._on_abandon = on_abandon
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def pump(self, source: AsyncIterator):
+        try:
+            async with aclosing(source):
+                async for item in source:
+                    self.items.append(item)
+                    self._notify()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._notify()
+
+    async def subscribe(self) -> AsyncIterator:
+        self.subscribers += 1
+        position = 0
+        try:
+            while True:
+                if position < len(self.items):
+                    yield self.items[position]
+                    position += 1
+                elif self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                else:
+                    await self._changed.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                # Everyone went away; stop paying for the upstream stream
+                self._on_abandon()
+                self.task.cancel()
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical upstream calls.
+
+    The first caller for a key starts the work as its own task; callers that
+    arrive while it is in flight wait on the same task (or, for streams,
+    subscribe to the same broadcast) instead of issuing another upstream
+    call. The work is not tied to the first caller's request, so it finishes
+    for the others even if that caller disconnects.
+    """
+
+    def __init__(self):
+        self._calls: dict[str, asyncio.Task] = {}
+        self._streams: dict[str, _Broadcast] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> tuple[Any, bool]:
+        """
+        Returns (result, shared); shared is True when the result came from
+        another caller's in-flight call.
+        """
+        task = self._calls.get(key)
+        shared = task is not None
+        if shared:
+            self.coalesced += 1
+        else:
+            self.leaders += 1
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._forget(self._calls, key, t))
+        return await asyncio.shield(task), shared
+
+    def stream(self, key: str, factory: Callable[[], tuple[Any, AsyncIterator]]) -> tuple[Any, AsyncIterator, bool]:
+        """
+        factory() returns (meta, iterator) and is only called for the first
+        caller, so it may raise (e.g. ValueError) before anything is
+        registered. Returns (meta, iterator, shared); every subscriber sees
+        the first caller's meta.
+        """
+        broadcast = self._streams.get(key)
+        shared = broadcast is not None
+        if shared:
+            self.coalesced += 1
+        else:
+            meta, source = factory()
+            self.leaders += 1
+            broadcast = _Broadcast(meta, lambda: self._forget(self._streams, key, broadcast))
+            broadcast.task = asyncio.ensure_future(broadcast.pump(source))
+            broadcast.task.add_done_callback(lambda t: self._forget(self._streams, key, broadcast))
+            self._streams[key] = broadcast
+        return broadcast.meta, broadcast.subscribe(), shared
+
+    @staticmethod
+    def _forget(calls: dict, key: str, value):
+        if calls.get(key) is value:
+            del calls[key]
+
+    def stats(self) -> dict:
+        return {
+            "enabled": COALESCE_ENABLED,
+            "in_flight": len(self._calls) + len(self._streams),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+        }
+
+
+singleflight = SingleFlight()
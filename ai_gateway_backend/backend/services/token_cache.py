@@ -0,0 +1,96 @@
+import os
+import time
+import hashlib
+from collections import OrderedDict
+from typing import Any, Optional
+
+TOKEN_CACHE_MAX_ENTRIES = int(os.getenv("TOKEN_CACHE_MAX_ENTRIES", "10000"))
+# Upper bound on how long a resolved user is trusted without a DB lookup
+TOKEN_CACHE_TTL = float(os.getenv("TOKEN_CACHE_TTL", "300"))
+
+
+class TokenCache:
+    """
+    Bounded LRU cache of verified JWTs.
+
+    Keys are SHA-256 digests of the raw token, values are the decoded claims
+    and the resolved user. An entry expires at the token's own `exp` or after
+    `ttl` seconds, whichever comes first, and can be dropped early with
+    invalidate_user() when the user's record changes.
+    """
+
+    def __init__(self, max_entries: int = TOKEN_CACHE_MAX_ENTRIES, ttl: float = TOKEN_CACHE_TTL):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._entries: OrderedDict = OrderedDict()  # digest -> (claims, user, expires_at)
+        self._by_username: dict[str, set] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _digest(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str) -> Optional[tuple[dict, Any]]:
+        digest = self._digest(token)
+        entry = self._entries.get(digest)
+        if entry is None:
+            self.misses += 1
+            return None
+        claims, user, expires_at = entry
+        if time.time() >= expires_at:
+            self._remove(digest)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(digest)
+        self.hits += 1
+        return claims, user
+
+    def put(self, token: str, claims: dict, user: Any):
+        expires_at = time.time() + self._ttl
+        exp = claims.get("exp")
+        if isinstance(exp, (int, float)):
+            expires_at = min(expires_at, exp)
+        digest = self._digest(token)
+        if digest in self._entries:
+            self._remove(digest)
+        self._entries[digest] = (claims, user, expires_at)
+        self._by_username.setdefault(claims.get("sub"), set()).add(digest)
+        while len(self._entries) > self._max_entries:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, digest: bytes):
+        claims, _, _ = self._entries.pop(digest)
+        digests = self._by_username.get(claims.get("sub"))
+        if digests is not None:
+            digests.discard(digest)
+            if not digests:
+                del self._by_username[claims.get("sub")]
+
+    def invalidate_user(self, username: str):
+        # Call whenever a user's row changes (password, email, deletion)
+        for digest in list(self._by_username.get(username, ())):
+            self._remove(digest)
+            self.invalidations += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._by_username.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+token_cache = TokenCache()
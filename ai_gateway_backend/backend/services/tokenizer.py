@@ -0,0 +1,251 @@
+import os
+import re
+import threading
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
+
+from backend.services.pricing import MODEL_COSTS, calculate_cost
+from backend.services.providers import registry, Prompt, as_messages
+
+# Token counts memoized for repeated texts: system prompts, templates, earlier turns of a session
+TOKENIZER_CACHE_SIZE = int(os.getenv("TOKENIZER_CACHE_SIZE", "4096"))
+# Longer texts are counted every time rather than kept alive in the memo
+TOKENIZER_CACHE_MAX_CHARS = int(os.getenv("TOKENIZER_CACHE_MAX_CHARS", "16384"))
+# "False" skips tiktoken for OpenAI models and always uses the approximate encoder (tiktoken is
+# in requirements.txt; its vocabularies are downloaded on first use unless TIKTOKEN_CACHE_DIR has them)
+TOKENIZER_USE_TIKTOKEN = os.getenv("TOKENIZER_USE_TIKTOKEN", "True").lower() == "true"
+# Encoding for models tiktoken does not know and for names providers.json does not declare
+TOKENIZER_DEFAULT_ENCODING = os.getenv("TOKENIZER_DEFAULT_ENCODING", "cl100k_base")
+# Largest worst-case cost in USD a single request may have; 0 disables
+MAX_REQUEST_COST_USD = float(os.getenv("MAX_REQUEST_COST_USD", "0"))
+
+# Prompt plus max_tokens must fit; models not listed are not checked
+MODEL_CONTEXT_TOKENS = {
+    "gpt-4": 8192,
+    "gpt-3.5-turbo": 16385,
+    "claude-3-opus-20240229": 200000,
+}
+
+APPROXIMATE = "approximate"
+# Chat formatting around each message, and the priming of the reply
+_MESSAGE_OVERHEAD = 3
+_REPLY_OVERHEAD = 3
+
+# Pieces a BPE vocabulary rarely merges across: words, digit runs, CJK characters, other
+# scripts, punctuation runs and line breaks or indentation. A single space joins the next word
+_PIECES = re.compile(
+    r"(?P<word>[A-Za-z]+)"
+    r"|(?P<number>[0-9]+)"
+    r"|(?P<cjk>[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+)"
+    r"|(?P<letters>[^\W\d_]+)"
+    r"|(?P<space> (?=\S)|\s+)"
+    r"|(?P<punct>[^\w\s]+|_+)"
+)
+
+
+def _approximate_count(text: str) -> int:
+    """
+    Approximates a byte-level BPE tokenizer (cl100k-like) without its
+    vocabulary: common words are one token, long ones a token per ~8
+    letters, digits go in threes, CJK characters are about 1.25 tokens each
+    and other scripts about one per two letters. Far closer than a word
+    count for code and non-English text.
+    """
+    count = 0
+    for match in _PIECES.finditer(text):
+        piece = match.group()
+        kind = match.lastgroup
+        if kind == "word":
+            count += 1 + (len(piece) - 1) // 8
+        elif kind == "number":
+            count += (len(piece) + 2) // 3
+        elif kind == "cjk":
+            count += (len(piece) * 5 + 3) // 4
+        elif kind == "letters":
+            count += (len(piece) + 1) // 2
+        elif kind == "space":
+            count += piece != " "
+        else:
+            count += (len(piece) + 1) // 2
+    return count
+
+
+class _Encoders:
+    """
+    tiktoken encodings, loaded on a background thread the first time a model
+    needs one: loading can mean downloading the vocabulary, which must not
+    hold up the event loop. Until it is ready, or if it cannot be loaded,
+    the model's prompts are counted approximately.
+
+    Only models declared in providers.json get their own entry; any other
+    name a prefix matches shares the default encoding, so clients cannot
+    start a thread or grow these tables by inventing model names.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._model_encodings: dict[str, str] = {}
+        self._encodings: dict[str, object] = {}
+        self._pending: set[str] = set()
+        self._failed: set[str] = set()
+
+    def for_model(self, model: str) -> str:
+        key = registry.metric_label(model)
+        name = self._model_encodings.get(key)
+        if name is not None:
+            return name
+        with self._lock:
+            if key in self._pending or key in self._failed:
+                return APPROXIMATE
+            self._pending.add(key)
+        threading.Thread(target=self._load, args=(key,), name="tokenizer-load", daemon=True).start()
+        return APPROXIMATE
+
+    def encode_count(self, name: str, text: str) -> int:
+        return len(self._encodings[name].encode(text, disallowed_special=()))
+
+    def _load(self, key: str):
+        try:
+            import tiktoken
+
+            try:
+                encoding = tiktoken.encoding_for_model(key)
+            except KeyError:
+                encoding = tiktoken.get_encoding(TOKENIZER_DEFAULT_ENCODING)
+            # One instance per encoding, however many models share it
+            self._encodings.setdefault(encoding.name, encoding)
+            self._model_encodings[key] = encoding.name
+        except Exception as e:
+            print(f"Tokenizer for {key} unavailable, counting approximately: {e}")
+            with self._lock:
+                self._failed.add(key)
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def loaded(self) -> dict[str, str]:
+        return dict(self._model_encodings)
+
+
+_encoders = _Encoders()
+_stats = {"rejected": 0}
+
+
+def _count(encoding: str, text: str) -> int:
+    if encoding == APPROXIMATE:
+        return _approximate_count(text)
+    return _encoders.encode_count(encoding, text)
+
+
+_memo_count = lru_cache(maxsize=TOKENIZER_CACHE_SIZE)(_count)
+
+
+def encoding_for(model_name: str) -> str:
+    """
+    The encoding used to count the model's tokens: a tiktoken encoding for
+    providers declared with "tokenizer": "tiktoken", otherwise approximate.
+    """
+    model, provider = registry.resolve(model_name)
+    if not TOKENIZER_USE_TIKTOKEN or registry.get(provider).tokenizer != "tiktoken":
+        return APPROXIMATE
+    return _encoders.for_model(model)
+
+
+def count_text(model_name: str, text: str) -> int:
+    encoding = encoding_for(model_name)
+    if len(text) > TOKENIZER_CACHE_MAX_CHARS:
+        return _count(encoding, text)
+    return _memo_count(encoding, text)
+
+
+def count_prompt(model_name: str, prompt: Prompt) -> int:
+    return _count_prompt(encoding_for(model_name), prompt)
+
+
+def _count_prompt(encoding: str, prompt: Prompt) -> int:
+    # Counted per message, so a conversation only counts its new turn
+    tokens = _REPLY_OVERHEAD
+    for message in as_messages(prompt):
+        content = message["content"]
+        counter = _count if len(content) > TOKENIZER_CACHE_MAX_CHARS else _memo_count
+        tokens += _MESSAGE_OVERHEAD + counter(encoding, content)
+    return tokens
+
+
+class PromptRejected(ValueError):
+    pass
+
+
+@dataclass
+class Estimate:
+    model_name: str
+    provider: str
+    encoding: str
+    input_tokens: int
+    max_output_tokens: int
+    context_window: Optional[int]
+    input_cost_usd: float
+    max_cost_usd: float
+
+    def rejection(self) -> Optional[str]:
+        # Why the request cannot be sent upstream, or None
+        if self.context_window is not None and self.input_tokens + self.max_output_tokens > self.context_window:
+            return (f"Prompt of about {self.input_tokens} tokens plus max_tokens {self.max_output_tokens} "
+                    f"exceeds the {self.context_window}-token context of {self.model_name}")
+        if MAX_REQUEST_COST_USD > 0 and self.max_cost_usd > MAX_REQUEST_COST_USD:
+            return f"Worst-case cost ${self.max_cost_usd:g} exceeds the ${MAX_REQUEST_COST_USD:g} per-request limit"
+        return None
+
+
+def estimate(model_name: str, prompt: Prompt, max_tokens: int) -> Estimate:
+    """
+    Input tokens and worst-case cost (the full max_tokens generated) of a
+    request, before it is sent. Raises ValueError for an unsupported model.
+    """
+    model, provider = registry.resolve(model_name)
+    encoding = encoding_for(model)
+    input_tokens = _count_prompt(encoding, prompt)
+    return Estimate(
+        model_name=model,
+        provider=provider,
+        encoding=encoding,
+        input_tokens=input_tokens,
+        max_output_tokens=max_tokens,
+        context_window=MODEL_CONTEXT_TOKENS.get(model),
+        input_cost_usd=calculate_cost(model, input_tokens, 0),
+        max_cost_usd=calculate_cost(model, input_tokens, max_tokens),
+    )
+
+
+def preflight(model_name: str, prompt: Prompt, max_tokens: int) -> Estimate:
+    """
+    Raises PromptRejected for a request that is too large for the model or
+    costs more than MAX_REQUEST_COST_USD at worst.
+    """
+    result = estimate(model_name, prompt, max_tokens)
+    reason = result.rejection()
+    if reason is not None:
+        _stats["rejected"] += 1
+        raise PromptRejected(reason)
+    return result
+
+
+def warm_up():
+    # Starts loading the encodings of the models with known prices or context sizes
+    for model in set(MODEL_COSTS) | set(MODEL_CONTEXT_TOKENS):
+        try:
+            encoding_for(model)
+        except ValueError:
+            pass
+
+
+def stats() -> dict:
+    memo = _memo_count.cache_info()
+    lookups = memo.hits + memo.misses
+    return {
+        "encodings": _encoders.loaded(),
+        "memo_entries": memo.currsize,
+        "memo_hit_ratio": round(memo.hits / lookups, 4) if lookups else 0.0,
+        "rejected": _stats["rejected"],
+    }
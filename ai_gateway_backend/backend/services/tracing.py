@@ -0,0 +1,459 @@
+import os
+import json
+import time
+import random
+import asyncio
+from collections import Counter, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Optional
+
+from backend.services import http_clients
+
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "True").lower() == "true"
+# Requests slower than this (seconds) are kept in the slow-request log and always exported
+TRACE_SLOW_THRESHOLD = float(os.getenv("TRACE_SLOW_THRESHOLD", "5"))
+TRACE_SLOW_LOG_SIZE = int(os.getenv("TRACE_SLOW_LOG_SIZE", "100"))
+# Optional JSON-lines copy of the slow-request log
+TRACE_SLOW_LOG_PATH = os.getenv("TRACE_SLOW_LOG_PATH", "")
+# Fraction of all other requests exported
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+# OTLP/JSON export: JSON lines appended to a file, and/or POSTed to a collector's /v1/traces
+TRACE_EXPORT_PATH = os.getenv("TRACE_EXPORT_PATH", "")
+TRACE_EXPORT_URL = os.getenv("TRACE_EXPORT_URL", "")
+TRACE_EXPORT_INTERVAL = float(os.getenv("TRACE_EXPORT_INTERVAL", "5"))
+TRACE_EXPORT_MAX_QUEUE = int(os.getenv("TRACE_EXPORT_MAX_QUEUE", "10000"))
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "ai-gateway")
+TRACE_MAX_SPANS = int(os.getenv("TRACE_MAX_SPANS", "256"))
+# Routes never traced: scrapes, and streams that are meant to stay open
+TRACE_IGNORE_ROUTES = {
+    route.strip() for route in os.getenv("TRACE_IGNORE_ROUTES", "/metrics,/usage/summary/stream").split(",")
+    if route.strip()
+}
+# Stack sampling of requests that have been running for TRACE_PROFILE_AFTER seconds
+TRACE_PROFILE_ENABLED = os.getenv("TRACE_PROFILE_ENABLED", "False").lower() == "true"
+TRACE_PROFILE_AFTER = float(os.getenv("TRACE_PROFILE_AFTER", str(TRACE_SLOW_THRESHOLD / 2)))
+TRACE_PROFILE_INTERVAL = float(os.getenv("TRACE_PROFILE_INTERVAL", "0.05"))
+# Innermost frames kept per sampled stack
+TRACE_PROFILE_DEPTH = int(os.getenv("TRACE_PROFILE_DEPTH", "24"))
+
+_current: ContextVar[Optional["Span"]] = ContextVar("trace_span", default=None)
+
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "attributes", "start_ns", "end_ns", "error")
+
+    def __init__(self, trace: "Trace", name: str, parent_id: Optional[str], attributes: dict):
+        self.trace = trace
+        self.span_id = random.getrandbits(64).to_bytes(8, "big").hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.error: Optional[str] = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    @property
+    def duration_ms(self) -> Optional[float]:
+        return None if self.end_ns is None else (self.end_ns - self.start_ns) / 1e6
+
+    def to_otlp(self) -> dict:
+        span = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            # SPAN_KIND_SERVER for the request itself, INTERNAL below it
+            "kind": 2 if self is self.trace.root else 1,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or time.time_ns()),
+            "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in self.attributes.items()],
+            # STATUS_CODE_ERROR / UNSET
+            "status": {"code": 2, "message": self.error} if self.error else {},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        return span
+
+
+class Trace:
+    """
+    The spans of one request. The root span is the HTTP request; a
+    W3C traceparent header on the request makes it a child of the caller's span.
+    """
+
+    def __init__(self, name: str, traceparent: Optional[str] = None):
+        self.trace_id, self.remote_parent_id = _parse_traceparent(traceparent)
+        self.spans: list[Span] = []
+        self.dropped_spans = 0
+        self.profile: Counter = Counter()
+        self.profile_samples = 0
+        self.started = time.monotonic()
+        self.root = self.add(name, self.remote_parent_id, {})
+
+    def add(self, name: str, parent_id: Optional[str], attributes: dict) -> Optional[Span]:
+        if len(self.spans) >= TRACE_MAX_SPANS:
+            self.dropped_spans += 1
+            return None
+        span = Span(self, name, parent_id, attributes)
+        self.spans.append(span)
+        return span
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.root.span_id}-01"
+
+    def tree(self) -> dict:
+        children: dict[Optional[str], list[Span]] = {}
+        for span in self.spans:
+            children.setdefault(span.parent_id, []).append(span)
+
+        def node(span: Span) -> dict:
+            return {
+                "name": span.name,
+                "span_id": span.span_id,
+                "start_offset_ms": round((span.start_ns - self.root.start_ns) / 1e6, 3),
+                "duration_ms": None if span.duration_ms is None else round(span.duration_ms, 3),
+                "attributes": span.attributes,
+                "error": span.error,
+                "children": [node(child) for child in children.get(span.span_id, [])],
+            }
+        return node(self.root)
+
+    def summary(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "name": self.root.name,
+            "timestamp": self.root.start_ns / 1e9,
+            "duration_ms": round(self.root.duration_ms or 0, 3),
+            "attributes": self.root.attributes,
+            "dropped_spans": self.dropped_spans,
+            "spans": self.tree(),
+            "profile": {
+                "samples": self.profile_samples,
+                "interval_ms": TRACE_PROFILE_INTERVAL * 1000,
+                # Collapsed stacks (outermost first), most frequent first: flame-graph input
+                "stacks": [{"stack": stack, "count": count} for stack, count in self.profile.most_common(50)],
+            } if self.profile_samples else None,
+        }
+
+
+def _parse_traceparent(value: Optional[str]) -> tuple[str, Optional[str]]:
+    # "00-<32 hex trace id>-<16 hex parent span id>-<flags>"
+    if value:
+        parts = value.strip().split("-")
+        if len(parts) == 4 and len(parts[1]) == 32 and len(parts[2]) == 16:
+            try:
+                # All-zero ids are invalid
+                if int(parts[1], 16) and int(parts[2], 16):
+                    return parts[1].lower(), parts[2].lower()
+            except ValueError:
+                pass
+    return random.getrandbits(128).to_bytes(16, "big").hex(), None
+
+
+def _otlp_value(value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Times the enclosed block as a child of the current span. Outside a
+    traced request (or past TRACE_MAX_SPANS) it only costs a context lookup
+    and yields None.
+    """
+    parent = _current.get()
+    child = parent.trace.add(name, parent.span_id, attributes) if parent is not None else None
+    if child is None:
+        yield None
+        return
+    token = _current.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        child.end_ns = time.time_ns()
+        _current.reset(token)
+
+
+def current_trace_id() -> Optional[str]:
+    current = _current.get()
+    return current.trace.trace_id if current is not None else None
+
+
+class SlowRequestLog:
+    """
+    Tail sampling: a request's trace is only kept once it has finished and
+    turned out slower than TRACE_SLOW_THRESHOLD. The copy in
+    TRACE_SLOW_LOG_PATH is appended by a background task, off the event loop.
+    """
+
+    def __init__(self, size: int = TRACE_SLOW_LOG_SIZE):
+        self._recent: deque = deque(maxlen=size)
+        self.recorded = 0
+        self._unwritten: deque = deque()
+        self._writer: Optional[asyncio.Task] = None
+        self.write_dropped = 0
+
+    def record(self, trace: Trace):
+        summary = trace.summary()
+        self._recent.append(summary)
+        self.recorded += 1
+        if TRACE_SLOW_LOG_PATH:
+            if len(self._unwritten) >= TRACE_EXPORT_MAX_QUEUE:
+                self.write_dropped += 1
+                return
+            self._unwritten.append(summary)
+            if self._writer is None or self._writer.done():
+                self._writer = asyncio.create_task(self._write())
+
+    async def _write(self):
+        # One writer at a time, so lines land in the order they were recorded
+        while self._unwritten:
+            summaries = [self._unwritten.popleft() for _ in range(len(self._unwritten))]
+            try:
+                await asyncio.to_thread(self._append, summaries)
+            except OSError as e:
+                print(f"Slow request log write failed: {e}")
+
+    @staticmethod
+    def _append(summaries: list[dict]):
+        with open(TRACE_SLOW_LOG_PATH, "a") as f:
+            f.write("".join(json.dumps(summary, default=str) + "\n" for summary in summaries))
+
+    async def flush(self):
+        # Waits until everything recorded so far is in the file
+        if self._writer is not None:
+            await self._writer
+
+    def _since(self, since: Optional[float]) -> list[dict]:
+        return [entry for entry in self._recent if since is None or entry["timestamp"] >= since]
+
+    def slowest(self, limit: int, since: Optional[float] = None) -> list[dict]:
+        return sorted(self._since(since), key=lambda entry: entry["duration_ms"], reverse=True)[:limit]
+
+    def recent(self, limit: int, since: Optional[float] = None) -> list[dict]:
+        return self._since(since)[::-1][:limit]
+
+
+class TraceExporter:
+    """
+    Batches finished traces and writes them as OTLP/JSON
+    ExportTraceServiceRequest documents, off the request path. When the
+    queue is full new traces are dropped and counted.
+    """
+
+    def __init__(self):
+        self._queue: deque = deque()
+        self._task: Optional[asyncio.Task] = None
+        self.exported = 0
+        self.dropped = 0
+        self.failures = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(TRACE_EXPORT_PATH or TRACE_EXPORT_URL)
+
+    def submit(self, trace: Trace):
+        if len(self._queue) >= TRACE_EXPORT_MAX_QUEUE:
+            self.dropped += 1
+            return
+        self._queue.append(trace)
+
+    def _payload(self, traces: list[Trace]) -> dict:
+        return {"resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}}]},
+            "scopeSpans": [{
+                "scope": {"name": "backend.services.tracing"},
+                "spans": [span.to_otlp() for trace in traces for span in trace.spans],
+            }],
+        }]}
+
+    def _append(self, line: str):
+        with open(TRACE_EXPORT_PATH, "a") as f:
+            f.write(line + "\n")
+
+    async def flush(self):
+        if not self._queue:
+            return
+        traces = [self._queue.popleft() for _ in range(len(self._queue))]
+        payload = self._payload(traces)
+        try:
+            if TRACE_EXPORT_PATH:
+                await asyncio.to_thread(self._append, json.dumps(payload, default=str))
+            if TRACE_EXPORT_URL:
+                response = await http_clients.get_client("traces").post(TRACE_EXPORT_URL, json=payload)
+                response.raise_for_status()
+            self.exported += len(traces)
+        except Exception as e:
+            self.failures += 1
+            print(f"Trace export failed: {e}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(TRACE_EXPORT_INTERVAL)
+            await self.flush()
+
+    def start(self):
+        if self.enabled:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            await self.flush()
+
+
+def _await_stack(task: asyncio.Task) -> str:
+    # Task.get_stack() stops at the outermost frame of a suspended coroutine; follow the await chain instead
+    names = []
+    awaitable = task.get_coro()
+    while awaitable is not None and len(names) < 1000:
+        frame = getattr(awaitable, "cr_frame", None) or getattr(awaitable, "ag_frame", None) \
+            or getattr(awaitable, "gi_frame", None)
+        if frame is None:
+            # What the innermost coroutine is waiting on: a Future, a Task, ...
+            names.append(f"<{type(awaitable).__name__}>")
+            break
+        names.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+        awaitable = getattr(awaitable, "cr_await", None) or getattr(awaitable, "ag_await", None) \
+            or getattr(awaitable, "gi_yieldfrom", None)
+    # The innermost frames say where the time goes; the outer ones are mostly ASGI middleware
+    return ";".join(names[-TRACE_PROFILE_DEPTH:])
+
+
+class StackSampler:
+    """
+    Samples the await stack of every in-flight request that has been running
+    for TRACE_PROFILE_AFTER seconds, every TRACE_PROFILE_INTERVAL. Runs on
+    the event loop, so a stack always shows where the request is waiting
+    (upstream, a DB executor, a scheduler slot); fast requests are never
+    sampled at all.
+    """
+
+    def __init__(self):
+        self._active: dict[asyncio.Task, Trace] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def track(self, task: Optional[asyncio.Task], trace: Trace):
+        if self._task is not None and task is not None:
+            self._active[task] = trace
+
+    def untrack(self, task: Optional[asyncio.Task]):
+        self._active.pop(task, None)
+
+    def _sample(self):
+        now = time.monotonic()
+        for task, trace in list(self._active.items()):
+            if now - trace.started < TRACE_PROFILE_AFTER or task.done():
+                continue
+            trace.profile[_await_stack(task)] += 1
+            trace.profile_samples += 1
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(TRACE_PROFILE_INTERVAL)
+            self._sample()
+
+    def start(self):
+        if TRACE_PROFILE_ENABLED:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._active.clear()
+
+
+class TracingMiddleware:
+    """
+    Plain ASGI middleware opening a trace per HTTP request. The root span
+    lasts until the response is fully sent. Finished traces go to the slow
+    request log (when slow) and the exporter (when slow or sampled).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope.get("headers") or [])
+        traceparent = headers.get(b"traceparent")
+        trace = Trace(f"{scope['method']} {scope['path']}", traceparent.decode("latin-1") if traceparent else None)
+        trace.root.set(**{"http.method": scope["method"], "http.target": scope["path"]})
+        token = _current.set(trace.root)
+        task = asyncio.current_task()
+        stack_sampler.track(task, trace)
+
+        async def send_with_trace(message):
+            if message["type"] == "http.response.start":
+                trace.root.set(**{"http.status_code": message["status"]})
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"traceparent", trace.traceparent.encode())
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_trace)
+        except BaseException as e:
+            trace.root.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            trace.root.end_ns = time.time_ns()
+            _current.reset(token)
+            stack_sampler.untrack(task)
+            self._finish(trace, scope)
+
+    def _finish(self, trace: Trace, scope: dict):
+        route = getattr(scope.get("route"), "path", None)
+        if route is not None:
+            # The route template names the trace, so traces of one endpoint group together
+            trace.root.name = f"{scope['method']} {route}"
+            trace.root.set(**{"http.route": route})
+            if route in TRACE_IGNORE_ROUTES:
+                return
+        slow = trace.root.duration_ms >= TRACE_SLOW_THRESHOLD * 1000
+        if slow:
+            slow_requests.record(trace)
+        if trace_exporter.enabled and (slow or random.random() < TRACE_SAMPLE_RATE):
+            trace_exporter.submit(trace)
+
+
+def stats() -> dict:
+    return {
+        "enabled": TRACING_ENABLED,
+        "slow_threshold_s": TRACE_SLOW_THRESHOLD,
+        "slow_requests": slow_requests.recorded,
+        "slow_log_dropped": slow_requests.write_dropped,
+        "exported": trace_exporter.exported,
+        "export_dropped": trace_exporter.dropped,
+        "export_failures": trace_exporter.failures,
+    }
+
+
+slow_requests = SlowRequestLog()
+trace_exporter = TraceExporter()
+stack_sampler = StackSampler()
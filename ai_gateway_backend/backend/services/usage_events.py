@@ -0,0 +1,123 @@
+import os
+import asyncio
+from typing import Optional
+
+from backend.services.pricing import calculate_cost
+from backend.services.usage_writer import usage_writer
+
+# Seconds between keep-alive comments on idle dashboard streams
+USAGE_STREAM_HEARTBEAT = float(os.getenv("USAGE_STREAM_HEARTBEAT", "15"))
+
+
+def empty_delta() -> dict:
+    # Same shape as UsageSummary, so the dashboard adds it field by field
+    return {
+        "total_requests": 0,
+        "total_input_tokens": 0,
+        "total_output_tokens": 0,
+        "estimated_total_cost_usd": 0.0,
+        "model_usage": {},
+    }
+
+
+def _add(delta: dict, other: dict):
+    for key in ("total_requests", "total_input_tokens", "total_output_tokens", "estimated_total_cost_usd"):
+        delta[key] += other[key]
+    for model, usage in other["model_usage"].items():
+        totals = delta["model_usage"].setdefault(model, {"input_tokens": 0, "output_tokens": 0, "requests": 0})
+        for key in totals:
+            totals[key] += usage[key]
+
+
+class Subscription:
+    """
+    One connected dashboard. Deltas published while it is not reading are
+    merged into a single pending one, so a slow client never falls behind by
+    more than one message and memory stays bounded.
+    """
+
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        self._pending: Optional[dict] = None
+        self._ready = asyncio.Event()
+
+    def push(self, delta: dict):
+        if self._pending is None:
+            self._pending = empty_delta()
+        _add(self._pending, delta)
+        self._ready.set()
+
+    async def next(self, timeout: Optional[float] = None) -> Optional[dict]:
+        """
+        The merged delta since the last call, or None if nothing arrived within timeout.
+        """
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+        self._ready.clear()
+        delta, self._pending = self._pending, None
+        delta["estimated_total_cost_usd"] = round(delta["estimated_total_cost_usd"], 6)
+        return delta
+
+
+class UsageBroker:
+    """
+    In-process pub/sub of committed usage, per user. The usage writer
+    publishes every batch after its transaction commits, so a subscriber
+    sees exactly what /usage/summary will report. Only events recorded by
+    this worker process are published.
+    """
+
+    def __init__(self):
+        self._subscriptions: dict[str, set[Subscription]] = {}
+        self.published_events = 0
+
+    def subscribe(self, user_id: int) -> Subscription:
+        subscription = Subscription(str(user_id))
+        self._subscriptions.setdefault(subscription.user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscriptions = self._subscriptions.get(subscription.user_id)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._subscriptions[subscription.user_id]
+
+    def publish(self, events: list):
+        deltas = {}
+        for event in events:
+            user_id = str(event.user_id)
+            if user_id not in self._subscriptions:
+                continue
+            delta = deltas.setdefault(user_id, empty_delta())
+            cost = event.cost_usd if event.cost_usd is not None else calculate_cost(
+                event.model_name, event.input_tokens, event.output_tokens
+            )
+            _add(delta, {
+                "total_requests": 1,
+                "total_input_tokens": event.input_tokens,
+                "total_output_tokens": event.output_tokens,
+                "estimated_total_cost_usd": float(cost),
+                "model_usage": {event.model_name: {
+                    "input_tokens": event.input_tokens,
+                    "output_tokens": event.output_tokens,
+                    "requests": 1,
+                }},
+            })
+        self.published_events += len(events)
+        for user_id, delta in deltas.items():
+            for subscription in self._subscriptions.get(user_id, ()):
+                subscription.push(delta)
+
+    def stats(self) -> dict:
+        return {
+            "subscribers": sum(len(subscriptions) for subscriptions in self._subscriptions.values()),
+            "users": len(self._subscriptions),
+            "published_events": self.published_events,
+        }
+
+
+usage_broker = UsageBroker()
+usage_writer.add_listener(usage_broker.publish)
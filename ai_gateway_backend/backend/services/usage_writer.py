@@ -0,0 +1,400 @@
+import os
+import glob
+import json
+import time
+import fcntl
+import asyncio
+import itertools
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Callable, Optional
+
+from backend.db import database, rollups
+from backend.services import metrics
+
+# Flush whenever this many events are pending, or every USAGE_FLUSH_INTERVAL seconds
+USAGE_FLUSH_BATCH_SIZE = int(os.getenv("USAGE_FLUSH_BATCH_SIZE", "500"))
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "1.0"))
+USAGE_RETRY_BACKOFF_MAX = float(os.getenv("USAGE_RETRY_BACKOFF_MAX", "30"))
+# Append-only spool; one segment file per worker process at a time
+USAGE_SPOOL_DIR = os.getenv("USAGE_SPOOL_DIR", "usage_spool")
+USAGE_SPOOL_SEGMENT_BYTES = int(os.getenv("USAGE_SPOOL_SEGMENT_BYTES", str(16 * 1024 * 1024)))
+# Events held in memory for the next flushes; past this (e.g. while the DB is down) they stay in the
+# spool only and are read back from it as the queue drains
+USAGE_MAX_PENDING = int(os.getenv("USAGE_MAX_PENDING", "100000"))
+# Events the database rejects outright, one JSON line each in the spool format; empty puts the file in the spool dir
+USAGE_DEAD_LETTER_PATH = os.getenv("USAGE_DEAD_LETTER_PATH", "")
+
+INSERT_USAGE_SQL = """
+    INSERT INTO usage_log (user_id, model_name, input_tokens, output_tokens, timestamp, cost_usd, cache_hit)
+    VALUES (%s, %s, %s, %s, %s, %s, %s)
+"""
+
+
+@dataclass
+class UsageEvent:
+    user_id: str
+    model_name: str
+    input_tokens: int
+    output_tokens: int
+    timestamp: datetime = field(default_factory=datetime.utcnow)
+    cost_usd: Optional[float] = None
+    # Served from the response cache: no upstream call, billed at zero cost
+    cache_hit: bool = False
+
+    def to_row(self) -> tuple:
+        return (self.user_id, self.model_name, self.input_tokens, self.output_tokens, self.timestamp,
+                self.cost_usd, self.cache_hit)
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "user_id": self.user_id,
+            "model_name": self.model_name,
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "timestamp": self.timestamp.isoformat(),
+            "cost_usd": self.cost_usd,
+            "cache_hit": self.cache_hit,
+        })
+
+    @classmethod
+    def from_json(cls, line: str) -> "UsageEvent":
+        data = json.loads(line)
+        data["timestamp"] = datetime.fromisoformat(data["timestamp"])
+        return cls(**data)
+
+
+class _Segment:
+    """
+    One spool file plus a sidecar file holding the byte offset up to which
+    its events are known to be in the database. The file is flock'ed for as
+    long as this process owns it, which is how other workers tell a live
+    segment from one orphaned by a crash.
+    """
+
+    def __init__(self, path: str, fd: int, size: int, committed: int):
+        self.path = path
+        self.fd = fd
+        self.size = size
+        self.committed = committed
+        # Events up to here are in the database or queued in memory; the rest are only in the file
+        self.queued = committed
+
+    @property
+    def offset_path(self) -> str:
+        return self.path + ".offset"
+
+    @classmethod
+    def create(cls, directory: str) -> "_Segment":
+        path = os.path.join(directory, f"usage-{os.getpid()}-{time.time_ns()}.jsonl")
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return cls(path, fd, 0, 0)
+
+    def append(self, data: bytes) -> int:
+        os.write(self.fd, data)
+        self.size += len(data)
+        return self.size
+
+    def save_offset(self, offset: int):
+        tmp_path = self.offset_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(str(offset))
+        os.replace(tmp_path, self.offset_path)
+
+    def remove(self):
+        # Spool file first: a leftover offset file without its spool is harmless
+        os.close(self.fd)
+        for path in (self.path, self.offset_path):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+class UsageWriter:
+    """
+    Takes usage logging off the request path.
+
+    record() appends the event to the local spool and queues it in memory; a
+    background task drains the queue with multi-row INSERTs when
+    USAGE_FLUSH_BATCH_SIZE events are pending or USAGE_FLUSH_INTERVAL has
+    passed. Spool segments left behind by a crashed or stopped worker are
+    replayed on startup, so delivery is at-least-once.
+
+    The queue holds at most USAGE_MAX_PENDING events. Beyond that, and for
+    replayed segments, events are only in the spool; each flush that empties
+    the queue reads the next ones back from the segments' queued offsets.
+
+    A batch the database rejects for its data (not because it is down) is
+    halved until the offending event is alone; that event is moved to the
+    dead-letter file so the events behind it keep flowing.
+    """
+
+    def __init__(self, spool_dir: str = USAGE_SPOOL_DIR):
+        self._spool_dir = spool_dir
+        self._dead_letter_path = USAGE_DEAD_LETTER_PATH or os.path.join(spool_dir, "dead-letter.jsonl")
+        self._segment: Optional[_Segment] = None
+        self._segments: list[_Segment] = []
+        self._pending: deque = deque()  # (event, segment, end offset in segment)
+        # Some spooled events are not queued; until they are, new events are only spooled too
+        self._spilled = False
+        self._wakeup: Optional[asyncio.Event] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+        self._failures = 0
+        self._retry_at = 0.0
+        self.flushed_events = 0
+        self.flushed_batches = 0
+        self.dead_lettered = 0
+        self._listeners: list[Callable[[list[UsageEvent]], None]] = []
+
+    def add_listener(self, listener: Callable[[list[UsageEvent]], None]):
+        """
+        Calls `listener(events)` on the event loop after each batch is committed.
+        """
+        self._listeners.append(listener)
+
+    def record(self, event: UsageEvent):
+        self.record_many([event])
+
+    def record_many(self, events: list[UsageEvent]):
+        """
+        Spools the events with a single append; they reach the database
+        together in the next flush.
+        """
+        if not events:
+            return
+        if self._segment is None or self._segment.size >= USAGE_SPOOL_SEGMENT_BYTES:
+            os.makedirs(self._spool_dir, exist_ok=True)
+            self._segment = _Segment.create(self._spool_dir)
+            self._segments.append(self._segment)
+        lines = [(event.to_json() + "\n").encode() for event in events]
+        start = self._segment.size
+        self._segment.append(b"".join(lines))
+        if self._spilled or len(self._pending) + len(events) > USAGE_MAX_PENDING:
+            # Queued events must stay a contiguous run from each segment's committed offset
+            self._spilled = True
+        else:
+            for event, length in zip(events, itertools.accumulate(len(line) for line in lines)):
+                self._pending.append((event, self._segment, start + length))
+            self._segment.queued = self._segment.size
+        if len(self._pending) >= USAGE_FLUSH_BATCH_SIZE and self._wakeup is not None:
+            self._wakeup.set()
+
+    def _replay_orphans(self) -> int:
+        # Adopts segments left by other processes; their events are read back by flush()
+        if not os.path.isdir(self._spool_dir):
+            return 0
+        replayed = 0
+        owned = {segment.path for segment in self._segments}
+        for path in sorted(glob.glob(os.path.join(self._spool_dir, "usage-*.jsonl"))):
+            if path in owned:
+                continue
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Still owned by a live worker
+                os.close(fd)
+                continue
+            try:
+                with open(path + ".offset") as f:
+                    committed = int(f.read().strip() or 0)
+            except (FileNotFoundError, ValueError):
+                committed = 0
+            segment = _Segment(path, fd, os.path.getsize(path), committed)
+            if segment.committed >= segment.size:
+                segment.remove()
+                continue
+            self._segments.append(segment)
+            self._spilled = True
+            replayed += 1
+        return replayed
+
+    @staticmethod
+    def _read_spooled(path: str, start: int, end: int, limit: int) -> tuple[list, int]:
+        # Up to `limit` events between two offsets, each with its end offset; and where reading stopped
+        events = []
+        with open(path, "rb") as f:
+            f.seek(start)
+            offset = start
+            while offset < end and len(events) < limit:
+                line = f.readline(end - offset)
+                if not line:
+                    break
+                offset += len(line)
+                try:
+                    events.append((UsageEvent.from_json(line.decode()), offset))
+                except (ValueError, KeyError, TypeError):
+                    # Torn write from a crash mid-append
+                    continue
+        return events, offset
+
+    async def _refill(self):
+        """
+        Queues spooled events that are not queued yet, oldest segment first,
+        up to USAGE_MAX_PENDING. The file is read off the event loop, only up
+        to the size it had when the read started.
+        """
+        for segment in list(self._segments):
+            room = USAGE_MAX_PENDING - len(self._pending)
+            if room <= 0:
+                return
+            if segment.queued >= segment.size:
+                continue
+            events, offset = await asyncio.to_thread(
+                self._read_spooled, segment.path, segment.queued, segment.size, room
+            )
+            for event, end in events:
+                self._pending.append((event, segment, end))
+            segment.queued = offset
+            if not events and segment.committed < offset and not any(s is segment for _, s, _ in self._pending):
+                # Nothing but a torn tail left: count it as committed so the segment can be dropped
+                segment.committed = offset
+                segment.save_offset(offset)
+        if all(segment.queued >= segment.size for segment in self._segments):
+            self._spilled = False
+
+    @staticmethod
+    def _write_batch(events: list, offsets: dict):
+        for segment in offsets:
+            os.fsync(segment.fd)
+        # Rollups are updated in the same transaction, so they always match usage_log
+        with metrics.db_seconds.timer(("usage_flush",)), database.transaction() as tx:
+            tx.executemany(INSERT_USAGE_SQL, [event.to_row() for event in events])
+            rollups.apply(tx, events)
+        for segment, offset in offsets.items():
+            segment.save_offset(offset)
+
+    def _write_dead_letter(self, event: UsageEvent, segment: _Segment, offset: int):
+        with open(self._dead_letter_path, "a") as f:
+            f.write(event.to_json() + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        segment.save_offset(offset)
+
+    async def flush(self) -> int:
+        """
+        Writes pending events to the database. Returns the number written;
+        on a DB error the events stay queued (and spooled) for the next attempt.
+        """
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        written = 0
+        # Shrinks while a rejected batch is narrowed down to the event at fault
+        batch_size = USAGE_FLUSH_BATCH_SIZE
+        async with self._flush_lock:
+            while True:
+                if not self._pending and self._spilled:
+                    await self._refill()
+                if not self._pending:
+                    break
+                batch = [self._pending[i] for i in range(min(batch_size, len(self._pending)))]
+                offsets = {}
+                for _, segment, end in batch:
+                    offsets[segment] = end
+                try:
+                    await database.run(self._write_batch, [event for event, _, _ in batch], offsets)
+                except database.DataError as e:
+                    if len(batch) > 1:
+                        batch_size = len(batch) // 2
+                        continue
+                    event, segment, end = batch[0]
+                    await asyncio.to_thread(self._write_dead_letter, event, segment, end)
+                    print(f"Usage event rejected by the DB, moved to {self._dead_letter_path}: {e}")
+                    self._pending.popleft()
+                    segment.committed = end
+                    self.dead_lettered += 1
+                    batch_size = USAGE_FLUSH_BATCH_SIZE
+                    continue
+                except database.DatabaseError as e:
+                    self._failures += 1
+                    self._retry_at = time.monotonic() + min(USAGE_RETRY_BACKOFF_MAX, 2 ** self._failures)
+                    print(f"DB log usage error ({len(self._pending)} events spooled): {e}")
+                    break
+                self._failures = 0
+                for _ in batch:
+                    self._pending.popleft()
+                for segment, offset in offsets.items():
+                    segment.committed = offset
+                written += len(batch)
+                self.flushed_events += len(batch)
+                self.flushed_batches += 1
+                self._notify([event for event, _, _ in batch])
+            self._drop_drained_segments()
+        return written
+
+    async def between_batches(self, fn, *args):
+        """
+        Runs a blocking DB read while no batch is being written, so every
+        batch it sees has already reached the listeners and every batch it
+        misses will reach them afterwards.
+        """
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            return await database.run(fn, *args)
+
+    def _notify(self, events: list[UsageEvent]):
+        for listener in self._listeners:
+            try:
+                listener(events)
+            except Exception as e:
+                print(f"Usage listener error: {e}")
+
+    def _drop_drained_segments(self):
+        for segment in list(self._segments):
+            if segment.committed >= segment.size:
+                self._segments.remove(segment)
+                if segment is self._segment:
+                    self._segment = None
+                segment.remove()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=USAGE_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if time.monotonic() < self._retry_at:
+                continue
+            try:
+                await self.flush()
+            except Exception as e:
+                # Never let the writer task die; events remain spooled
+                print(f"Usage writer error: {e}")
+
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        replayed = self._replay_orphans()
+        if replayed:
+            print(f"Replaying usage events from {replayed} spool segments")
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "spilled": self._spilled,
+            "spool_segments": len(self._segments),
+            "flushed_events": self.flushed_events,
+            "flushed_batches": self.flushed_batches,
+            "dead_lettered": self.dead_lettered,
+            "consecutive_failures": self._failures,
+        }
+
+
+usage_writer = UsageWriter()
@@ -0,0 +1,53 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# Settings are read when the backend modules are imported, so they are set before any test imports one:
+# a throwaway SQLite database, mock providers and the approximate tokenizer, nothing on the network
+_TMP = tempfile.mkdtemp(prefix="ai_gateway_tests-")
+os.environ.update({
+    "DB_BACKEND": "sqlite",
+    "DB_PATH": os.path.join(_TMP, "gateway.db"),
+    "USAGE_SPOOL_DIR": os.path.join(_TMP, "usage_spool"),
+    "USAGE_ARCHIVE_DIR": os.path.join(_TMP, "usage_archive"),
+    "RATE_LIMIT_SQLITE_PATH": os.path.join(_TMP, "rate_limits.db"),
+    "USE_OPENAI_MOCK": "true",
+    "USE_ANTHROPIC_MOCK": "true",
+    "USE_LLAMA_MOCK": "true",
+    "TOKENIZER_USE_TIKTOKEN": "false",
+    "SECRET_KEY": "test",
+    "BCRYPT_ROUNDS": "4",
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backend.db import database  # noqa: E402
+
+_TABLES = ["usage_log", "usage_rollup_hourly", "usage_rollup_daily", "usage_rollup_total", "users"]
+
+
+@pytest.fixture
+def db():
+    """
+    The SQLite database with the schema applied; emptied after each test.
+    """
+    database.init_pool()
+    yield database
+    for table in _TABLES:
+        database.execute(f"DELETE FROM {table}")
+
+
+@pytest.fixture
+def client(db):
+    """
+    A TestClient on the app (startup and shutdown hooks included) plus the
+    auth headers of a freshly registered user.
+    """
+    from fastapi.testclient import TestClient
+    from backend.main import app
+
+    with TestClient(app) as test_client:
+        test_client.post("/register", json={"username": "alice", "email": "alice@example.com", "password": "pw"})
+        token = test_client.post("/token", data={"username": "alice", "password": "pw"}).json()["access_token"]
+        yield test_client, {"Authorization": f"Bearer {token}"}
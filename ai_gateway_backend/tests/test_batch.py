@@ -0,0 +1,34 @@
+from backend.services import rate_limiter as rate_limiter_module
+
+
+def _items(count: int, model_name: str = "gpt-4") -> list[dict]:
+    return [{"prompt": f"question {i}", "model_name": model_name, "max_tokens": 10} for i in range(count)]
+
+
+def test_batch_is_charged_once_against_the_request_rate(client, monkeypatch):
+    test_client, headers = client
+    monkeypatch.setattr(rate_limiter_module, "USER_REQUESTS_PER_SECOND", 0.001)
+    monkeypatch.setattr(rate_limiter_module, "USER_REQUEST_BURST", 2)
+
+    for _ in range(2):
+        response = test_client.post("/generate/batch", json={"items": _items(30), "cache": "bypass"}, headers=headers)
+        assert response.status_code == 200
+        assert response.json()["usage"]["succeeded"] == 30
+    response = test_client.post("/generate/batch", json={"items": _items(1), "cache": "bypass"}, headers=headers)
+    assert response.status_code == 429
+    assert "Retry-After" in response.headers
+
+
+def test_failed_items_carry_their_own_status(client):
+    test_client, headers = client
+    items = _items(2) + _items(1, model_name="no-such-model")
+    body = test_client.post("/generate/batch", json={"items": items}, headers=headers).json()
+    assert [result["index"] for result in body["results"]] == [0, 1, 2]
+    assert body["results"][2]["error"]["status"] == 400
+    assert body["usage"]["succeeded"] == 2
+    assert body["usage"]["failed"] == 1
+
+
+def test_batch_limits(client):
+    test_client, headers = client
+    assert test_client.post("/generate/batch", json={"items": []}, headers=headers).status_code == 400
@@ -0,0 +1,56 @@
+import pytest
+
+from backend.db import database
+
+
+def _idle() -> int:
+    return database.get_pool().stats()["idle"]
+
+
+def test_driver_error_is_typed_and_discards_the_connection(db):
+    database.fetch_one("SELECT 1 AS one")
+    idle = _idle()
+    with pytest.raises(database.DatabaseError):
+        with database.transaction() as tx:
+            tx.execute("SELECT * FROM no_such_table")
+    assert _idle() == idle - 1
+
+
+def test_integrity_error_keeps_the_connection(db):
+    insert = "INSERT INTO users (username, email, hashed_password) VALUES (%s, %s, %s)"
+    database.execute(insert, ("bob", "bob@example.com", "x"))
+    idle = _idle()
+    with pytest.raises(database.IntegrityError):
+        database.execute(insert, ("bob", "bob@example.com", "x"))
+    assert _idle() == idle
+
+
+def test_failed_rollback_does_not_replace_the_callers_error(db):
+    class Boom(Exception):
+        pass
+
+    with pytest.raises(Boom):
+        with database.transaction() as tx:
+            tx.conn.close()
+            raise Boom()
+
+
+def test_error_rolls_back_the_transaction(db):
+    with pytest.raises(RuntimeError):
+        with database.transaction() as tx:
+            tx.execute("INSERT INTO users (username, email, hashed_password) VALUES ('carol', 'c@example.com', 'x')")
+            raise RuntimeError()
+    assert database.fetch_one("SELECT id FROM users WHERE username = 'carol'") is None
+
+
+def test_register_maps_only_duplicates_to_400(client, monkeypatch):
+    test_client, _ = client
+    duplicate = {"username": "alice", "email": "alice@example.com", "password": "pw"}
+    assert test_client.post("/register", json=duplicate).status_code == 400
+
+    async def pool_exhausted(*args, **kwargs):
+        raise database.PoolTimeout("No database connection available within 5s")
+
+    monkeypatch.setattr(database, "run", pool_exhausted)
+    response = test_client.post("/register", json={"username": "bob", "email": "bob@example.com", "password": "pw"})
+    assert response.status_code == 503
@@ -0,0 +1,56 @@
+import threading
+
+import pytest
+
+from backend.services import metrics
+from backend.services.providers import registry
+from backend.services.usage_writer import UsageEvent
+
+
+def test_counter_sums_the_per_thread_shards():
+    counter = metrics.Counter("test_shards_total", "Test counter", ("kind",))
+    threads = [threading.Thread(target=lambda: [counter.inc(("a",)) for _ in range(1000)]) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    counter.inc(("b",), 2.5)
+    assert counter.totals() == {("a",): 4000, ("b",): 2.5}
+    assert 'test_shards_total{kind="a"} 4000' in counter.render()
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = metrics.Histogram("test_seconds", "Test histogram", buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value)
+    lines = histogram.render()
+    assert 'test_seconds_bucket{le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{le="1"} 2' in lines
+    assert 'test_seconds_bucket{le="+Inf"} 3' in lines
+    assert "test_seconds_count 3" in lines
+
+
+@pytest.mark.parametrize("model_name, label", [
+    ("gpt-4", "gpt-4"),
+    (" GPT-4 ", "gpt-4"),
+    ("claude-3-opus", "claude-3-opus-20240229"),
+    ("gpt-4-made-up-by-a-client", "unknown"),
+    ("no-such-model", "unknown"),
+])
+def test_model_labels_are_canonical_and_bounded(model_name, label):
+    assert registry.metric_label(model_name) == label
+
+
+def test_billed_usage_is_counted_under_the_canonical_model():
+    from backend.main import _count_usage
+
+    before = metrics.tokens_total.totals()
+    _count_usage([
+        UsageEvent("1", "GPT-4", 10, 20),
+        UsageEvent("1", "gpt-4-whatever", 1, 1),
+        UsageEvent("1", "gpt-4", 100, 100, cache_hit=True),
+    ])
+    after = metrics.tokens_total.totals()
+    assert after.get(("gpt-4", "input"), 0) - before.get(("gpt-4", "input"), 0) == 10
+    assert after.get(("unknown", "output"), 0) - before.get(("unknown", "output"), 0) == 1
+    assert ("GPT-4", "input") not in after
@@ -0,0 +1,137 @@
+import asyncio
+
+import pytest
+
+from backend.services import rate_limiter as rate_limiter_module
+from backend.services.rate_limiter import MemoryBackend, RateLimited, RateLimiter
+
+
+@pytest.fixture(autouse=True)
+def limits(monkeypatch):
+    monkeypatch.setattr(rate_limiter_module, "USER_REQUESTS_PER_SECOND", 1)
+    monkeypatch.setattr(rate_limiter_module, "USER_REQUEST_BURST", 100)
+    monkeypatch.setattr(rate_limiter_module, "USER_TOKENS_PER_MINUTE", 1000)
+    monkeypatch.setattr(rate_limiter_module, "MODEL_REQUESTS_PER_SECOND", {})
+    monkeypatch.setattr(rate_limiter_module, "MODEL_TOKENS_PER_MINUTE", {})
+    monkeypatch.setattr(rate_limiter_module, "USER_DAILY_BUDGET_USD", 0)
+    monkeypatch.setattr(rate_limiter_module, "USER_MONTHLY_BUDGET_USD", 0)
+
+
+def test_bucket_refuses_without_taking_and_reports_the_wait():
+    backend = MemoryBackend()
+    assert backend.take("k", 8, rate=1, capacity=10) == 0
+    wait = backend.take("k", 8, rate=1, capacity=10)
+    assert 5.9 < wait <= 6
+    backend.give("k", 8, capacity=10)
+    assert backend.take("k", 8, rate=1, capacity=10) == 0
+
+
+def test_settle_refunds_unused_tokens():
+    async def run():
+        limiter = RateLimiter(MemoryBackend())
+        first = await limiter.reserve(1, "gpt-4", "hi", max_tokens=600)
+        with pytest.raises(RateLimited):
+            await limiter.reserve(1, "gpt-4", "hi", max_tokens=600)
+        await limiter.settle(first, input_tokens=5, output_tokens=5)
+        await limiter.reserve(1, "gpt-4", "hi", max_tokens=600)
+        return limiter.stats()
+
+    stats = asyncio.run(run())
+    assert stats["allowed"] == 2
+    assert stats["rate_limited"] == 1
+
+
+def test_rejected_reservation_charges_nothing(monkeypatch):
+    monkeypatch.setattr(rate_limiter_module, "USER_REQUESTS_PER_SECOND", 0.001)
+    monkeypatch.setattr(rate_limiter_module, "USER_REQUEST_BURST", 2)
+
+    async def run():
+        backend = MemoryBackend()
+        limiter = RateLimiter(backend)
+        await limiter.reserve(1, "gpt-4", "hi", max_tokens=900)
+        # The request bucket is taken first; the token bucket then refuses and it is given back
+        with pytest.raises(RateLimited) as error:
+            await limiter.reserve(1, "gpt-4", "hi", max_tokens=900)
+        return backend, error.value
+
+    backend, error = asyncio.run(run())
+    assert error.retry_after >= 1
+    assert "token rate" in str(error)
+    assert backend._buckets["rps:1"][0] == pytest.approx(1, abs=0.01)
+
+
+def test_settle_is_idempotent():
+    async def run():
+        limiter = RateLimiter(MemoryBackend())
+        reservation = await limiter.reserve(1, "gpt-4", "hi", max_tokens=600)
+        await limiter.settle(reservation)
+        await limiter.settle(reservation)
+        return limiter
+
+    limiter = asyncio.run(run())
+    tokens, _ = limiter._backend._buckets["tpm:1"]
+    assert tokens == pytest.approx(1000, abs=1)
+
+
+def test_budget_is_reserved_at_worst_case_and_settled_to_actual_cost(db, monkeypatch):
+    # gpt-4 output is $0.06 per 1K tokens, so 1000 max_tokens reserve just over $0.06
+    monkeypatch.setattr(rate_limiter_module, "USER_TOKENS_PER_MINUTE", 0)
+    monkeypatch.setattr(rate_limiter_module, "USER_DAILY_BUDGET_USD", 0.1)
+
+    async def run():
+        limiter = RateLimiter(MemoryBackend())
+        first = await limiter.reserve(1, "gpt-4", "hi", max_tokens=1000)
+        with pytest.raises(RateLimited) as error:
+            await limiter.reserve(1, "gpt-4", "hi", max_tokens=1000)
+        await limiter.settle(first, input_tokens=5, output_tokens=5, cost_usd=0.001)
+        await limiter.reserve(1, "gpt-4", "hi", max_tokens=1000)
+        return limiter, error.value
+
+    limiter, error = asyncio.run(run())
+    assert "Budget" in str(error)
+    assert limiter.over_budget == 1
+
+
+@pytest.mark.parametrize("spelling", [" gpt-4", "GPT-4\t", "Gpt-4"])
+def test_model_limits_apply_however_the_model_is_spelled(monkeypatch, spelling):
+    monkeypatch.setattr(rate_limiter_module, "MODEL_REQUESTS_PER_SECOND", {"gpt-4": 0.001})
+
+    async def run():
+        limiter = RateLimiter(MemoryBackend())
+        reservation = await limiter.reserve(1, "gpt-4", "hi", max_tokens=10)
+        with pytest.raises(RateLimited) as error:
+            await limiter.reserve(1, spelling, "hi", max_tokens=10)
+        with pytest.raises(RateLimited):
+            await limiter.reserve_requests(1, {spelling})
+        return reservation, error.value
+
+    reservation, error = asyncio.run(run())
+    assert reservation.model_name == "gpt-4"
+    assert "gpt-4 request rate" in str(error)
+
+
+def test_model_token_limits_apply_to_aliases(monkeypatch):
+    monkeypatch.setattr(rate_limiter_module, "MODEL_TOKENS_PER_MINUTE",
+                        rate_limiter_module._parse_rates("claude-3-opus=100"))
+
+    async def run():
+        limiter = RateLimiter(MemoryBackend())
+        await limiter.reserve(1, "claude-3-opus-20240229", "hi", max_tokens=90)
+        with pytest.raises(RateLimited) as error:
+            await limiter.reserve(1, "CLAUDE-3-OPUS", "hi", max_tokens=90)
+        return error.value
+
+    assert "claude-3-opus-20240229 token rate" in str(asyncio.run(run()))
+
+
+def test_batch_with_only_unknown_models_still_charges_the_user(monkeypatch):
+    monkeypatch.setattr(rate_limiter_module, "USER_REQUESTS_PER_SECOND", 0.001)
+    monkeypatch.setattr(rate_limiter_module, "USER_REQUEST_BURST", 1)
+
+    async def run():
+        limiter = RateLimiter(MemoryBackend())
+        await limiter.reserve_requests(1, {"no-such-model"})
+        with pytest.raises(RateLimited):
+            await limiter.reserve_requests(1, {"no-such-model"})
+
+    asyncio.run(run())
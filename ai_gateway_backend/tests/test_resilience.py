@@ -0,0 +1,104 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+
+import pytest
+
+from backend.services import resilience
+from backend.services.resilience import (
+    Deadline, DeadlineExceeded, ProviderRejected, ProviderUnavailable, call_with_retries, classify_status,
+    parse_retry_after,
+)
+
+
+@pytest.mark.parametrize("headers, expected", [
+    (None, None),
+    ({}, None),
+    ({"retry-after": "7"}, 7.0),
+    ({"retry-after": "1.5"}, 1.5),
+    ({"retry-after": "-3"}, 0.0),
+    ({"retry-after-ms": "250", "retry-after": "7"}, 0.25),
+    ({"retry-after-ms": "soon", "retry-after": "7"}, 7.0),
+    ({"retry-after": "whenever"}, None),
+])
+def test_parse_retry_after(headers, expected):
+    assert parse_retry_after(headers) == expected
+
+
+def test_parse_retry_after_http_date():
+    when = datetime.now(timezone.utc) + timedelta(seconds=30)
+    assert 28 <= parse_retry_after({"retry-after": format_datetime(when, usegmt=True)}) <= 30
+
+
+@pytest.mark.parametrize("status, retryable", [(429, True), (503, True), (408, True), (400, False), (404, False)])
+def test_classify_status(status, retryable):
+    error = classify_status("openai", status, "failed", {"retry-after": "2"})
+    assert error.retryable is retryable
+    assert isinstance(error, ProviderUnavailable if retryable else ProviderRejected)
+    assert error.retry_after == 2.0
+
+
+def _attempts(*outcomes):
+    # An attempt function failing with, or returning, each outcome in turn
+    calls = []
+
+    async def attempt(timeout):
+        outcome = outcomes[len(calls)]
+        calls.append(timeout)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    return attempt, calls
+
+
+def test_retryable_errors_are_retried(monkeypatch):
+    monkeypatch.setattr(resilience, "PROVIDER_MAX_RETRIES", 3)
+    attempt, calls = _attempts(ProviderUnavailable("openai", "503", 503, retry_after=0),
+                               ProviderUnavailable("openai", "503", 503, retry_after=0), "ok")
+    assert asyncio.run(call_with_retries(attempt, Deadline.after(5), "openai")) == "ok"
+    assert len(calls) == 3
+
+
+def test_gives_up_after_max_retries(monkeypatch):
+    monkeypatch.setattr(resilience, "PROVIDER_MAX_RETRIES", 1)
+    attempt, calls = _attempts(*[ProviderUnavailable("openai", "503", 503, retry_after=0)] * 3)
+    with pytest.raises(ProviderUnavailable):
+        asyncio.run(call_with_retries(attempt, Deadline.after(5), "openai"))
+    assert len(calls) == 2
+
+
+def test_rejections_are_not_retried():
+    attempt, calls = _attempts(ProviderRejected("openai", "400", 400), "ok")
+    with pytest.raises(ProviderRejected):
+        asyncio.run(call_with_retries(attempt, Deadline.after(5), "openai"))
+    assert len(calls) == 1
+
+
+def test_long_retry_after_is_left_to_the_router(monkeypatch):
+    monkeypatch.setattr(resilience, "PROVIDER_RETRY_MAX", 8)
+    attempt, calls = _attempts(ProviderUnavailable("openai", "429", 429, retry_after=60), "ok")
+    with pytest.raises(ProviderUnavailable):
+        asyncio.run(call_with_retries(attempt, Deadline.after(120), "openai"))
+    assert len(calls) == 1
+
+
+def test_attempt_timeout_is_bounded_by_the_deadline():
+    attempt, calls = _attempts("ok")
+    asyncio.run(call_with_retries(attempt, Deadline.after(2), "openai"))
+    assert calls[0] <= 2
+
+
+def test_hung_attempt_past_the_deadline_raises_deadline_exceeded():
+    async def attempt(timeout):
+        await asyncio.sleep(10)
+
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(call_with_retries(attempt, Deadline.after(0.05), "openai"))
+
+
+def test_expired_deadline_makes_no_call():
+    attempt, calls = _attempts("ok")
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(call_with_retries(attempt, Deadline(0), "openai"))
+    assert calls == []
@@ -0,0 +1,158 @@
+import asyncio
+
+import pytest
+
+from backend.services import routing
+from backend.services.resilience import ProviderRejected, ProviderUnavailable
+from backend.services.routing import CLOSED, HALF_OPEN, OPEN, ProviderHealth, Router, RoutingPolicy
+
+
+@pytest.fixture(autouse=True)
+def breaker_settings(monkeypatch):
+    monkeypatch.setattr(routing, "BREAKER_FAILURE_THRESHOLD", 3)
+    monkeypatch.setattr(routing, "BREAKER_COOLDOWN", 30)
+
+
+def _trip(health: ProviderHealth):
+    for _ in range(routing.BREAKER_FAILURE_THRESHOLD):
+        health.begin()
+        health.record_failure()
+
+
+def _cool_down(health: ProviderHealth):
+    health.opened_at -= routing.BREAKER_COOLDOWN
+
+
+def test_breaker_opens_after_consecutive_failures():
+    health = ProviderHealth("openai")
+    for _ in range(routing.BREAKER_FAILURE_THRESHOLD - 1):
+        health.record_failure()
+    assert health.state == CLOSED
+    health.record_failure()
+    assert health.state == OPEN
+    assert not health.is_available()
+
+
+def test_success_resets_the_failure_streak():
+    health = ProviderHealth("openai")
+    for _ in range(routing.BREAKER_FAILURE_THRESHOLD - 1):
+        health.record_failure()
+    health.record_success(0.1)
+    health.record_failure()
+    assert health.state == CLOSED
+
+
+def test_half_open_lets_a_single_probe_through():
+    health = ProviderHealth("openai")
+    _trip(health)
+    _cool_down(health)
+    assert health.is_available()
+    assert health.state == HALF_OPEN
+    health.begin()
+    assert not health.is_available()
+
+
+def test_probe_outcome_closes_or_reopens():
+    health = ProviderHealth("openai")
+    _trip(health)
+    _cool_down(health)
+    health.is_available()
+    health.begin()
+    health.record_success(0.1)
+    assert health.state == CLOSED
+
+    _trip(health)
+    _cool_down(health)
+    health.is_available()
+    health.begin()
+    health.record_failure()
+    assert health.state == OPEN
+
+
+def test_cancelled_probe_frees_the_half_open_slot():
+    health = ProviderHealth("openai")
+    _trip(health)
+    _cool_down(health)
+    health.is_available()
+    health.begin()
+    health.record_cancelled()
+    assert health.state == HALF_OPEN
+    assert health.is_available()
+
+
+def _router(config: dict) -> Router:
+    # Every model is its own provider
+    return Router(lambda model: model, RoutingPolicy(config))
+
+
+def test_provider_failure_falls_back_and_counts_against_the_breaker():
+    router = _router({"fallbacks": {"primary": ["backup"]}})
+    calls = []
+
+    async def call(model):
+        calls.append(model)
+        if model == "primary":
+            raise ProviderUnavailable(model, "503", 503)
+        return model
+
+    assert asyncio.run(router.run("primary", call)) == "backup"
+    assert calls == ["primary", "backup"]
+    assert router.health("primary").consecutive_failures == 1
+    assert router.fallbacks == 1
+
+
+@pytest.mark.parametrize("error", [ProviderRejected("primary", "400", 400), ValueError("bad request")])
+def test_request_errors_neither_fall_back_nor_trip_the_breaker(error):
+    router = _router({"fallbacks": {"primary": ["backup"]}})
+    calls = []
+
+    async def call(model):
+        calls.append(model)
+        raise error
+
+    with pytest.raises(type(error)):
+        asyncio.run(router.run("primary", call))
+    assert calls == ["primary"]
+    assert router.health("primary").consecutive_failures == 0
+
+
+def test_open_breaker_is_skipped_for_its_fallback():
+    router = _router({"fallbacks": {"primary": ["backup"]}})
+    _trip(router.health("primary"))
+    assert router.candidates("primary") == ["backup"]
+
+
+def test_open_breaker_without_fallback_sheds_the_call():
+    router = _router({})
+    _trip(router.health("primary"))
+    router.health("primary").opened_at -= routing.BREAKER_COOLDOWN - 5
+    calls = []
+
+    async def call(model):
+        calls.append(model)
+        return model
+
+    with pytest.raises(ProviderUnavailable) as error:
+        asyncio.run(router.run("primary", call))
+    assert calls == []
+    assert error.value.retryable
+    assert 4 <= error.value.retry_after <= 5
+    # The breaker still recovers through a half-open probe once the cooldown is over
+    _cool_down(router.health("primary"))
+    assert asyncio.run(router.run("primary", call)) == "primary"
+    assert router.health("primary").state == CLOSED
+
+
+def test_everything_open_sheds_with_the_shortest_cooldown():
+    router = _router({"fallbacks": {"primary": ["backup"]}})
+    _trip(router.health("primary"))
+    _trip(router.health("backup"))
+    router.health("backup").opened_at -= routing.BREAKER_COOLDOWN - 2
+    with pytest.raises(ProviderUnavailable) as error:
+        router.candidates("primary")
+    assert 1 <= error.value.retry_after <= 2
+
+
+def test_shipped_policy_has_no_cross_vendor_fallback():
+    policy = RoutingPolicy.load(routing.ROUTING_POLICY_PATH)
+    assert policy.alternatives("gpt-4") == []
@@ -0,0 +1,98 @@
+import asyncio
+
+import pytest
+
+from backend.services import scheduler as scheduler_module
+from backend.services.scheduler import Overloaded, Scheduler, _Limiter
+
+
+def test_admits_up_to_the_limit_without_queueing():
+    async def run():
+        limiter = _Limiter("openai", 2)
+        await limiter.acquire(0, 1)
+        await limiter.acquire(0, 1)
+        return limiter.active, limiter.queued
+
+    assert asyncio.run(run()) == (2, 0)
+
+
+def test_freed_slot_goes_to_interactive_before_batch():
+    async def run():
+        limiter = _Limiter("openai", 1)
+        await limiter.acquire(0, 1)
+        order = []
+
+        async def wait(priority, name):
+            await limiter.acquire(priority, 5)
+            order.append(name)
+
+        batch = asyncio.create_task(wait(1, "batch"))
+        await asyncio.sleep(0)
+        interactive = asyncio.create_task(wait(0, "interactive"))
+        await asyncio.sleep(0)
+        limiter.release()
+        await interactive
+        limiter.release()
+        await batch
+        return order
+
+    assert asyncio.run(run()) == ["interactive", "batch"]
+
+
+def test_full_queue_is_rejected(monkeypatch):
+    monkeypatch.setattr(scheduler_module, "SCHEDULER_MAX_QUEUE", 1)
+
+    async def run():
+        limiter = _Limiter("openai", 1)
+        await limiter.acquire(0, 1)
+        waiter = asyncio.create_task(limiter.acquire(0, 5))
+        await asyncio.sleep(0)
+        with pytest.raises(Overloaded) as error:
+            await limiter.acquire(0, 5)
+        waiter.cancel()
+        return limiter.rejected, error.value.retry_after
+
+    rejected, retry_after = asyncio.run(run())
+    assert rejected == 1
+    assert retry_after >= 1
+
+
+def test_wait_past_the_deadline_times_out_and_leaves_the_queue():
+    async def run():
+        limiter = _Limiter("openai", 1)
+        await limiter.acquire(0, 1)
+        with pytest.raises(Overloaded):
+            await limiter.acquire(0, 0.01)
+        return limiter.timed_out, limiter.queued
+
+    assert asyncio.run(run()) == (1, 0)
+
+
+def test_slot_is_released_after_the_block(monkeypatch):
+    monkeypatch.setattr(scheduler_module, "PROVIDER_CONCURRENCY_LIMITS", {"openai": 1})
+
+    async def run():
+        scheduler = Scheduler()
+        async with scheduler.slot("openai", "gpt-4"):
+            pass
+        async with scheduler.slot("openai", "gpt-4"):
+            pass
+        return scheduler.stats()["providers"]["openai"]
+
+    stats = asyncio.run(run())
+    assert stats["active"] == 0
+    assert stats["admitted"] == 2
+
+
+def test_overloaded_provider_returns_429_with_retry_after(client, monkeypatch):
+    test_client, headers = client
+    from backend.services.scheduler import scheduler
+
+    busy = _Limiter("openai", 1)
+    busy.active = 1
+    monkeypatch.setattr(scheduler_module, "SCHEDULER_MAX_QUEUE", 0)
+    monkeypatch.setitem(scheduler._providers, "openai", busy)
+    response = test_client.post("/generate", json={"prompt": "hi", "model_name": "gpt-4", "cache": "bypass"},
+                                headers=headers)
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
@@ -0,0 +1,56 @@
+import asyncio
+
+from backend.services.sessions import SessionStore
+
+
+def test_turns_build_on_the_same_prefix(client):
+    test_client, headers = client
+    session_id = test_client.post("/sessions", json={"model_name": "gpt-4", "system": "be brief"},
+                                  headers=headers).json()["session_id"]
+    for content in ("hi", "again"):
+        assert test_client.post(f"/sessions/{session_id}/messages", json={"content": content},
+                                headers=headers).status_code == 200
+    session = test_client.get(f"/sessions/{session_id}", headers=headers).json()
+    assert session["turns"] == 2
+    assert [message["content"] for message in session["messages"][::2]] == ["hi", "again"]
+
+
+def test_unknown_session_takes_no_lock(client):
+    test_client, headers = client
+    from backend.services.sessions import session_store
+
+    response = test_client.post("/sessions/does-not-exist/messages", json={"content": "hi"}, headers=headers)
+    assert response.status_code == 404
+    assert "does-not-exist" not in session_store._locks
+
+
+def test_evicted_sessions_spill_to_disk_and_come_back(tmp_path):
+    async def run():
+        store = SessionStore(max_in_memory=1, disk_path=str(tmp_path / "sessions.db"))
+        store.start()
+        first = await store.create(1, "gpt-4")
+        await store.create(1, "gpt-4")
+        spilled = store.stats()["on_disk"]
+        loaded = await store.get(first.session_id, 1)
+        other_user = await store.get(first.session_id, 2)
+        store.close()
+        return spilled, loaded, other_user
+
+    spilled, loaded, other_user = asyncio.run(run())
+    assert spilled == 1
+    assert loaded is not None
+    assert other_user is None
+
+
+def test_sessions_beyond_memory_are_dropped_without_a_disk_path():
+    async def run():
+        store = SessionStore(max_in_memory=1, disk_path="")
+        store.start()
+        first = await store.create(1, "gpt-4")
+        await store.create(1, "gpt-4")
+        return store.stats(), await store.get(first.session_id, 1)
+
+    stats, evicted = asyncio.run(run())
+    assert stats["dropped"] == 1
+    assert stats["on_disk"] == 0
+    assert evicted is None
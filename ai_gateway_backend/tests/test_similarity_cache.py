@@ -0,0 +1,52 @@
+from backend.services.similarity_cache import SimilarityCache
+
+TEMPLATE = ("Summarize the following support ticket in two sentences for the on-call engineer. "
+            "Customer {name} reports that exports from the billing dashboard time out after thirty "
+            "seconds whenever the date range covers more than one quarter of invoices and line items.")
+
+
+def _cache(**kwargs) -> SimilarityCache:
+    return SimilarityCache(models={"*"}, **kwargs)
+
+
+def test_near_duplicate_prompt_is_served():
+    cache = _cache(threshold=0.7)
+    cache.set(cache.fingerprint("gpt-4", TEMPLATE.format(name="Alice")), ("summary", 40, 20))
+    hit = cache.get(cache.fingerprint("gpt-4", TEMPLATE.format(name="Bob")))
+    assert hit is not None
+    value, similarity = hit
+    assert value == ("summary", 40, 20)
+    assert 0.7 <= similarity < 1.0
+
+
+def test_unrelated_prompt_misses():
+    cache = _cache(threshold=0.7)
+    cache.set(cache.fingerprint("gpt-4", TEMPLATE.format(name="Alice")), ("summary", 40, 20))
+    assert cache.get(cache.fingerprint("gpt-4", "Write a haiku about the sea at dawn, with gulls and salt")) is None
+    assert cache.misses == 1
+
+
+def test_threshold_decides_between_hit_and_miss():
+    strict = _cache(threshold=0.99)
+    strict.set(strict.fingerprint("gpt-4", TEMPLATE.format(name="Alice")), ("summary", 40, 20))
+    assert strict.get(strict.fingerprint("gpt-4", TEMPLATE.format(name="Bob Smith of Acme"))) is None
+    assert strict.get(strict.fingerprint("gpt-4", TEMPLATE.format(name="Alice"))) is not None
+
+
+def test_other_model_or_parameters_never_match():
+    cache = _cache(threshold=0.5)
+    prompt = TEMPLATE.format(name="Alice")
+    cache.set(cache.fingerprint("gpt-4", prompt, max_tokens=100), ("summary", 40, 20))
+    assert cache.get(cache.fingerprint("claude-3-opus", prompt, max_tokens=100)) is None
+    assert cache.get(cache.fingerprint("gpt-4", prompt, max_tokens=200)) is None
+    assert cache.get(cache.fingerprint("gpt-4", prompt, max_tokens=100)) is not None
+
+
+def test_prompt_without_words_has_no_fingerprint():
+    assert _cache().fingerprint("gpt-4", "?!  ...") is None
+
+
+def test_only_listed_models_are_enabled():
+    cache = SimilarityCache(models={"claude-3-opus"})
+    assert cache.enabled_for("claude-3-opus-20240229")
+    assert not cache.enabled_for("gpt-4")
@@ -0,0 +1,93 @@
+import pytest
+
+from backend.services import tokenizer
+from backend.services.tokenizer import PromptRejected
+
+
+def test_counts_grow_with_the_prompt_and_include_chat_overhead():
+    short = tokenizer.estimate("gpt-4", "hello", 10).input_tokens
+    longer = tokenizer.estimate("gpt-4", "hello " * 100, 10).input_tokens
+    assert 0 < short < longer
+    messages = [{"role": "system", "content": "be brief"}, {"role": "user", "content": "hello"}]
+    assert tokenizer.estimate("gpt-4", messages, 10).input_tokens > short
+
+
+def test_cjk_counts_more_than_a_word_count():
+    assert tokenizer.estimate("gpt-4", "你好世界" * 50, 10).input_tokens > 200
+
+
+def test_preflight_rejects_a_prompt_over_the_context_window():
+    with pytest.raises(PromptRejected) as error:
+        tokenizer.preflight("gpt-4", "word " * 9000, 100)
+    assert "8192-token context of gpt-4" in str(error.value)
+
+
+def test_preflight_counts_max_tokens_against_the_context_window():
+    tokenizer.preflight("gpt-4", "hello", 8000)
+    with pytest.raises(PromptRejected):
+        tokenizer.preflight("gpt-4", "hello", 8192)
+
+
+def test_preflight_rejects_a_request_over_the_cost_limit(monkeypatch):
+    monkeypatch.setattr(tokenizer, "MAX_REQUEST_COST_USD", 0.01)
+    # gpt-4 output is $0.06 per 1K tokens
+    tokenizer.preflight("gpt-4", "hello", 100)
+    with pytest.raises(PromptRejected) as error:
+        tokenizer.preflight("gpt-4", "hello", 1000)
+    assert "per-request limit" in str(error.value)
+
+
+def test_unknown_model_is_a_value_error():
+    with pytest.raises(ValueError):
+        tokenizer.estimate("no-such-model", "hello", 10)
+
+
+def test_invented_model_names_share_one_encoder_load(monkeypatch):
+    encoders = tokenizer._Encoders()
+    loads = []
+
+    def load(key):
+        loads.append(key)
+        encoders._model_encodings[key] = "cl100k_base"
+
+    class Thread:
+        def __init__(self, target, args, **kwargs):
+            self.run = lambda: target(*args)
+
+        def start(self):
+            self.run()
+
+    monkeypatch.setattr(encoders, "_load", load)
+    monkeypatch.setattr(tokenizer.threading, "Thread", Thread)
+    monkeypatch.setattr(tokenizer, "_encoders", encoders)
+    monkeypatch.setattr(tokenizer, "TOKENIZER_USE_TIKTOKEN", True)
+
+    for i in range(50):
+        tokenizer.encoding_for(f"gpt-{i}-made-up")
+    tokenizer.encoding_for("gpt-4")
+    tokenizer.encoding_for(" GPT-4 ")
+    assert loads == ["unknown", "gpt-4"]
+    assert encoders.loaded() == {"unknown": "cl100k_base", "gpt-4": "cl100k_base"}
+
+
+def test_oversized_prompt_is_rejected_before_dispatch(client):
+    test_client, headers = client
+    response = test_client.post("/generate", json={"prompt": "word " * 9000, "model_name": "gpt-4"}, headers=headers)
+    assert response.status_code == 400
+    assert "context" in response.json()["detail"]
+
+
+@pytest.mark.parametrize("max_tokens", [0, -1, 10 ** 9])
+def test_out_of_range_max_tokens_is_a_422(client, max_tokens):
+    test_client, headers = client
+    for path in ("/generate", "/estimate"):
+        response = test_client.post(path, json={"prompt": "hi", "model_name": "gpt-4", "max_tokens": max_tokens},
+                                    headers=headers)
+        assert response.status_code == 422
+
+
+def test_estimate_reports_the_rejection(client):
+    test_client, headers = client
+    body = test_client.post("/estimate", json={"prompt": "word " * 9000, "model_name": "gpt-4"}, headers=headers).json()
+    assert body["accepted"] is False
+    assert body["input_tokens"] > 8192 - 100
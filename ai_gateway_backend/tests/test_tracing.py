@@ -0,0 +1,41 @@
+import asyncio
+import json
+import threading
+
+from backend.services import tracing
+from backend.services.tracing import SlowRequestLog, Trace
+
+
+def _finished(name: str) -> Trace:
+    trace = Trace(name)
+    trace.root.end_ns = trace.root.start_ns + 6 * 10 ** 9
+    return trace
+
+
+def test_slow_log_file_is_written_off_the_event_loop(tmp_path, monkeypatch):
+    path = tmp_path / "slow.jsonl"
+    monkeypatch.setattr(tracing, "TRACE_SLOW_LOG_PATH", str(path))
+    writers = []
+    append = SlowRequestLog._append
+
+    def recording_append(summaries):
+        writers.append(threading.current_thread())
+        append(summaries)
+
+    monkeypatch.setattr(SlowRequestLog, "_append", staticmethod(recording_append))
+
+    async def run():
+        log = SlowRequestLog()
+        for index in range(3):
+            log.record(_finished(f"GET /slow/{index}"))
+        # Recorded, but nothing written from the request path itself
+        written_inline = path.exists()
+        await log.flush()
+        return log, written_inline
+
+    log, written_inline = asyncio.run(run())
+    assert not written_inline
+    assert threading.main_thread() not in writers
+    with open(path) as f:
+        assert [json.loads(line)["name"] for line in f] == [f"GET /slow/{index}" for index in range(3)]
+    assert [entry["name"] for entry in log.recent(3)] == [f"GET /slow/{index}" for index in (2, 1, 0)]
@@ -0,0 +1,63 @@
+from datetime import datetime
+
+import pytest
+
+from backend.db import database, usage_archive
+
+INSERT = ("INSERT INTO usage_log (user_id, model_name, input_tokens, output_tokens, timestamp, cost_usd, cache_hit) "
+          "VALUES (%s, %s, %s, %s, %s, %s, %s)")
+NOW = datetime(2026, 6, 1)
+
+
+@pytest.fixture
+def archive(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(usage_archive, "USAGE_ARCHIVE_DIR", str(tmp_path))
+    monkeypatch.setattr(usage_archive, "USAGE_RETENTION_DAYS", 30)
+    return usage_archive
+
+
+def _insert(tokens: int, timestamp: datetime):
+    database.execute(INSERT, ("7", "gpt-4", tokens, tokens, timestamp, 0.001, False))
+
+
+def test_expired_months_move_to_the_archive(archive):
+    for day in range(1, 4):
+        _insert(day, datetime(2026, 1, day))
+    _insert(99, datetime(2026, 5, 20))
+    assert archive.archive_expired(NOW) == 3
+    assert database.fetch_one("SELECT COUNT(*) AS n FROM usage_log")["n"] == 1
+    rows = list(archive.read_archive(7))
+    assert [row["input_tokens"] for row in rows] == [3, 2, 1]
+
+
+def test_late_rows_are_archived_once(archive):
+    for day in range(1, 4):
+        _insert(day, datetime(2026, 1, day))
+    # A crash after the export left the rows in usage_log as well
+    archive._export(datetime(2026, 1, 1), datetime(2026, 2, 1))
+    assert archive.archive_expired(NOW) == 0
+    _insert(50, datetime(2026, 1, 15))
+    assert archive.archive_expired(NOW) == 1
+    assert archive.archive_expired(NOW) == 0
+    assert len(archive.archive_files()) == 2
+    assert sorted(row["input_tokens"] for row in archive.read_archive(7)) == [1, 2, 3, 50]
+
+
+def test_nothing_is_archived_without_retention(archive, monkeypatch):
+    monkeypatch.setattr(usage_archive, "USAGE_RETENTION_DAYS", 0)
+    _insert(1, datetime(2020, 1, 1))
+    assert archive.archive_expired(NOW) == 0
+    assert archive.archived_before() is None
+
+
+def test_percentiles_count_rows_left_behind_by_a_crash_once(archive):
+    from backend.services import analytics
+
+    for day in range(1, 4):
+        _insert(day, datetime(2026, 1, day))
+    # Exported, then the process died before deleting them from usage_log
+    archive._export(datetime(2026, 1, 1), datetime(2026, 2, 1))
+    _insert(4, datetime(2026, 1, 4))
+    result = analytics.token_percentiles(7, datetime(2026, 1, 1), NOW, [50])
+    assert result["models"]["gpt-4"]["requests"] == 4
+    assert result["models"]["gpt-4"]["input_tokens"]["p50"] == 2.5
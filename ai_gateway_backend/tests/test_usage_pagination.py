@@ -0,0 +1,59 @@
+import json
+from datetime import datetime, timedelta
+
+from backend.db import database
+
+INSERT = ("INSERT INTO usage_log (user_id, model_name, input_tokens, output_tokens, timestamp, cost_usd, cache_hit) "
+          "VALUES (%s, %s, %s, %s, %s, %s, %s)")
+
+
+def _seed(user_id: str, count: int) -> list[int]:
+    # Pairs of rows share a timestamp, so pages have to break ties on id
+    start = datetime(2026, 3, 1, 12)
+    database.executemany(INSERT, [
+        (user_id, "gpt-4", i, i, start + timedelta(minutes=i // 2), 0.001, False) for i in range(count)
+    ])
+    rows = database.fetch_all("SELECT id FROM usage_log WHERE user_id = %s ORDER BY timestamp DESC, id DESC",
+                              (user_id,))
+    return [row["id"] for row in rows]
+
+
+def _user_id() -> str:
+    return str(database.fetch_one("SELECT id FROM users WHERE username = 'alice'")["id"])
+
+
+def test_cursor_pages_cover_every_row_once_in_order(client):
+    test_client, headers = client
+    expected = _seed(_user_id(), 7)
+    _seed("someone-else", 3)
+
+    seen = []
+    cursor = None
+    while True:
+        params = {"limit": 2} if cursor is None else {"limit": 2, "cursor": cursor}
+        page = test_client.get("/usage", params=params, headers=headers).json()
+        seen.extend(row["id"] for row in page["usage"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert seen == expected
+
+
+def test_last_full_page_has_no_cursor(client):
+    test_client, headers = client
+    _seed(_user_id(), 4)
+    page = test_client.get("/usage", params={"limit": 4}, headers=headers).json()
+    assert len(page["usage"]) == 4
+    assert page["next_cursor"] is None
+
+
+def test_invalid_cursor_is_a_400(client):
+    test_client, headers = client
+    assert test_client.get("/usage", params={"cursor": "not-a-cursor"}, headers=headers).status_code == 400
+
+
+def test_ndjson_export_streams_every_row(client):
+    test_client, headers = client
+    expected = _seed(_user_id(), 5)
+    response = test_client.get("/usage", params={"format": "ndjson", "limit": 1}, headers=headers)
+    assert [json.loads(line)["id"] for line in response.text.splitlines()] == expected
@@ -0,0 +1,105 @@
+import asyncio
+import os
+
+from backend.db import database
+from backend.services import usage_writer as usage_writer_module
+from backend.services.usage_writer import UsageEvent, UsageWriter
+
+
+def _logged(user_id: str) -> list[int]:
+    rows = database.fetch_all("SELECT input_tokens FROM usage_log WHERE user_id = %s", (user_id,))
+    return sorted(row["input_tokens"] for row in rows)
+
+
+def test_flush_writes_events_and_rollups(db, tmp_path):
+    async def run():
+        writer = UsageWriter(str(tmp_path))
+        writer.record_many([UsageEvent("u1", "gpt-4", i, 1) for i in range(3)])
+        return await writer.flush(), writer.stats()
+
+    written, stats = asyncio.run(run())
+    assert written == 3
+    assert stats["pending"] == 0
+    assert stats["spool_segments"] == 0
+    assert _logged("u1") == [0, 1, 2]
+    assert database.fetch_one("SELECT requests FROM usage_rollup_total WHERE user_id = 'u1'")["requests"] == 3
+
+
+def test_queue_is_capped_while_the_database_is_down(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(usage_writer_module, "USAGE_MAX_PENDING", 10)
+    monkeypatch.setattr(usage_writer_module, "USAGE_FLUSH_BATCH_SIZE", 4)
+    run_query = database.run
+
+    async def down(*args, **kwargs):
+        raise database.DatabaseError("down")
+
+    async def run():
+        writer = UsageWriter(str(tmp_path))
+        monkeypatch.setattr(database, "run", down)
+        for i in range(50):
+            writer.record(UsageEvent("u2", "gpt-4", i, 1))
+        await writer.flush()
+        while_down = writer.stats()
+        monkeypatch.setattr(database, "run", run_query)
+        written = await writer.flush()
+        return while_down, written, writer.stats()
+
+    while_down, written, after = asyncio.run(run())
+    assert while_down["pending"] == 10
+    assert while_down["spilled"] is True
+    assert written == 50
+    assert after["spilled"] is False
+    assert _logged("u2") == list(range(50))
+    assert os.listdir(tmp_path) == []
+
+
+def test_orphaned_segments_are_replayed_once(db, tmp_path):
+    async def run():
+        crashed = UsageWriter(str(tmp_path))
+        crashed.record_many([UsageEvent("u3", "gpt-4", i, 1) for i in range(5)])
+        for segment in crashed._segments:
+            # Releases the lock, as the process dying would
+            os.close(segment.fd)
+        writer = UsageWriter(str(tmp_path))
+        await writer.start()
+        await writer.stop()
+
+    asyncio.run(run())
+    assert _logged("u3") == list(range(5))
+
+
+def test_poison_event_is_dead_lettered_and_the_rest_flushed(db, tmp_path):
+    events = [UsageEvent("u4", "gpt-4", i, 1) for i in range(7)]
+    # NOT NULL user_id: the database rejects this row however often it is retried
+    events[4] = UsageEvent(None, "gpt-4", 4, 1)
+
+    async def run():
+        writer = UsageWriter(str(tmp_path))
+        writer.record_many(events)
+        return await writer.flush(), writer.stats()
+
+    written, stats = asyncio.run(run())
+    assert written == 6
+    assert stats["dead_lettered"] == 1
+    assert stats["consecutive_failures"] == 0
+    assert stats["spool_segments"] == 0
+    assert _logged("u4") == [0, 1, 2, 3, 5, 6]
+    with open(tmp_path / "dead-letter.jsonl") as f:
+        assert [UsageEvent.from_json(line).input_tokens for line in f] == [4]
+
+
+def test_outage_is_retried_rather_than_dead_lettered(db, tmp_path, monkeypatch):
+    async def locked(*args, **kwargs):
+        raise database.DatabaseError("database is locked")
+
+    async def run():
+        writer = UsageWriter(str(tmp_path))
+        writer.record(UsageEvent("u5", "gpt-4", 1, 1))
+        monkeypatch.setattr(database, "run", locked)
+        await writer.flush()
+        return writer.stats()
+
+    stats = asyncio.run(run())
+    assert stats["pending"] == 1
+    assert stats["dead_lettered"] == 0
+    assert not (tmp_path / "dead-letter.jsonl").exists()